@@ -29,9 +29,19 @@ class Config:
     validation_periods = [0, 10, 20, max_epochs + 1]
 
     save_model_every_nth = 20
+    # checkpoints contain the complete training state (optimizers, schedulers, RNG, ...) -> python main.py --resume
+    save_checkpoint_every_nth = 1
+    # number of checkpoints that are kept in the logging folder
+    keep_last_checkpoints = 3
+
+    # precision of the training and the anonymization: 'fp32', 'bf16' (autocast, i.e. on bfloat16 capable cpus) or
+    # 'fp16' (autocast with loss scaling, gpu) | supported by DeepFake, LatentModel, PGGAN and CPGGAN
+    precision = 'fp32'
 
 
 class Deep_Fakes_Config(Config):
+    # one decoder is trained for each identity (folder in <dataset>/preprocessed)
+    identities = [A, B]
     model = DeepFakeOriginal
     model_params = {'encoder': lambda: Encoder(input_dim=(3, 128, 128),
                                                latent_dim=1024,
@@ -39,12 +49,16 @@ class Deep_Fakes_Config(Config):
                     'decoder': lambda: Decoder(input_dim=512,
                                                num_convblocks=4),
                     'auto_encoder': AutoEncoder,
-                    'select_autoencoder': 1}
+                    'identities': identities,
+                    'target': A,
+                    # opt-in: one optimizer for the encoder and all decoders instead of one per autoencoder (look into
+                    # DeepFakeOriginal), checkpoints of the two training modes are not interchangeable
+                    'fused_step': False}
 
     @staticmethod
     def data_set():
         return ImageDatesetCombined(Path(SIMONE_MERKEL), size_multiplicator=100,
-                                    img_size=(128, 128))
+                                    img_size=(128, 128), identities=Deep_Fakes_Config.identities)
 
 
 class LowResConfig(Config):
@@ -160,6 +174,10 @@ class PGGAN_CONFIG(GAN_CONFIG):
                     'epochs_fade': epochs_fade,
                     'epochs_stab': epochs_stab,
                     'level_with_multiple_gpus': 4,
+                    # apply the gradient penalty only every nth discriminator step (scaled by n), 1: every step
+                    'gp_interval': 1,
+                    # one discriminator forward pass for real and fake examples
+                    'fused_discriminator': True,
                     'batch_size_schedule': {1: 64, 2: 64, 3: 64, 4: 32, 5: 16, 6: 16},
                     # Resolutions:          4      8     16     32     64    128
                     }
@@ -180,6 +198,8 @@ class CPGGAN_CONFIG(PGGAN_CONFIG):
                     'lm_cov': ARRAY_LANDMARKS_10_COV,
                     'lr_mean': ARRAY_LOWRES_2_MEAN,
                     'lr_cov': ARRAY_LOWRES_2_COV,
+                    # features as vector instead of constant feature maps for the discriminator
+                    'broadcast_features': True,
                     }
     model_params.update(PGGAN_CONFIG.model_params)
     model_params['target_resolution'] = target_resolution
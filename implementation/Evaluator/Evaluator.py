@@ -16,50 +16,62 @@ from Preprocessor.FaceExtractor import FaceExtractor
 class Evaluator:
 
     @staticmethod
-    def evaluate_model(config, model_folder, image_folder, output_path, save_json=True):
+    def evaluate_model(config, model_folder, image_folder, output_path, save_json=True, batch_size=16):
         """
         Evaluates a model by comparing input images with output images
         :param config: the model configuration
         :param model_folder: folder of the saved model
         :param image_folder: path images used to evaluate the model
         :param output_path: path where anonymized images should be stored
+        :param batch_size: number of faces anonymized in one forward pass
         :return: list of distances
         """
 
         image_folder = Path(image_folder)
         output_path = Path(output_path)
-        model = config.model(**config.model_params)
+        model = config.model(**config.model_params, precision=config.precision, mode='inference')
         model.load_model(Path(model_folder))
+        model.set_train_mode(False)
         extractor = FaceExtractor(margin=0.05, mask_factor=10)
 
         print("The authors of the package recommend 0.6 as max distance for the same person.")
         scores = {}
-        for image_file in image_folder.iterdir():
-            if image_file.is_dir():
+        image_files = [image_file for image_file in image_folder.iterdir() if not image_file.is_dir()]
+        for start in range(0, len(image_files), batch_size):
+            # extract the faces of a batch of images, they are anonymized in one forward pass
+            extracted = []
+            for image_file in image_files[start:start + batch_size]:
+                print('#' * 10)
+                print('Extracting face:', image_file.name)
+
+                input_image = Image.open(image_file)
+                extracted_face, extracted_info = extractor(input_image)
+                if extracted_face is None:
+                    print('Face could not be extracted')
+                    continue
+                extracted.append((image_file, extracted_face, extracted_info))
+            if not extracted:
                 continue
 
-            print('#' * 10)
-            print('Processing image:', image_file.name)
-
-            input_image = Image.open(image_file)
-            extracted_face, extracted_info = extractor(input_image)
-            if extracted_face is None:
-                print('Face could not be extracted')
-                continue
-
-            face_out = model.anonymize(extracted_face, extracted_info).squeeze(0)
-            face_out = ToPILImage()(face_out.cpu().detach())
-            face_out = face_out.resize(extracted_face.size, resample=BICUBIC)
-
-            try:
-                face_out.save(output_path / ('anonymized_' + image_file.name.__str__()))
-                score, sim, emo = Evaluator.evaluate_image_pair(extracted_face, face_out)
-                scores[image_file.name] = {'score': score, 'sim': sim, 'emo': emo}
-            except Exception as ex:
-                print(ex)
-                continue
-
-            print('Current image score:', scores[image_file.name])
+            faces_out = model.anonymize_batch([extracted_face for _, extracted_face, _ in extracted],
+                                              [extracted_info for _, _, extracted_info in extracted])
+            faces_out = faces_out.cpu().detach()
+
+            for (image_file, extracted_face, _), face_out in zip(extracted, faces_out):
+                print('#' * 10)
+                print('Processing image:', image_file.name)
+                face_out = ToPILImage()(face_out)
+                face_out = face_out.resize(extracted_face.size, resample=BICUBIC)
+
+                try:
+                    face_out.save(output_path / ('anonymized_' + image_file.name.__str__()))
+                    score, sim, emo = Evaluator.evaluate_image_pair(extracted_face, face_out)
+                    scores[image_file.name] = {'score': score, 'sim': sim, 'emo': emo}
+                except Exception as ex:
+                    print(ex)
+                    continue
+
+                print('Current image score:', scores[image_file.name])
 
         if save_json:
             with open(output_path / 'scores.json', 'w') as f:
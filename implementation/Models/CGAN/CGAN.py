@@ -7,7 +7,7 @@ from torch.distributions import MultivariateNormal
 from Configuration.config_general import ARRAY_LANDMARKS_28_MEAN, ARRAY_LANDMARKS_28_COV
 from Models.CGAN.Discriminator import Discriminator
 from Models.CGAN.Generator import Generator
-from Models.ModelUtils.ModelUtils import CombinedModel, norm_img
+from Models.ModelUtils.ModelUtils import CombinedModel, InferenceNetwork, AdversarialStep, cuda_available
 from Preprocessor.FaceExtractor import extract_landmarks, normalize_landmarks
 
 
@@ -35,12 +35,20 @@ class CGAN(CombinedModel):
         lrD = kwargs.get('lrD', 0.0002)
         beta1 = kwargs.get('beta1', 0.5)
         beta2 = kwargs.get('beta2', 0.999)
+        # only the generator is constructed for the inference (look into CombinedModel.inference)
+        self.inference = kwargs.get('mode') == 'inference'
 
         # setup generator and discriminator
         self.G = Generator(input_dim=(self.z_dim, self.y_dim), output_dim=self.img_dim, ngf=ngf)
+        if self.inference:
+            if cuda_available():
+                self.cuda = True
+                self.G.cuda()
+            return
         self.D = Discriminator(y_dim=self.y_dim, input_dim=self.img_dim, ndf=ndf)
         self.G_optimizer = optim.Adam(self.G.parameters(), lr=lrG, betas=(beta1, beta2))
         self.D_optimizer = optim.Adam(self.D.parameters(), lr=lrD, betas=(beta1, beta2))
+        self.adversarial_step = AdversarialStep(self.D, self.G_optimizer, self.D_optimizer)
 
         # as loss we use standard bce loss to minimize the KL-divergence -> better use the wasserstein distance
         self.BCE_loss = nn.BCELoss()
@@ -60,15 +68,13 @@ class CGAN(CombinedModel):
         # self.distribution_lowres = MultivariateNormal(loc=self.lowres_mean.type(torch.float64),
         #                                               covariance_matrix=self.lowres_cov.type(torch.float64))
 
-        # Fixed noise for anonymization
-        self.anonym_noise = torch.randn((1, self.z_dim))
         # Fixed noise for validation
         n_val_samples = 64
         self.static_noise = torch.randn((n_val_samples, self.z_dim))
         self.static_landmarks = 2 * (self.distribution_landmarks.sample((n_val_samples,)).type(torch.float32) - 0.5)
         # self.static_lowres = 2 * (self.distribution_lowres.sample((n_val_samples,)).type(torch.float32) - 0.5)
 
-        if torch.cuda.is_available():
+        if cuda_available():
             self.cuda = True
             self.G.cuda()
             self.D.cuda()
@@ -93,10 +99,7 @@ class CGAN(CombinedModel):
             instance_noise_factor = 0
         print('Current epoch', current_epoch, 'instance noise factor', instance_noise_factor, 'Validation', validate)
 
-        # sum the loss for logging
-        g_loss_summed, d_loss_summed = 0, 0
-        iterations = 0
-
+        # the losses are accumulated by the adversarial step
         for images, features in data_loader:
             # Label vectors for loss function
             label_real, label_fake = (torch.ones(batch_size, 1, 1, 1), torch.zeros(batch_size, 1, 1, 1))
@@ -121,75 +124,85 @@ class CGAN(CombinedModel):
                 images, features, noise = images.cuda(), features.cuda(), noise.cuda()
                 features_gen = features_gen.cuda()
 
-            ############################
-            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(noise)))
-            ###########################
-            self.D_optimizer.zero_grad()
-
-            # === Train on real example with real features
-            real_predictions = self.D(images + torch.randn_like(images) * instance_noise_factor, features)
-            d_real_predictions_loss = self.BCE_loss(real_predictions, label_real)  # corresponds to log(D_real)
-            # make backward instantly
-            d_real_predictions_loss.backward()
-
-            # === Train on real example with fake features
-            fake_labels_predictions = self.D(images + torch.randn_like(images) * instance_noise_factor, features_gen)
-            d_fake_labels_loss = self.BCE_loss(fake_labels_predictions, label_fake) / 2
-            # make backward instantly
-            d_fake_labels_loss.backward()
-
-            # === Train on fake example from generator
+            # the instance noise of the real images is drawn once for both passes over the real images
+            noisy_images = images + torch.randn_like(images) * instance_noise_factor
+            # the generated images are computed once and get the same instance noise in the D and the G update
             generated_images = self.G(noise, features)
-            fake_images_predictions = self.D(generated_images.detach() + torch.randn_like(generated_images) *
-                                             instance_noise_factor, features)
-            d_fake_images_loss = self.BCE_loss(fake_images_predictions, label_fake) / 2  # corresponds to log(1-D_fake)
-            # make backward instantly
-            d_fake_images_loss.backward()
-
-            d_loss = d_real_predictions_loss + d_fake_labels_loss + d_fake_images_loss
-            self.D_optimizer.step()
+            noisy_generated_images = generated_images + torch.randn_like(generated_images) * instance_noise_factor
 
-            ############################
+            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(noise)))
             # (2) Update G network: maximize log(D(G(noise)))
-            ###########################
-            self.G_optimizer.zero_grad()
-
-            # === Train on fooling the Discriminator
-            fake_images_predictions = self.D(generated_images + torch.randn_like(generated_images) *
-                                             instance_noise_factor, features)
-            g_loss = self.BCE_loss(fake_images_predictions, label_real)
-
-            g_loss.backward()
-            self.G_optimizer.step()
-
-            # losses
-            g_loss_summed += float(g_loss)
-            d_loss_summed += float(d_loss)
-            iterations += 1
+            self.adversarial_step(noisy_generated_images,
+                                  lambda fake: self.discriminator_step_loss(noisy_images, fake, features, features_gen,
+                                                                            label_real, label_fake),
+                                  lambda fake: self.generator_step_loss(fake, features, label_real),
+                                  validate=validate)
 
         if not validate:
-            g_loss_summed /= iterations
-            d_loss_summed /= iterations
-            log_info = {'loss': {'lossG': g_loss_summed,
-                                 'lossD': d_loss_summed}}
-            log_img = generated_images + torch.randn_like(generated_images) * instance_noise_factor
+            values = self.adversarial_step.get_metrics()
+            log_info = {'loss': {'lossG': values['lossG'],
+                                 'lossD': values['lossD']}}
+            log_img = noisy_generated_images
         else:
             log_info = {}
             log_img = generated_images
 
         return log_info, log_img
 
+    def discriminator_step_loss(self, images, fake, features, features_gen, label_real, label_fake):
+        """
+        :param images: real images (with instance noise)
+        :param fake: detached generated images (with instance noise)
+        :param features: real features
+        :param features_gen: features sampled from the distribution of the features
+        :param label_real: labels of the real examples
+        :param label_fake: labels of the fake examples
+        :return: loss of the discriminator and dict of logged values
+        """
+        # === Train on real example with real features
+        real_predictions = self.D(images, features)
+        d_real_predictions_loss = self.BCE_loss(real_predictions, label_real)  # corresponds to log(D_real)
+
+        # === Train on real example with fake features
+        fake_labels_predictions = self.D(images, features_gen)
+        d_fake_labels_loss = self.BCE_loss(fake_labels_predictions, label_fake) / 2
+
+        # === Train on fake example from generator
+        fake_images_predictions = self.D(fake, features)
+        d_fake_images_loss = self.BCE_loss(fake_images_predictions, label_fake) / 2  # corresponds to log(1-D_fake)
+
+        d_loss = d_real_predictions_loss + d_fake_labels_loss + d_fake_images_loss
+        return d_loss, {'lossD': d_loss}
+
+    def generator_step_loss(self, fake, features, label_real):
+        """
+        :param fake: generated images (with instance noise)
+        :param features: features the images were generated with
+        :param label_real: labels of the real examples
+        :return: loss of the generator and dict of logged values
+        """
+        # === Train on fooling the Discriminator
+        fake_images_predictions = self.D(fake, features)
+        g_loss = self.BCE_loss(fake_images_predictions, label_real)
+        return g_loss, {'lossG': g_loss}
+
     def get_modules(self):
+        if self.inference:
+            return [self.G]
         return [self.G, self.D]
 
     def get_model_names(self):
+        if self.inference:
+            return ['generator']
         return ['generator', 'discriminator']
 
     def get_remaining_modules(self):
+        if self.inference:
+            return []
         return [self.G_optimizer, self.D_optimizer, self.BCE_loss]
 
-    def anonymize(self, extracted_face, extracted_information):
-        self.anonym_noise = torch.randn((1, self.z_dim))
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
         # ===== Landmarks
         # Normalize landmarks
         landmarks = normalize_landmarks(extracted_information)
@@ -206,16 +219,11 @@ class CGAN(CombinedModel):
         # ===== Zero centering
         feature -= 0.5
         feature *= 2.0
-        if self.cuda:
-            self.anonym_noise, feature = self.anonym_noise.cuda(), feature.cuda()
-        tensor_img = self.G(self.anonym_noise, feature)
-
-        # ===== Denormalize generated image
-        for t in tensor_img:  # loop over mini-batch dimension
-            norm_img(t)
-        tensor_img *= 255
-        tensor_img = tensor_img.type(torch.uint8)
-        return tensor_img
+        return feature
+
+    def get_inference_network(self, **kwargs):
+        # new noise for each face, the generator gets noise and features as separate inputs
+        return InferenceNetwork(self.G, (self.y_dim,), noise_size=self.z_dim, concat_noise=False, output='uint8')
 
     def log_images(self, logger, epoch, images, validation=True):
         tag = 'validation_output' if validation else 'training_output'
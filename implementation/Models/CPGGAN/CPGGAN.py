@@ -1,8 +1,9 @@
+import time
+
 from torch.distributions import MultivariateNormal
 
 from Configuration.config_general import ARRAY_LANDMARKS_28_MEAN, ARRAY_LANDMARKS_28_COV, \
     ARRAY_LOWRES_4_MEAN, ARRAY_LOWRES_4_COV
-from Models.ModelUtils.ModelUtils import norm_img
 from Models.PGGAN.PGGAN import PGGAN
 from Models.PGGAN.model import torch, np
 from Preprocessor.FaceExtractor import extract_landmarks, extract_lowres
@@ -15,6 +16,9 @@ class CPGGAN(PGGAN):
 
     def __init__(self, **kwargs):
         super(CPGGAN, self).__init__(**kwargs)
+        # pass the features to the discriminator as vector instead of constant feature maps (same objective, the
+        # gradient penalty can be compared with the feature maps by check_gradient_penalty.py)
+        self.broadcast_features = kwargs.get('broadcast_features', False)
         if self.mode == 'train':
             # path to numpy arrays containing the calculated mean and cov matrices for calculating a multivariate gaussian
             path_to_lm_mean = kwargs.get('lm_mean', ARRAY_LANDMARKS_28_MEAN)
@@ -47,15 +51,20 @@ class CPGGAN(PGGAN):
         # Static noise for anonymization
         self.anonymization_noise = self.noise(1)
 
+    # static features used for the validation images are part of the training state as well
+    stage_variables = PGGAN.stage_variables + ['static_landmarks', 'static_lowres']
+
     def train(self, train_data_loader, batch_size, validate, **kwargs):
 
         if not validate:
-            self.schedule_resolution()
+            # the stage of an interrupted epoch was already scheduled before the checkpoint
+            if not kwargs.get('resumed', False):
+                self.schedule_resolution()
             train_data_loader = self.data_loader.get_train_data_loader()
 
-        # sum the loss for logging
-        g_loss_summed, d_loss_summed, wasserstein_d_summed, eps_summed = 0, 0, 0, 0
+        # the losses are accumulated by the adversarial step
         iterations = 0
+        start_time = time.time()
 
         for images, features in train_data_loader:
             # set the fade_in_factor:
@@ -91,108 +100,68 @@ class CPGGAN(PGGAN):
 
             # because of the conditioning we concatenate noise and features to one big vector
             input_vec = torch.cat([noise, features], 1)
-            # for the discriminator the process is a bit more complicated:
-            # we add the features as additional channels to the input image
-            features_fill = features.view((self.batch_size, -1, 1, 1)).repeat((1, 1, images.shape[2], images.shape[2]))
-            input_img_real = torch.cat([images, features_fill], 1)
-            ############################
-            # (1) Update D network: minimize -D(x) + D(G(z)) + penalty instead of clipping
-            ###########################
-            if not validate:
-                # Avoid computations in Generator training
-                self.D.train(True)
-                self.D_optimizer.zero_grad()
-
-            # Train on real example with real features
-            D_real = self.D(input_img_real, cur_level=cur_level)
-
-            # Epsilon loss => 4th loss term from Nvidia paper
-            eps_loss = D_real ** 2
-            eps_loss = 0.001 * eps_loss.mean()
-
-            # Wasserstein Loss
-            D_real = -D_real.mean() + eps_loss
-            if not validate:
-                D_real.backward()
-
-            # Train on fake example from generator
-            G_fake = self.G(input_vec, cur_level=cur_level)
+
+            # Generate fake example from generator (reused for the generator update)
+            with self.mixed_precision.autocast():
+                G_fake = self.G(input_vec, cur_level=cur_level)
             if validate:
                 # Validate only generated image
                 break
+            # the discriminator gets the conditional data as well
+            input_img_real, features_D = self.discriminator_input(images, features)
+            input_img_fake, _ = self.discriminator_input(G_fake, features)
 
-            # concat the input so that the discriminator gets the conditional data as well
-            input_img_fake = torch.cat([G_fake, features_fill], 1)
-            D_fake = self.D(input_img_fake.detach(), cur_level=cur_level)
-
-            # Wasserstein Loss
-            D_fake = D_fake.mean()
-            if not validate:
-                D_fake.backward()
-
-            # Wasserstein loss
-            # train with gradient penalty
-            gp = self.calculate_gradient_penalty(input_img_real, input_img_fake.detach(), cur_level)
-            if not validate:
-                gp.backward()
-
-            # Wasserstein loss
-            D_loss = float(D_fake - D_real + gp)
-            Wasserstein_D = float(D_real - D_fake)
-
-            if not validate:
-                self.D_optimizer.step()
-
-            ############################
+            # (1) Update D network: minimize -D(x) + D(G(z)) + penalty instead of clipping
             # (2) Update G network: minimize -D(G(z)) (is same to maximise D(G(z)) / Discriminator makes an error)
-            ###########################
-            if not validate:
-                self.D.train(False)
-                self.G_optimizer.zero_grad()
-
-            # Train on fooling the Discriminator
-            D_fake = self.D(input_img_fake, cur_level=cur_level)
-
-            # Wasserstein Loss
-            D_fake = -D_fake.mean()
-            if not validate:
-                D_fake.backward()
-                self.G_optimizer.step()
-            G_loss = float(D_fake)
-
-            # losses
-            g_loss_summed += G_loss
-            d_loss_summed += D_loss
-            wasserstein_d_summed += Wasserstein_D
-            eps_summed += float(eps_loss)
+            self.adversarial_step(input_img_fake,
+                                  lambda fake: self.discriminator_step_loss(input_img_real, fake, cur_level,
+                                                                            features_D),
+                                  lambda fake: self.generator_step_loss(fake, cur_level, features_D),
+                                  validate=validate)
             iterations += 1
 
-            if not self.stabilization_phase and not validate:
+            if not self.stabilization_phase:
                 # Count only images during training
                 self.images_faded_in += self.batch_size
 
         if not validate:
-            g_loss_summed /= iterations
-            d_loss_summed /= iterations
-            log_info = {'loss': {'lossG': g_loss_summed,
-                                 'lossD': d_loss_summed},
-                        'info/WassersteinDistance': wasserstein_d_summed,
-                        'info/eps': eps_summed,
-                        'info/curr_level': cur_level}
-            log_img = G_fake
+            values = self.adversarial_step.get_metrics()
+            log_info = {'loss': {'lossG': values['lossG'],
+                                 'lossD': values['lossD']},
+                        'info/WassersteinDistance': values['WassersteinDistance'],
+                        'info/eps': values['eps'],
+                        'info/curr_level': cur_level,
+                        'info/iterations_per_second': iterations / (time.time() - start_time),
+                        'info/gp_interval': self.gp_interval}
+            log_img = G_fake.float()
         else:
             log_info = {}
-            log_img = G_fake
+            log_img = G_fake.float()
 
         return log_info, log_img
 
-    def anonymize(self, extracted_face, extracted_information, level_out=None):
+    def discriminator_input(self, images, features):
+        """
+        The discriminator gets the features as additional channels of the input image. With broadcast_features they
+        are passed separately and only the projection of the features by the first 1x1 convolution is broadcast
+        (same result without the batch x features x height x width tensor, look into DSelectLayer.apply_input).
+        :param images: real or generated images
+        :param features: conditioning vector of the images
+        :return: input images and features (None if they are already part of the images) for the discriminator
+        """
+        if self.broadcast_features:
+            return images, features
+        return self.concatenate_features(images, features), None
+
+    def concatenate_features(self, images, features):
         """
-        :param extracted_face:
-        :param extracted_information:
-        level_out: Output layer
-        :return:
+        :return: images with the features as additional constant channels
         """
+        features_fill = features.view((images.size(0), -1, 1, 1)).repeat((1, 1, images.shape[2], images.shape[2]))
+        return torch.cat([images, features_fill], 1)
+
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
         # ===== Landmarks
         # Normalize landmarks
         landmarks = np.array(extracted_information.landmarks) / extracted_information.size_fine
@@ -211,25 +180,5 @@ class CPGGAN(PGGAN):
         # ===== Zero centering
         feature -= 0.5
         feature *= 2.0
-
-        # ===== Create input vector & move to GPU
-        input_vec = torch.cat([self.noise(1), feature], 1)
-        if self.cuda:
-            input_vec = input_vec.cuda()
-
-        # ===== Determine output resolution
-        if level_out is None:
-            level = int(np.log2(self.target_resolution)) - 1
-        else:
-            level = level_out
-        # ===== Generate image
-        # Default: Generate image on highest resolution
-        # If images on a lower level should be generated, set the level manually
-        tensor_img = self.G(input_vec, cur_level=level)
-
-        # ===== Denormalize generated image
-        for t in tensor_img:  # loop over mini-batch dimension
-            norm_img(t)
-        tensor_img *= 255
-        tensor_img = tensor_img.type(torch.uint8)
-        return tensor_img
+        # the noise is concatenated in front of the features by the inference network
+        return feature
@@ -4,7 +4,7 @@ from torch import optim, nn
 from Models.CGAN import CGAN
 from Models.DCGAN.Discriminator import Discriminator
 from Models.DCGAN.Generator import Generator
-from Models.ModelUtils.ModelUtils import CombinedModel, norm_img
+from Models.ModelUtils.ModelUtils import CombinedModel, InferenceNetwork, AdversarialStep, cuda_available
 
 
 class DCGAN(CombinedModel):
@@ -27,6 +27,8 @@ class DCGAN(CombinedModel):
         beta1 = kwargs.get('beta1', 0.5)
         beta2 = kwargs.get('beta2', 0.999)
         batch_size = kwargs.get('initial_batch_size', -1)
+        # only the generator is constructed for the inference (look into CombinedModel.inference)
+        self.inference = kwargs.get('mode') == 'inference'
 
         # this makes sure pycharm doesn't delete the import statements
         if False:
@@ -36,12 +38,17 @@ class DCGAN(CombinedModel):
 
         self.g = Generator(nc=self.image_size[2], nz=self.nz, ngf=self.ngf)  # comment
         # self.g = CGAN.Generator(input_dim=(self.nz, 10), output_dim=self.image_size, ngf=self.ngf) # uncomment
+        if self.inference:
+            if cuda_available():
+                self.cuda = True
+                self.g.cuda()
+            return
         self.d = Discriminator(nc=self.image_size[2], ndf=self.ndf)  # comment
         # self.d = CGAN.Discriminator(y_dim=10, input_dim=self.image_size, ndf=self.ndf) # uncomment
 
         self.BCE_loss = nn.BCELoss()
 
-        if torch.cuda.is_available():
+        if cuda_available():
             self.cuda = True
             self.g.cuda()
             self.d.cuda()
@@ -49,6 +56,7 @@ class DCGAN(CombinedModel):
 
         self.G_optimizer = optim.Adam(self.g.parameters(), lr=lrG, betas=(beta1, beta2))
         self.D_optimizer = optim.Adam(self.d.parameters(), lr=lrD, betas=(beta1, beta2))
+        self.adversarial_step = AdversarialStep(self.d, self.G_optimizer, self.D_optimizer)
 
         self.static_noise = torch.randn(batch_size, self.nz)
 
@@ -59,10 +67,7 @@ class DCGAN(CombinedModel):
         if self.cuda:
             label_real, label_fake = label_real.cuda(), label_fake.cuda()
 
-        # sum the loss for logging
-        g_loss_summed, d_loss_summed = 0, 0
-        iterations = 0
-
+        # the losses are accumulated by the adversarial step
         # for data, features in data_loader:  # uncomment
         for data in data_loader:  # comment
             if validate:
@@ -73,102 +78,86 @@ class DCGAN(CombinedModel):
                 data = data.cuda()
                 noise = noise.cuda()
                 # features = features.cuda()  # uncomment
-            ############################
-            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
-            ###########################
-            # train with real
-            if not validate:
-                self.d.zero_grad()
-
-            output = self.d(data)  # comment
-            # output = self.d(data, features)  # uncomment
-            errD_real = self.BCE_loss(output, label_real)
-
-            if not validate:
-                errD_real.backward()
-
-            # train with fake
             fake = self.g(noise)  # comment
             # fake = self.g(noise, features)  # uncomment
-            output = self.d(fake.detach())  # comment
-            # output = self.d(fake.detach(), features)  # uncomment
-            errD_fake = self.BCE_loss(output, label_fake)
-            if not validate:
-                errD_fake.backward()
-            D_G_z1 = output.mean().item()
-            errD = errD_real + errD_fake
-            if not validate:
-                self.D_optimizer.step()
-
-            ############################
+
+            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
             # (2) Update G network: maximize log(D(G(z)))
-            ###########################
-            if not validate:
-                self.g.zero_grad()
-            output = self.d(fake)  # comment
-            # output = self.d(fake, features)  # uncomment
-            errG = self.BCE_loss(output, label_real)
-            if not validate:
-                errG.backward()
-            D_G_z2 = output.mean().item()
-            if not validate:
-                self.G_optimizer.step()
-
-            # losses
-            g_loss_summed += float(errG)
-            d_loss_summed += float(errD)
-            iterations += 1
+            self.adversarial_step(fake,
+                                  lambda generated: self.discriminator_step_loss(data, generated, label_real,
+                                                                                 label_fake),
+                                  lambda generated: self.generator_step_loss(generated, label_real),
+                                  validate=validate)
 
             if validate:
                 break
 
-        g_loss_summed /= iterations
-        d_loss_summed /= iterations
-
+        values = self.adversarial_step.get_metrics()
         if not validate:
-            log_info = {'loss': {'lossG': g_loss_summed,
-                                 'lossD': d_loss_summed},
-                        'loss/meanG': float(D_G_z1),
-                        'loss/meanD': float(D_G_z2)}
+            log_info = {'loss': {'lossG': values['lossG'],
+                                 'lossD': values['lossD']},
+                        'loss/meanG': values['meanG'],
+                        'loss/meanD': values['meanD']}
         else:
-            log_info = {'loss': {'lossG_val': g_loss_summed,
-                                 'lossD_val': d_loss_summed},
-                        'loss/meanG/val': float(D_G_z1),
-                        'loss/meanD/val': float(D_G_z2)}
+            log_info = {'loss': {'lossG_val': values['lossG'],
+                                 'lossD_val': values['lossD']},
+                        'loss/meanG/val': values['meanG'],
+                        'loss/meanD/val': values['meanD']}
 
         return log_info, fake
 
+    def discriminator_step_loss(self, data, fake, label_real, label_fake):
+        """
+        :param data: real images
+        :param fake: detached generated images
+        :param label_real: labels of the real images
+        :param label_fake: labels of the generated images
+        :return: loss of the discriminator and dict of logged values
+        """
+        # train with real
+        output = self.d(data)  # comment
+        # output = self.d(data, features)  # uncomment
+        errD_real = self.BCE_loss(output, label_real)
+
+        # train with fake
+        output = self.d(fake)  # comment
+        # output = self.d(fake, features)  # uncomment
+        errD_fake = self.BCE_loss(output, label_fake)
+        errD = errD_real + errD_fake
+        return errD, {'lossD': errD, 'meanG': output.mean()}
+
+    def generator_step_loss(self, fake, label_real):
+        """
+        :param fake: generated images
+        :param label_real: labels of the real images
+        :return: loss of the generator and dict of logged values
+        """
+        output = self.d(fake)  # comment
+        # output = self.d(fake, features)  # uncomment
+        errG = self.BCE_loss(output, label_real)
+        return errG, {'lossG': errG, 'meanD': output.mean()}
+
     def get_modules(self):
+        if self.inference:
+            return [self.g]
         return [self.g, self.d]
 
     def get_model_names(self):
+        if self.inference:
+            return ['generator']
         return ['generator', 'discriminator']
 
     def get_remaining_modules(self):
+        if self.inference:
+            return []
         return [self.G_optimizer, self.D_optimizer, self.BCE_loss]
 
-    def anonymize(self, x, **kwargs):
-        raise NotImplementedError
-
     def log_images(self, logger, epoch, images, validation=True):
         tag = 'validation_output' if validation else 'training_output'
         logger.log_images(epoch, images, tag, 8)
 
-    def anonymize(self, *args, **kwargs):
+    def get_inference_network(self, **kwargs):
         """
         No real anonymization - only random face
         """
-        # Generate random input
-        noise = torch.randn(1, self.nz)
-        if self.cuda:
-            noise = noise.cuda()
-
-        # Generate face
-        random_img = self.g(noise)
-
-        # ===== Denormalize generated image
-        norm_img(random_img)
-        random_img *= 255
-        random_img = random_img.type(torch.uint8)
-
-        return random_img
+        return InferenceNetwork(self.g, (0,), noise_size=self.nz, output='uint8')
@@ -6,133 +6,198 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torchvision.transforms import ToTensor
 
+from Configuration.config_general import A, B
 from Models.DeepFake.Autoencoder import AutoEncoder
-from Models.ModelUtils.ModelUtils import CombinedModel
+from Models.ModelUtils.ModelUtils import CombinedModel, InferenceNetwork, MixedPrecision, cuda_available
 
 
 class DeepFakeOriginal(CombinedModel):
     def __init__(self, encoder, decoder, auto_encoder=AutoEncoder, **kwargs):
         """
         Initialize a new DeepFakeOriginal.
-        The idea is to use one encoder for two different decoder. Both decoder are trained with this encoder but see
-        different input. Both are trained on one person but the shared encoder leads to a latentspace both can decode.
-        During runtime you switch the decoder and can thus switch the faces of those persons
+        The idea is to use one encoder for several decoders, one for each identity. All decoders are trained with this
+        encoder but see different input. Each is trained on one person but the shared encoder leads to a latentspace all
+        of them can decode. During runtime you switch the decoder and can thus switch the faces of those persons
+        :param identities: names of the identities, i.e. the folders of ImageDatesetCombined (default: A and B)
+        :param target: name of the identity the anonymize function decodes to (default: select_autoencoder)
+        :param select_autoencoder: 1-based index of the target identity, only used if target is not set
+        :param fused_step: train all autoencoders with one pass through the encoder and a single optimizer
+        :param precision: 'fp32', 'bf16' or 'fp16' (look into MixedPrecision)
+        :param mode: 'inference' constructs only the encoder and the decoder of the target (look into
+        CombinedModel.inference)
         """
-        self.encoder = encoder().cuda()
-        self.decoder1 = decoder().cuda()
-        self.decoder2 = decoder().cuda()
-
+        self.identities = list(kwargs.get('identities', [A, B]))
         # this variable indicates witch autoencoder and thus decoder should be used for the anonymize function
-        self.select_ae = kwargs.get('select_autoencoder', 1)
-        self.autoencoder1 = auto_encoder(self.encoder, self.decoder1).cuda()
-        self.autoencoder2 = auto_encoder(self.encoder, self.decoder2).cuda()
+        self.target = kwargs.get('target', self.identities[kwargs.get('select_autoencoder', 1) - 1])
+        if self.target not in self.identities:
+            raise ValueError('Unknown target %s, the model was trained on %s' % (self.target, self.identities))
+
+        # indices (w.r.t. identities) of the constructed decoders
+        self.inference = kwargs.get('mode') == 'inference'
+        if self.inference:
+            self.decoder_indices = [self.identities.index(self.target)]
+        else:
+            self.decoder_indices = list(range(len(self.identities)))
 
-        # standard l1 loss to calculate the difference between the input and output image
-        self.lossfn = torch.nn.L1Loss(size_average=True).cuda()
+        self.encoder = encoder()
+        self.decoders = [decoder() for _ in self.decoder_indices]
+        self.autoencoders = [auto_encoder(self.encoder, decoder) for decoder in self.decoders]
 
-        self.optimizer1 = Adam(self.autoencoder1.parameters(), lr=1e-4)
-        self.scheduler1 = ReduceLROnPlateau(self.optimizer1, patience=100, cooldown=50)
-        self.optimizer2 = Adam(self.autoencoder2.parameters(), lr=1e-4)
-        self.scheduler2 = ReduceLROnPlateau(self.optimizer2, patience=100, cooldown=50)
+        if cuda_available():
+            self.cuda = True
+            for autoencoder in self.autoencoders:
+                autoencoder.cuda()
+        self.mixed_precision = MixedPrecision(kwargs.get('precision', 'fp32'), self.cuda)
+        if self.inference:
+            return
+
+        # standard l1 loss to calculate the difference between the input and output image
+        self.lossfn = torch.nn.L1Loss()
+        if self.cuda:
+            self.lossfn.cuda()
+
+        # the fused step passes all faces through the shared encoder at once and updates all weights with a single
+        # optimizer | otherwise each autoencoder is trained with its own optimizer
+        self.fused_step = kwargs.get('fused_step', False)
+        if self.fused_step:
+            parameters = list(self.encoder.parameters())
+            for decoder in self.decoders:
+                parameters += list(decoder.parameters())
+            self.optimizer = Adam(parameters, lr=1e-4)
+            self.scheduler = ReduceLROnPlateau(self.optimizer, patience=100, cooldown=50)
+        else:
+            self.optimizers = [Adam(autoencoder.parameters(), lr=1e-4) for autoencoder in self.autoencoders]
+            self.schedulers = [ReduceLROnPlateau(optimizer, patience=100, cooldown=50)
+                               for optimizer in self.optimizers]
 
     def train(self, train_data_loader, batch_size, validate, **kwargs):
-        current_epoch = kwargs.get('current_epoch', -1)
-
-        loss1_mean, loss2_mean = 0, 0
-        face1 = None
-        face1_warped = None
-        output1 = None
-        face2 = None,
-        face2_warped = None
-        output2 = None
+        losses_summed = [0] * len(self.identities)
+        faces_warped, faces, outputs = [], [], []
         iterations = 0
 
-        for (face1_warped, face1), (face2_warped, face2) in train_data_loader:
-            # face1 and face2 contain a batch of images of the first and second face, respectively
-            face1, face2 = face1.cuda(), face2.cuda()
+        for batch in train_data_loader:
+            # the batch contains a tuple (warped face, face) for each identity
             # the warped images are augmented to make the learning more robust
-            face1_warped, face2_warped = face1_warped.cuda(), face2_warped.cuda()
-
-            ############################
-            # (1) train the first autoencoder
-            ###########################
-
-            if not validate:
-                self.optimizer1.zero_grad()
-
-            output1 = self.autoencoder1(face1_warped)
-            loss1 = self.lossfn(output1, face1)
-
-            if not validate:
-                loss1.backward()
-                self.optimizer1.step()
-
-            ############################
-            # (2) train the second autoencoder
-            ###########################
-
-            if not validate:
-                self.optimizer2.zero_grad()
-
-            output2 = self.autoencoder2(face2_warped)
-            loss2 = self.lossfn(output2, face2)
-
-            if not validate:
-                loss2.backward()
-                self.optimizer2.step()
-
-            loss1_mean += float(loss1)
-            loss2_mean += float(loss2)
+            faces_warped = [face_warped for face_warped, _ in batch]
+            faces = [face for _, face in batch]
+            if self.cuda:
+                faces_warped = [face_warped.cuda() for face_warped in faces_warped]
+                faces = [face.cuda() for face in faces]
+
+            if self.fused_step:
+                ############################
+                # train all autoencoders with one pass through the encoder
+                ###########################
+
+                if not validate:
+                    self.optimizer.zero_grad()
+
+                with self.mixed_precision.autocast():
+                    outputs = self.forward_fused(*faces_warped)
+                    losses = [self.lossfn(output, face) for output, face in zip(outputs, faces)]
+
+                if not validate:
+                    self.mixed_precision.backward(sum(losses))
+                    self.mixed_precision.step(self.optimizer)
+            else:
+                ############################
+                # train the autoencoders one after another
+                ###########################
+                outputs, losses = [], []
+                for i, autoencoder in enumerate(self.autoencoders):
+                    if not validate:
+                        self.optimizers[i].zero_grad()
+
+                    with self.mixed_precision.autocast():
+                        output = autoencoder(faces_warped[i])
+                        loss = self.lossfn(output, faces[i])
+
+                    if not validate:
+                        self.mixed_precision.backward(loss)
+                        self.mixed_precision.step(self.optimizers[i])
+                    outputs.append(output)
+                    losses.append(loss)
+
+            # sum as tensors, this way the training doesn't wait for the gpu in every iteration
+            losses_summed = [summed + loss.detach() for summed, loss in zip(losses_summed, losses)]
             iterations += 1
 
-        loss1_mean /= iterations
-        loss2_mean /= iterations
-        loss1_mean = loss1_mean.cpu().data.numpy()
-        loss2_mean = loss2_mean.cpu().data.numpy()
+        losses_mean = [float(summed) / iterations for summed in losses_summed]
         if not validate:
-            self.scheduler1.step(loss1_mean, current_epoch)
-            self.scheduler2.step(loss2_mean, current_epoch)
+            if self.fused_step:
+                self.scheduler.step(sum(losses_mean))
+            else:
+                for scheduler, loss_mean in zip(self.schedulers, losses_mean):
+                    scheduler.step(loss_mean)
 
-        if not validate:
-            log_info = {'loss': {'lossA': loss1_mean, 'lossB': loss2_mean}}
-        else:
-            log_info = {'loss': {'lossA_val': loss1_mean, 'lossB_val': loss2_mean}}
+        suffix = '' if not validate else '_val'
+        log_info = {'loss': {'loss' + name + suffix: loss_mean for name, loss_mean in zip(self.identities, losses_mean)}}
+
+        return log_info, [faces_warped, [output.float() for output in outputs], faces]
 
-        return log_info, [face1_warped, output1, face1, face2_warped, output2, face2]
+    def forward_fused(self, *faces):
+        """
+        Same as calling the i-th autoencoder on the i-th batch of faces, but all batches are passed through the shared
+        encoder together
+        :param faces: one batch of faces for each identity
+        :return: list with the output of each decoder
+        """
+        sizes = [len(face) for face in faces]
+        faces = torch.cat(faces)
+        ngpu = torch.cuda.device_count()
+        if faces.is_cuda and ngpu > 1:
+            latents = torch.nn.parallel.data_parallel(self.encoder, faces, range(ngpu)).split(sizes)
+            return [torch.nn.parallel.data_parallel(decoder, latent, range(ngpu))
+                    for decoder, latent in zip(self.decoders, latents)]
+        latents = self.encoder(faces).split(sizes)
+        return [decoder(latent) for decoder, latent in zip(self.decoders, latents)]
 
     def get_modules(self):
-        return [self.encoder, self.decoder1, self.decoder2]
+        return [self.encoder] + self.decoders
 
     def get_model_names(self):
-        return ['encoder', 'decoder1', 'decoder2']
+        return ['encoder'] + ['decoder%d' % (i + 1) for i in self.decoder_indices]
 
     def get_remaining_modules(self):
-        return [self.autoencoder1, self.autoencoder2, self.lossfn, self.optimizer1, self.optimizer2, self.scheduler1,
-                self.scheduler2]
+        if self.inference:
+            return self.autoencoders
+        if self.fused_step:
+            return self.autoencoders + [self.lossfn, self.optimizer, self.scheduler]
+        return self.autoencoders + [self.lossfn] + self.optimizers + self.schedulers
 
-    def anonymize(self, extracted_face, extracted_information, **kwargs):
-        extracted_face = ToTensor()(extracted_face.resize((128, 128), resample=BICUBIC)).unsqueeze(0).cuda()
-        if self.select_ae == 1:
-            output = self.autoencoder1(extracted_face)
-        else:
-            output = self.autoencoder2(extracted_face)
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
+        return ToTensor()(extracted_face.resize((128, 128), resample=BICUBIC)).unsqueeze(0)
+
+    def get_validation_input(self, batch):
+        # the unwarped faces of all identities
+        return torch.cat([face for _, face in batch])
 
-        return output
+    def get_inference_network(self, target=None, **kwargs):
+        """
+        :param target: name of the identity the faces are decoded to (default: the target of the model)
+        """
+        target = self.target if target is None else target
+        if target not in self.identities:
+            raise ValueError('Unknown target %s, the model was trained on %s' % (target, self.identities))
+        index = self.identities.index(target)
+        if index not in self.decoder_indices:
+            raise ValueError('Only the decoder of %s was constructed for the inference' % self.target)
+        return InferenceNetwork(self.autoencoders[self.decoder_indices.index(index)], (3, 128, 128))
 
     def log_images(self, logger, epoch, images, validation=True):
-        examples = int(len(images[0]))
+        faces_warped, outputs, faces = images
+        examples = int(len(faces[0]))
         example_indices = random.sample(range(0, examples - 1), 5)
-
-        anonym_img_1 = self.autoencoder1(images[5][example_indices])
-        anonym_img_2 = self.autoencoder2(images[2][example_indices])
-        A = []
-        B = []
-        for idx, i in enumerate(example_indices):
-            for j in range(3):
-                A.append(images[j].cpu()[i])
-                B.append(images[3 + j].cpu()[i])
-            A.append(anonym_img_1.cpu()[idx])
-            B.append(anonym_img_2.cpu()[idx])
-            tag = 'validation_output' if validation else 'training_output'
-        logger.log_images(epoch, A, f"{tag}/A", 4)
-        logger.log_images(epoch, B, f"{tag}/B", 4)
+        tag = 'validation_output' if validation else 'training_output'
+
+        for i, name in enumerate(self.identities):
+            # the faces of the next identity are swapped to this identity
+            swapped = self.autoencoders[i](faces[(i + 1) % len(self.identities)][example_indices])
+            grid = []
+            for idx, j in enumerate(example_indices):
+                grid.append(faces_warped[i].cpu()[j])
+                grid.append(outputs[i].cpu()[j])
+                grid.append(faces[i].cpu()[j])
+                grid.append(swapped.cpu()[idx])
+            logger.log_images(epoch, grid, f"{tag}/{name}", 4)
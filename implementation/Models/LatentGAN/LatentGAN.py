@@ -6,7 +6,7 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 from Models.LatentModel.Decoder import LatentDecoder
-from Models.ModelUtils.ModelUtils import CombinedModel
+from Models.ModelUtils.ModelUtils import CombinedModel, InferenceNetwork, AdversarialStep, cuda_available
 from Preprocessor.FaceExtractor import normalize_landmarks, extract_lowres
 from .Discriminator import Discriminator
 
@@ -20,18 +20,26 @@ class LatentGAN(CombinedModel):
         self.img_dim = kwargs['img_dim']
         self.ndf = kwargs['ndf']
         self.lrD = kwargs['lrD']
+        # only the decoder is constructed for the inference (look into CombinedModel.inference)
+        self.inference = kwargs.get('mode') == 'inference'
 
         self.decoder = LatentDecoder(self.input_dim)
+        if self.inference:
+            if cuda_available():
+                self.cuda = True
+                self.decoder.cuda()
+            return
         self.discriminator = Discriminator(input_dim=self.img_dim, ndf=self.ndf)
 
-        self.l1_loss = torch.nn.L1Loss(size_average=True).cuda()
+        self.l1_loss = torch.nn.L1Loss()
         self.bce_loss = torch.nn.BCELoss()
 
         self.dec_optimizer = Adam(params=self.decoder.parameters(), lr=1e-4)
         self.dec_scheduler = ReduceLROnPlateau(self.dec_optimizer, patience=100, cooldown=50)
         self.disc_optimizer = Adam(params=self.discriminator.parameters(), lr=self.lrD)
+        self.adversarial_step = AdversarialStep(self.discriminator, self.dec_optimizer, self.disc_optimizer)
 
-        if torch.cuda.is_available():
+        if cuda_available():
             self.cuda = True
             self.decoder.cuda()
             self.discriminator.cuda()
@@ -39,11 +47,8 @@ class LatentGAN(CombinedModel):
             self.bce_loss.cuda()
 
     def train(self, train_data_loader, batch_size, validate, **kwargs):
-        g_l1_loss_mean = 0
-        d_loss_mean = 0
         faces = None
         output = None
-        iterations = 0
 
         current_epoch = kwargs.get('current_epoch', -1)
 
@@ -54,58 +59,19 @@ class LatentGAN(CombinedModel):
                 faces = faces.cuda()
                 latent_information = latent_information.cuda()
 
-            ############################
-            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
-            ###########################
-            if not validate:
-                self.disc_optimizer.zero_grad()
-
-            # Train on real examples
-            real_predictions = self.discriminator(faces)
-            d_real_predictions_loss = self.bce_loss(real_predictions, label_real)
-
-            if not validate:
-                d_real_predictions_loss.backward()
-
-            # Train on fake examples from encoder
-            generated = self.decoder(latent_information)
-            fake_predictions = self.discriminator(generated.detach())
-            d_fake_predictions_loss = self.bce_loss(fake_predictions, label_fake)
-
-            if not validate:
-                d_fake_predictions_loss.backward()
-                self.disc_optimizer.step()
-
-            d_overall_loss = d_real_predictions_loss + d_fake_predictions_loss
-
-            ############################
-            # (2) Update encoder network
-            ###########################
-            if not validate:
-                self.dec_optimizer.zero_grad()
-
-            # L1 loss for image reconstruction
+            # the output of the decoder is used for the update of the discriminator and the decoder
             output = self.decoder(latent_information)
-            g_l1_loss = self.l1_loss(output, faces) * self.alpha
-
-            if not validate:
-                g_l1_loss.backward()
 
-            fake_predictions = self.discriminator(generated)
-            g_fake_predictions_loss = self.bce_loss(fake_predictions, label_real) * (1 - self.alpha)
-
-            if not validate:
-                g_fake_predictions_loss.backward()
-                self.dec_optimizer.step()
-
-            d_loss_mean += float(d_overall_loss)
-            g_l1_loss_mean += float(g_l1_loss)
-            iterations += 1
+            # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
+            # (2) Update decoder network: L1 loss for image reconstruction and fooling the discriminator
+            self.adversarial_step(output,
+                                  lambda fake: self.discriminator_step_loss(faces, fake, label_real, label_fake),
+                                  lambda fake: self.decoder_step_loss(faces, fake, label_real),
+                                  validate=validate)
 
-        d_loss_mean /= iterations
-        g_l1_loss_mean /= iterations
-        d_loss_mean = d_loss_mean.cpu().data.numpy()
-        g_l1_loss_mean = g_l1_loss_mean.cpu().data.numpy()
+        values = self.adversarial_step.get_metrics()
+        d_loss_mean = values['disc_loss']
+        g_l1_loss_mean = values['g_l1_loss']
 
         if not validate:
             self.dec_scheduler.step(g_l1_loss_mean, current_epoch)
@@ -117,7 +83,41 @@ class LatentGAN(CombinedModel):
 
         return log_info, [faces, output]
 
-    def anonymize(self, extracted_face, extracted_information):
+    def discriminator_step_loss(self, faces, fake, label_real, label_fake):
+        """
+        :param faces: real faces
+        :param fake: detached output of the decoder
+        :param label_real: labels of the real examples
+        :param label_fake: labels of the fake examples
+        :return: loss of the discriminator and dict of logged values
+        """
+        # Train on real examples
+        real_predictions = self.discriminator(faces)
+        d_real_predictions_loss = self.bce_loss(real_predictions, label_real)
+
+        # Train on fake examples from decoder
+        fake_predictions = self.discriminator(fake)
+        d_fake_predictions_loss = self.bce_loss(fake_predictions, label_fake)
+
+        d_overall_loss = d_real_predictions_loss + d_fake_predictions_loss
+        return d_overall_loss, {'disc_loss': d_overall_loss}
+
+    def decoder_step_loss(self, faces, output, label_real):
+        """
+        :param faces: real faces
+        :param output: output of the decoder
+        :param label_real: labels of the real examples
+        :return: loss of the decoder and dict of logged values
+        """
+        # L1 loss for image reconstruction
+        g_l1_loss = self.l1_loss(output, faces) * self.alpha
+
+        fake_predictions = self.discriminator(output)
+        g_fake_predictions_loss = self.bce_loss(fake_predictions, label_real) * (1 - self.alpha)
+        return g_l1_loss + g_fake_predictions_loss, {'g_l1_loss': g_l1_loss}
+
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
         # ===== Landmarks
         # Normalize landmarks
         landmarks = normalize_landmarks(extracted_information).reshape((1, -1))
@@ -130,21 +130,29 @@ class LatentGAN(CombinedModel):
 
         latent_vector -= 0.5
         latent_vector *= 2.0
+        return latent_vector
 
-        if self.cuda:
-            latent_vector = latent_vector.cuda()
+    def get_validation_input(self, batch):
+        # the latent information is the input of the decoder
+        faces, latent_information = batch
+        return latent_information
 
-        unnormalized = self.decoder(latent_vector)
-        normalized = unnormalized / 2.0 + 0.5
-        return normalized
+    def get_inference_network(self, **kwargs):
+        return InferenceNetwork(self.decoder, (self.input_dim,), output='tanh')
 
     def get_modules(self):
+        if self.inference:
+            return [self.decoder]
         return [self.discriminator, self.decoder]
 
     def get_model_names(self):
+        if self.inference:
+            return ['decoder']
         return ['discriminator', 'decoder']
 
     def get_remaining_modules(self):
+        if self.inference:
+            return []
         return [self.dec_optimizer, self.disc_optimizer, self.dec_scheduler, self.l1_loss, self.bce_loss]
 
     def log_images(self, logger, epoch, images, validation=True):
@@ -5,7 +5,7 @@ import torch
 from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
-from Models.ModelUtils.ModelUtils import CombinedModel
+from Models.ModelUtils.ModelUtils import CombinedModel, InferenceNetwork, MixedPrecision, cuda_available
 from Preprocessor.FaceExtractor import normalize_landmarks, extract_lowres
 
 
@@ -20,16 +20,21 @@ class LatentModel(CombinedModel):
         # the decoder aka generator
         self.decoder = kwargs.get('decoder')()
         lr = kwargs.get('lr', 1e-4)
+        # the optimizer and the scheduler are not constructed for the inference (look into CombinedModel.inference)
+        self.inference = kwargs.get('mode') == 'inference'
 
         self.loss = torch.nn.L1Loss(size_average=True)
 
-        if torch.cuda.is_available():
+        if cuda_available():
             self.cuda = True
             self.decoder.cuda()
             self.loss.cuda()
+        # 'fp32', 'bf16' or 'fp16' (look into MixedPrecision)
+        self.mixed_precision = MixedPrecision(kwargs.get('precision', 'fp32'), self.cuda)
 
-        self.optimizer = Adam(params=self.decoder.parameters(), lr=lr)
-        self.scheduler = ReduceLROnPlateau(self.optimizer, patience=100, cooldown=50)
+        if not self.inference:
+            self.optimizer = Adam(params=self.decoder.parameters(), lr=lr)
+            self.scheduler = ReduceLROnPlateau(self.optimizer, patience=100, cooldown=50)
 
     def train(self, train_data_loader, batch_size, validate, **kwargs):
         loss_mean = 0
@@ -48,12 +53,13 @@ class LatentModel(CombinedModel):
                 self.optimizer.zero_grad()
 
             # just feed in the latent information and calculate the loss
-            output = self.decoder(latent_information)
-            loss = self.loss(output, face)
+            with self.mixed_precision.autocast():
+                output = self.decoder(latent_information)
+                loss = self.loss(output, face)
 
             if not validate:
-                loss.backward()
-                self.optimizer.step()
+                self.mixed_precision.backward(loss)
+                self.mixed_precision.step(self.optimizer)
 
             loss_mean += float(loss)
             iterations += 1
@@ -68,7 +74,12 @@ class LatentModel(CombinedModel):
         else:
             log_info = {'loss': {'loss_val': loss_mean}}
 
-        return log_info, [face, output]
+        return log_info, [face, output.float()]
+
+    def get_validation_input(self, batch):
+        # the latent information is the input of the decoder
+        face, latent_information = batch
+        return latent_information
 
     def get_modules(self):
         return [self.decoder]
@@ -77,6 +88,8 @@ class LatentModel(CombinedModel):
         return ['decoder']
 
     def get_remaining_modules(self):
+        if self.inference:
+            return [self.loss]
         return [self.optimizer, self.scheduler, self.loss]
 
     def log_images(self, logger, epoch, images, validation=True):
@@ -93,7 +106,8 @@ class LatentModel(CombinedModel):
 
 
 class LowResModel(LatentModel):
-    def anonymize(self, extracted_face, extracted_information):
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
         # ===== Landmarks
         # Normalize landmarks
         landmarks = normalize_landmarks(extracted_information).reshape((1, -1))
@@ -107,13 +121,10 @@ class LowResModel(LatentModel):
         # ===== Zero centering
         latent_vector -= 0.5
         latent_vector *= 2.0
+        return latent_vector
 
-        if self.cuda:
-            latent_vector = latent_vector.cuda()
-
-        unnormalized = self.decoder(latent_vector)
-        normalized = unnormalized / 2.0 + 0.5
-        return normalized
+    def get_inference_network(self, **kwargs):
+        return InferenceNetwork(self.decoder, (self.decoder.sequ[0].in_features,), output='tanh')
 
 
 class RetrainLowResModel(LowResModel):
@@ -121,6 +132,8 @@ class RetrainLowResModel(LowResModel):
     Just a simple model to retrain a LowResModel
     """
 
-    def __init__(self, decoder, model_path):
-        super().__init__(decoder)
-        self.load_model(model_path)
+    def __init__(self, decoder, model_path, **kwargs):
+        super().__init__(decoder=decoder, **kwargs)
+        if not self.inference:
+            # for the inference the retrained weights are loaded instead
+            self.load_model(model_path)
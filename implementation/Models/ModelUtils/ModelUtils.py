@@ -1,3 +1,5 @@
+import contextlib
+import functools
 from abc import abstractmethod, ABCMeta
 from pathlib import Path
 
@@ -66,10 +68,19 @@ class CombinedModel(metaclass=ABCMeta):
         automatic validation/train mode
     """
 
+    # set to True by models that move their modules to the GPU
+    cuda = False
+    # set by models that support reduced precision (look into MixedPrecision), None runs everything in fp32
+    mixed_precision = None
+    # set to True by models constructed with mode='inference': only the modules needed by anonymize are constructed,
+    # listed in get_modules and loaded (no discriminators, optimizers, data set statistics, ...)
+    inference = False
+
     @abstractmethod
     def get_modules(self):
         """
         :return: a list of modules that should be auto loaded and saved; these modules need to inherit from CustomModel
+        | in inference mode only the modules used by get_inference_network
         """
         raise NotImplementedError
 
@@ -102,15 +113,93 @@ class CombinedModel(metaclass=ABCMeta):
         """
         raise NotImplementedError
 
-    @abstractmethod
-    def anonymize(self, extracted_face, extracted_information):
+    @staticmethod
+    def get_anonymization_input(extracted_face, extracted_information):
+        """
+        Converts an extracted face into the input of the inference network (look into get_inference_network)
+        This has to be a staticmethod, thus exported models can prepare their input without constructing the model
+        :param extracted_face: extracted face (by the face extractor) in RGB
+        :param extracted_information: additional information possibly needed by the network like landmarks
+        :return: float tensor with batch dimension | by default an empty feature vector for models that only use noise
+        """
+        return torch.zeros((1, 0))
+
+    def get_inference_network(self, **kwargs):
+        """
+        :param kwargs: additional variables needed for a individual model (i.e. the output level of the PGGAN)
+        :return: InferenceNetwork that maps the output of get_anonymization_input to the anonymized face
+        """
+        raise NotImplementedError
+
+    def get_folded_modules(self):
+        """
+        :return: dict with names and optimized copies of modules for the inference that are derived from the weights
+        (i.e. the folded generators of the PGGAN) | bundles contain their weights as well (look into Utils/Bundle.py)
+        """
+        return {}
+
+    def set_folded_modules(self, modules):
+        """
+        Uses the modules returned by get_folded_modules, i.e. loaded from a bundle, until the weights change
+        :param modules: dict with the names and the modules
+        """
+        pass
+
+    def get_validation_input(self, batch):
+        """
+        Converts a batch of the data set into a batch of inputs of the inference network, i.e. to calibrate and check a
+        quantized export (look into Utils/Export.py)
+        :param batch: one batch of the data loader of the data set the model was trained on
+        :return: float tensor with the same format as the output of get_anonymization_input
+        """
+        raise NotImplementedError
+
+    def anonymize(self, extracted_face, extracted_information, **kwargs):
         """
         This function is used to anonymize a incoming picture
         :param extracted_face: extracted face (by the face extractor) in RGB
         :param extracted_information: additional information possibly needed by the network like landmarks)
+        :param kwargs: passed to get_inference_network
         :return: returns a anonymized version of the input image
         """
-        raise NotImplementedError
+        return self.anonymize_batch([extracted_face], [extracted_information], **kwargs)
+
+    def anonymize_batch(self, extracted_faces, extracted_informations, noise=None, **kwargs):
+        """
+        Same as anonymize for several faces, i.e. of different images, in one forward pass. Each face gets its own
+        noise.
+        :param extracted_faces: list of extracted faces (by the face extractor) in RGB
+        :param extracted_informations: list with the additional information of each face
+        :param noise: batch with the noise of each face (look into get_noise_size), by default new noise is drawn
+        :param kwargs: passed to get_inference_network
+        :return: batch with the anonymized version of each face | computed without autograd, set_train_mode only
+        disables it for the calling thread and the anonymization may run in other threads (look into
+        Utils/VideoPipeline.py)
+        """
+        network_input = torch.cat([self.get_anonymization_input(extracted_face, extracted_information)
+                                   for extracted_face, extracted_information in
+                                   zip(extracted_faces, extracted_informations)])
+        if self.cuda:
+            network_input = network_input.cuda()
+        with torch.no_grad(), \
+                self.mixed_precision.autocast() if self.mixed_precision is not None else contextlib.nullcontext():
+            return self.get_inference_network(**kwargs)(network_input, noise)
+
+    def get_noise_size(self, **kwargs):
+        """
+        :param kwargs: passed to get_inference_network
+        :return: length of the noise vector of each face, 0 if the anonymization is deterministic
+        """
+        return self.get_inference_network(**kwargs).noise_size
+
+    def get_output_levels(self, min_resolution=4):
+        """
+        Levels of the output resolution, only progressive models (look into PGGAN) can generate faces with a lower
+        resolution
+        :param min_resolution: minimal resolution of the generated faces
+        :return: values of level_out for get_inference_network ascending, [None] if the resolution is fixed
+        """
+        return [None]
 
     def log(self, logger, epoch, log_info, images, log_images=False):
         """
@@ -161,6 +250,8 @@ class CombinedModel(metaclass=ABCMeta):
         :param mode: current train mode (validation or training)
         :return:
         """
+        if mode and self.inference:
+            raise RuntimeError('The model was constructed for the inference only (mode=\'inference\')')
         for model in self.get_modules():
             model.train(mode)
         torch.set_grad_enabled(mode)
@@ -189,6 +280,290 @@ class CombinedModel(metaclass=ABCMeta):
         for name, model in zip(self.get_model_names(), self.get_modules()):
             model.load(path / (name + '.model'))
 
+    def get_training_state(self):
+        """
+        Collects everything besides the weights of the CustomModules that is needed to resume a training. By default
+        these are the states of all optimizers and learning rate schedulers listed in get_remaining_modules.
+        Override this function (and call super) to add model specific state, i.e. the progressive growing of PGGAN
+        :return: dict with the training state
+        """
+        return {'remaining_modules': [module.state_dict() if has_training_state(module) else None
+                                      for module in self.get_remaining_modules()]}
+
+    def set_training_state(self, state):
+        """
+        Restores the training state returned by get_training_state
+        :param state: dict with the training state
+        """
+        for module, module_state in zip(self.get_remaining_modules(), state['remaining_modules']):
+            if module_state is not None:
+                module.load_state_dict(module_state)
+
+    def get_module_states(self):
+        """
+        :return: dict with the names of the CustomModules (look into get_model_names) as keys and their state_dicts as
+        values
+        """
+        modules = {}
+        for name, model in zip(self.get_model_names(), self.get_modules()):
+            if type(model) is nn.DataParallel:
+                model = model.module
+            modules[name] = model.state_dict()
+        return modules
+
+    def get_checkpoint(self):
+        """
+        :return: dict with the weights of all CustomModules and the training state (look into get_training_state)
+        """
+        return {'modules': self.get_module_states(), 'training_state': self.get_training_state()}
+
+    def load_checkpoint(self, checkpoint):
+        """
+        Restores the weights and the training state from a checkpoint created by get_checkpoint
+        :param checkpoint: dict returned by get_checkpoint
+        """
+        # the modules have to be loaded first, the optimizers move their state to the device of the parameters
+        for name, model in zip(self.get_model_names(), self.get_modules()):
+            if type(model) is nn.DataParallel:
+                model = model.module
+            model.load_state_dict(checkpoint['modules'][name])
+        self.set_training_state(checkpoint['training_state'])
+
+
+def cuda_available():
+    """
+    Check if the modules of a model should be moved to the GPU during its construction. This is never the case while a
+    model is constructed on the meta device (look into Utils/Bundle.py), its modules are moved after the weights are
+    loaded.
+    """
+    return torch.cuda.is_available() and torch.empty(0).device.type != 'meta'
+
+
+def has_training_state(module):
+    """
+    Check if an entry of CombinedModel.get_remaining_modules holds a state that is needed to resume a training
+    (optimizers and learning rate schedulers) | the state of nn.Modules is stored with the CustomModules
+    :param module: entry of get_remaining_modules
+    :return: True if the state_dict of the module should be part of a checkpoint
+    """
+    return not isinstance(module, nn.Module) and hasattr(module, 'state_dict')
+
+
+class InferenceNetwork(nn.Module):
+    """
+    Everything a CombinedModel does on tensors during the anonymization: noise generation, the forward pass of the
+    network and the denormalization of the generated image. Only tensor operations are used, thus this module can be
+    traced and exported (look into Utils/Export.py).
+    """
+
+    def __init__(self, network, input_size, noise_size=0, concat_noise=True, output=None, **network_kwargs):
+        """
+        :param network: the network used for the anonymization (generator, decoder or autoencoder)
+        :param input_size: shape of one input (output of get_anonymization_input) without the batch dimension
+        :param noise_size: length of the gaussian noise vector generated for each input, 0 for no noise
+        :param concat_noise: concatenate noise and input to one vector, otherwise the network is called with
+        network(noise, input)
+        :param output: denormalization of the output | 'uint8': min max normalization to 0..255 (look into norm_img),
+        'tanh': from -1..1 to 0..1, None: output is used as it is
+        :param network_kwargs: additional arguments for the network (i.e. cur_level)
+        """
+        super(InferenceNetwork, self).__init__()
+        assert output in ['uint8', 'tanh', None]
+        self.network = network
+        self.input_size = tuple(input_size)
+        self.noise_size = noise_size
+        self.concat_noise = concat_noise
+        self.output = output
+        self.network_kwargs = network_kwargs
+
+    def forward(self, x, noise=None):
+        """
+        :param x: batch of inputs
+        :param noise: batch of noise vectors (noise_size), by default new noise is drawn for each input
+        """
+        if self.noise_size:
+            if noise is None:
+                noise = x.new_empty((x.size(0), self.noise_size)).normal_()
+            else:
+                noise = noise.to(x)
+            if self.concat_noise:
+                x = self.network(torch.cat([noise, x], 1), **self.network_kwargs)
+            else:
+                x = self.network(noise, x, **self.network_kwargs)
+        else:
+            x = self.network(x, **self.network_kwargs)
+        # the denormalization is done in fp32, the network may run in reduced precision (look into MixedPrecision)
+        x = x.float()
+
+        if self.output == 'uint8':
+            # min max normalization for each image of the batch
+            _min = x.flatten(1).min(1)[0].view(-1, 1, 1, 1)
+            _max = x.flatten(1).max(1)[0].view(-1, 1, 1, 1)
+            x = (x - _min) / (_max - _min + 1e-5)
+            x = (x * 255).type(torch.uint8)
+        elif self.output == 'tanh':
+            x = x / 2.0 + 0.5
+        return x
+
+
+class AdversarialStep:
+    """
+    One training step of a GAN. The output of the generator is computed once by the model and reused: detached for the
+    update of the discriminator and attached for the update of the generator. The model only provides the losses, the
+    optimizer handling and the accumulation of the logged values happen here.
+    """
+
+    def __init__(self, discriminator, generator_optimizer, discriminator_optimizer, mixed_precision=None):
+        """
+        :param discriminator: discriminator module | it does not compute gradients for its parameters during the update
+        of the generator
+        :param generator_optimizer: optimizer of the generator (or decoder)
+        :param discriminator_optimizer: optimizer of the discriminator
+        :param mixed_precision: MixedPrecision used for the losses and the updates, by default fp32
+        """
+        self.discriminator = discriminator
+        self.generator_optimizer = generator_optimizer
+        self.discriminator_optimizer = discriminator_optimizer
+        self.mixed_precision = MixedPrecision() if mixed_precision is None else mixed_precision
+        self.metrics = MetricAccumulator()
+
+    def __call__(self, generated, discriminator_loss, generator_loss, validate=False):
+        """
+        :param generated: output of the generator for this step (tensor or tuple of tensors)
+        :param discriminator_loss: function that gets the detached generated output and returns the loss of the
+        discriminator and a dict of values that should be logged
+        :param generator_loss: function that gets the generated output and returns the loss of the generator and a dict
+        of values that should be logged
+        :param validate: only calculate the losses without updating the networks
+        """
+        ############################
+        # (1) Update D network
+        ###########################
+        if not validate:
+            self.discriminator_optimizer.zero_grad()
+        with self.mixed_precision.autocast():
+            loss, values = discriminator_loss(detach(generated))
+        if not validate:
+            self.mixed_precision.backward(loss)
+            self.mixed_precision.step(self.discriminator_optimizer)
+        self.metrics.add(**values)
+
+        ############################
+        # (2) Update G network
+        ###########################
+        if not validate:
+            set_requires_grad(self.discriminator, False)
+            self.generator_optimizer.zero_grad()
+        with self.mixed_precision.autocast():
+            loss, values = generator_loss(generated)
+        if not validate:
+            self.mixed_precision.backward(loss)
+            self.mixed_precision.step(self.generator_optimizer)
+            set_requires_grad(self.discriminator, True)
+        self.metrics.add(**values)
+
+    def get_metrics(self):
+        """
+        :return: mean of the logged values since the last call | the accumulator is reset
+        """
+        values = self.metrics.mean()
+        self.metrics = MetricAccumulator()
+        return values
+
+
+class MixedPrecision:
+    """
+    Reduced precision for the training and the anonymization. The weights and the optimizers stay in fp32, only the
+    operations within autocast run in bfloat16 or float16. Gradients of float16 losses can underflow, thus these losses
+    are scaled (look into torch.amp.GradScaler); bfloat16 has the range of fp32 and needs no scaling.
+    Numerically sensitive layers opt out of the reduced precision with the float32 decorator.
+    """
+
+    DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+    def __init__(self, precision='fp32', cuda=False):
+        """
+        :param precision: 'fp32', 'bf16' or 'fp16'
+        :param cuda: the model runs on the gpu
+        """
+        if precision not in self.DTYPES:
+            raise ValueError('Unknown precision %s, use one of %s' % (precision, list(self.DTYPES)))
+        self.precision = precision
+        self.dtype = self.DTYPES[precision]
+        self.device_type = 'cuda' if cuda else 'cpu'
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=precision == 'fp16')
+
+    def autocast(self):
+        """
+        :return: context manager, the operations within run in the reduced precision
+        """
+        return torch.autocast(self.device_type, dtype=self.dtype or torch.bfloat16, enabled=self.dtype is not None)
+
+    def backward(self, loss):
+        """
+        Same as loss.backward(), but the loss is scaled if needed
+        :param loss: loss computed within autocast
+        """
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """
+        Same as optimizer.step(), but the gradients are unscaled before and the step is skipped if they contain inf/nan
+        :param optimizer: optimizer of the parameters
+        """
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def float32(forward):
+    """
+    Decorator for the forward function of numerically sensitive layers (normalizations, statistics): the layer runs in
+    fp32 even within autocast (look into MixedPrecision)
+    :param forward: forward(self, x, *args, **kwargs)
+    :return: decorated forward function
+    """
+
+    @functools.wraps(forward)
+    def float32_forward(self, x, *args, **kwargs):
+        with torch.autocast(x.device.type, enabled=False):
+            return forward(self, x.float(), *args, **kwargs)
+
+    return float32_forward
+
+
+class MetricAccumulator:
+    """
+    Sums logged values of each step. Tensors stay on their device, thus the training does not wait for the gpu in
+    every step; they are only converted to floats at the end of an epoch.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, **values):
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach()
+            self.sums[name] = self.sums.get(name, 0) + value
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def mean(self):
+        """
+        :return: dict with the mean of each value as float
+        """
+        return {name: float(value) / self.counts[name] for name, value in self.sums.items()}
+
+
+def detach(tensors):
+    """
+    :param tensors: tensor or tuple/list of tensors
+    :return: detached tensor(s)
+    """
+    if isinstance(tensors, (tuple, list)):
+        return type(tensors)(tensor.detach() for tensor in tensors)
+    return tensors.detach()
+
 
 class ConvBlock(nn.Module):
     """Convolution followed by a LeakyReLU"""
@@ -276,7 +651,8 @@ class Flatten(nn.Module):
     """Flatten images"""
 
     def forward(self, input):
-        return input.view(input.size(0), -1)
+        # reshape: the output of quantized convolutions is not contiguous
+        return input.reshape(input.size(0), -1)
 
 
 class View(nn.Module):
@@ -344,6 +720,17 @@ class RandomNoiseGenerator:
         return torch.from_numpy(self.generator([batch_size, self.size]).astype(np.float32))
 
 
+def set_requires_grad(module, requires_grad):
+    """
+    Enables or disables the gradient computation for all parameters of a module, i.e. the discriminator does not need
+    gradients for its parameters during the generator update
+    :param module: nn.Module
+    :param requires_grad: new value of requires_grad
+    """
+    for param in module.parameters():
+        param.requires_grad_(requires_grad)
+
+
 def norm_img(img):
     """
     Normalize image via min max inplace
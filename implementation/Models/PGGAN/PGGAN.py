@@ -1,7 +1,11 @@
+import time
+
 import numpy as np
+import torch.nn.functional as F
 from torch import optim
 
-from Models.ModelUtils.ModelUtils import CombinedModel, RandomNoiseGenerator, norm_img
+from Models.ModelUtils.ModelUtils import CombinedModel, RandomNoiseGenerator, InferenceNetwork, AdversarialStep, \
+    MixedPrecision, cuda_available
 from Models.PGGAN.model import Generator, Discriminator, torch
 
 
@@ -15,22 +19,28 @@ class PGGAN(CombinedModel):
         self.feature_size = kwargs.get('feature_size', 0)
         # this latent_size is used as channels for generator and discriminator
         self.latent_size = kwargs.get('latent_size', 512)
+        # 'train', 'validate' or 'inference' (only the generator is constructed, look into CombinedModel.inference)
+        self.mode = kwargs.get('mode', 'validate')
+        self.inference = self.mode == 'inference'
 
         # Modules with parameters
         self.G = Generator(num_channels=3, latent_size=self.latent_size, resolution=self.target_resolution,
                            fmap_max=self.latent_size, fmap_base=8192, tanh_at_end=True, ngpu=1)
-        self.D = Discriminator(num_channels=3 + self.feature_size, mbstat_avg='all', resolution=self.target_resolution,
-                               fmap_max=self.latent_size, fmap_base=8192, sigmoid_at_end=False, ngpu=1)
+        if not self.inference:
+            self.D = Discriminator(num_channels=3 + self.feature_size, mbstat_avg='all',
+                                   resolution=self.target_resolution, fmap_max=self.latent_size, fmap_base=8192,
+                                   sigmoid_at_end=False, ngpu=1)
 
         self.noise = RandomNoiseGenerator(self.latent_size - self.feature_size, 'gaussian')
 
         # move to gpu if available
-        if torch.cuda.is_available():
+        if cuda_available():
             self.cuda = True
-            self.G.cuda()
-            self.D.cuda()
+            for module in self.get_modules():
+                module.cuda()
+        # 'fp32', 'bf16' or 'fp16' (look into MixedPrecision) | the gradient penalty is always computed in fp32
+        self.mixed_precision = MixedPrecision(kwargs.get('precision', 'fp32'), self.cuda)
 
-        self.mode = kwargs.get('mode', 'validate')
         if self.mode == 'train':
             # the data loader is used to change resolution of input images
             self.data_loader = kwargs.get('data_loader', None)
@@ -43,6 +53,8 @@ class PGGAN(CombinedModel):
             beta2 = kwargs.get('beta2', 0.99)
             self.G_optimizer = optim.Adam(self.G.parameters(), lr=lrG, betas=(beta1, beta2))
             self.D_optimizer = optim.Adam(self.D.parameters(), lr=lrD, betas=(beta1, beta2))
+            self.adversarial_step = AdversarialStep(self.D, self.G_optimizer, self.D_optimizer,
+                                                    mixed_precision=self.mixed_precision)
 
             ############################
             # variables for growing the network
@@ -86,27 +98,64 @@ class PGGAN(CombinedModel):
             # noise generation and static noise for logging
             self.static_noise = self.noise(self.batch_size)
 
+            # lazy regularization: the gradient penalty is only applied every gp_interval discriminator steps and is
+            # scaled by gp_interval instead | 1 applies it on every step
+            self.gp_interval = kwargs.get('gp_interval', 1)
+            self.discriminator_steps = 0
+            # real and fake examples are passed through the discriminator as one batch (look into discriminator_losses)
+            self.fused_discriminator = kwargs.get('fused_discriminator', False)
+
     def get_modules(self):
+        if self.inference:
+            return [self.G]
         return [self.G, self.D]
 
     def get_model_names(self):
+        if self.inference:
+            return ['generator']
         return ['generator', 'discriminator']
 
     def get_remaining_modules(self):
+        if self.mode != 'train':
+            return [self.noise]
         return [self.G_optimizer, self.D_optimizer, self.noise]
 
+    # variables of the progressive growing that are needed to resume a training
+    stage_variables = ['resolution_level', 'epochs_in_current_stage', 'epochs_per_stage', 'images_faded_in',
+                       'images_per_fading_phase', 'stabilization_phase', 'batch_size', 'static_noise',
+                       'discriminator_steps']
+
+    def get_training_state(self):
+        state = super(PGGAN, self).get_training_state()
+        for name in self.stage_variables:
+            state[name] = getattr(self, name)
+        return state
+
+    def set_training_state(self, state):
+        super(PGGAN, self).set_training_state(state)
+        for name in self.stage_variables:
+            setattr(self, name, state[name])
+        # schedule_resolution only switches to multiple gpus when reaching exactly this level
+        if self.resolution_level >= self.level_with_multiple_gpus:
+            self.G.ngpu = self.D.ngpu = torch.cuda.device_count()
+        # the execution path of an interrupted epoch (look into schedule_resolution)
+        self.G.select_level(self.resolution_level, fading=not self.stabilization_phase)
+        self.D.select_level(self.resolution_level, fading=not self.stabilization_phase)
+
     def train(self, train_data_loader, batch_size, validate, **kwargs):
 
         # during training we adjust our current level if needed -> higher resolution -> we need to reload the
         # data_loader
         if not validate:
             # todo write with return statement -> we get a data loader from it
-            self.schedule_resolution()
+            # the stage of an interrupted epoch was already scheduled before the checkpoint
+            if not kwargs.get('resumed', False):
+                self.schedule_resolution()
             train_data_loader = self.data_loader.get_train_data_loader()
 
-        # sum the loss for logging
-        g_loss_summed, d_loss_summed, wasserstein_d_summed, eps_summed = 0, 0, 0, 0
+        # the losses are accumulated by the adversarial step
         iterations = 0
+        start_time = time.time()
 
         for images in train_data_loader:
             # todo move to self.schedule_resolution?
@@ -140,120 +189,106 @@ class PGGAN(CombinedModel):
                 images = images.cuda()
                 noise = noise.cuda()
 
-            ############################
-            # (1) Update D network: minimize -D(x) + D(G(z)) + penalty instead of clipping
-            ###########################
-            if not validate:
-                self.D.train(True)
-                self.D_optimizer.zero_grad()
-
-            # Train on real example with real features
-            D_real = self.D(images, cur_level=cur_level)
-
-            # Epsilon loss => 4th loss term from Nvidia paper
-            eps_loss = D_real ** 2
-            eps_loss = 0.001 * eps_loss.mean()
-
-            # Wasserstein Loss
-            D_real = -D_real.mean() + eps_loss
-            if not validate:
-                D_real.backward()
-
-            # Train on fake example from generator
-            G_fake = self.G(noise, cur_level=cur_level)
+            # Generate fake example (reused for the generator update)
+            with self.mixed_precision.autocast():
+                G_fake = self.G(noise, cur_level=cur_level)
             if validate:
                 # Validate only generated image
                 break
-            D_fake = self.D(G_fake.detach(), cur_level=cur_level)
 
-            # Wasserstein Loss
-            D_fake = D_fake.mean()
-            if not validate:
-                D_fake.backward()
-
-            # Wasserstein loss
-            # train with gradient penalty
-            gp = self.calculate_gradient_penalty(images, G_fake.detach(), cur_level)
-            if not validate:
-                gp.backward()
-
-            # Wasserstein loss
-            D_loss = float(D_fake - D_real + gp)
-            Wasserstein_D = float(D_real - D_fake)
-
-            if not validate:
-                self.D_optimizer.step()
-
-            ############################
+            # (1) Update D network: minimize -D(x) + D(G(z)) + penalty instead of clipping
             # (2) Update G network: minimize -D(G(z)) (is same to maximise D(G(z)) / Discriminator makes an error)
-            ###########################
-            if not validate:
-                # Avoid computations in Generator training
-                self.D.train(False)
-                self.G_optimizer.zero_grad()
-
-            # Train on fooling the Discriminator
-            D_fake = self.D(G_fake, cur_level=cur_level)
-
-            # Wasserstein Loss
-            D_fake = -D_fake.mean()
-            if not validate:
-                D_fake.backward()
-                self.G_optimizer.step()
-            G_loss = float(D_fake)
-
-            # losses
-            g_loss_summed += G_loss
-            d_loss_summed += D_loss
-            wasserstein_d_summed += Wasserstein_D
-            eps_summed += float(eps_loss)
+            self.adversarial_step(G_fake,
+                                  lambda fake: self.discriminator_step_loss(images, fake, cur_level),
+                                  lambda fake: self.generator_step_loss(fake, cur_level),
+                                  validate=validate)
             iterations += 1
 
-            if not self.stabilization_phase and not validate:
+            if not self.stabilization_phase:
                 # Count only images during training
                 self.images_faded_in += self.batch_size
 
         if not validate:
-            g_loss_summed /= iterations
-            d_loss_summed /= iterations
-            wasserstein_d_summed /= iterations
-            eps_summed /= iterations
-            log_info = {'loss': {'lossG': g_loss_summed,
-                                 'lossD': d_loss_summed},
-                        'info/WassersteinDistance': wasserstein_d_summed,
-                        'info/eps': eps_summed,
-                        'info/curr_level': cur_level}
-            log_img = G_fake
+            values = self.adversarial_step.get_metrics()
+            log_info = {'loss': {'lossG': values['lossG'],
+                                 'lossD': values['lossD']},
+                        'info/WassersteinDistance': values['WassersteinDistance'],
+                        'info/eps': values['eps'],
+                        'info/curr_level': cur_level,
+                        'info/iterations_per_second': iterations / (time.time() - start_time),
+                        'info/gp_interval': self.gp_interval}
+            log_img = G_fake.float()
         else:
             log_info = {}
-            log_img = G_fake
+            log_img = G_fake.float()
 
         return log_info, log_img
 
-    def anonymize(self, level_out=None, *args, **kwargs):
+    def get_inference_network(self, level_out=None, fold=True, **kwargs):
         """
         No real anonymization - only random face
-        level_out: Output layer
+        :param level_out: Output layer
+        :param fold: use the optimized copy of the generator (look into Generator.fold), the copy of each level is
+        cached until the weights change (look into set_train_mode, load_model and load_checkpoint)
         """
-        # Generate random input
-        noise = self.noise(1)
-        if self.cuda:
-            noise = noise.cuda()
-
         # ===== Determine output resolution
+        # Default: Generate image on highest resolution
+        # If images on a lower level should be generated, set the level manually
         if level_out is None:
             level = int(np.log2(self.target_resolution)) - 1
         else:
             level = level_out
-        # ===== Generate image
-        random_img = self.G(noise, cur_level=level)
+        # ===== Generate image from random input and denormalize it
+        if fold:
+            return InferenceNetwork(self.get_folded_generator(level), (self.feature_size,),
+                                    noise_size=self.latent_size - self.feature_size, output='uint8')
+        self.G.select_level(level)
+        return InferenceNetwork(self.G, (self.feature_size,), noise_size=self.latent_size - self.feature_size,
+                                output='uint8', cur_level=level)
+
+    def get_output_levels(self, min_resolution=4):
+        """
+        :param min_resolution: minimal resolution of the generated faces
+        :return: levels of the generator (level_out of get_inference_network) ascending, level l generates faces with
+        a resolution of 2^(l+1)
+        """
+        max_level = int(np.log2(self.target_resolution)) - 1
+        return [level for level in range(1, max_level + 1) if 2 ** (level + 1) >= min_resolution] or [max_level]
+
+    def get_folded_generator(self, level):
+        """
+        :param level: output level
+        :return: optimized copy of the generator for this level (look into Generator.fold), the copies of all levels
+        share the folded blocks
+        """
+        if self.folded_generators is None:
+            self.folded_generators = {}
+            self.folded_blocks = {}
+        if level not in self.folded_generators:
+            self.folded_generators[level] = self.G.fold(level, self.folded_blocks)
+        return self.folded_generators[level]
+
+    def get_folded_modules(self):
+        return {'generator_%d' % level: self.get_folded_generator(level) for level in self.get_output_levels()}
+
+    def set_folded_modules(self, modules):
+        self.folded_generators = {int(name.rsplit('_', 1)[1]): module for name, module in modules.items()}
+        self.folded_blocks = {}
+
+    # the folded generators of the inference: {level: generator} | None if they have to be rebuilt
+    folded_generators = None
 
-        # ===== Denormalize generated image
-        norm_img(random_img)
-        random_img *= 255
-        random_img = random_img.type(torch.uint8)
+    def set_train_mode(self, mode):
+        super(PGGAN, self).set_train_mode(mode)
+        self.folded_generators = None
 
-        return random_img
+    def load_model(self, path):
+        super(PGGAN, self).load_model(path)
+        self.folded_generators = None
+
+    def load_checkpoint(self, checkpoint):
+        super(PGGAN, self).load_checkpoint(checkpoint)
+        self.folded_generators = None
 
     def log_images(self, logger, epoch, images, validation):
         tag = 'validation_output' if validation else 'training_output'
@@ -291,34 +326,123 @@ class PGGAN(CombinedModel):
         if self.resolution_level == self.level_with_multiple_gpus:
             self.G.ngpu = self.D.ngpu = torch.cuda.device_count()
 
+        # only the layers needed for the current level and phase are executed
+        self.G.select_level(self.resolution_level, fading=not self.stabilization_phase)
+        self.D.select_level(self.resolution_level, fading=not self.stabilization_phase)
+
         self.epochs_in_current_stage += 1
 
-    def calculate_gradient_penalty(self, real_data, fake_data, cur_level):
+    def discriminator_step_loss(self, real, fake, cur_level, features=None):
+        """
+        Loss of the discriminator update: Wasserstein losses, eps loss and gradient penalty
+        :param real: real examples
+        :param fake: detached generated examples
+        :param cur_level: current level
+        :param features: optional conditioning vector (look into Discriminator.forward)
+        :return: loss and dict of logged values
+        """
+        D_real, D_fake, eps_loss = self.discriminator_losses(real, fake, cur_level, features)
+        loss = D_real + D_fake
+
+        # train with gradient penalty (lazy: only every gp_interval steps, scaled by gp_interval)
+        if self.discriminator_steps % self.gp_interval == 0:
+            gp = self.calculate_gradient_penalty(real, fake, cur_level, features) * self.gp_interval
+            loss = loss + gp
+        else:
+            gp = 0
+        self.discriminator_steps += 1
+
+        # Wasserstein loss
+        return loss, {'lossD': D_fake - D_real + gp, 'WassersteinDistance': D_real - D_fake, 'eps': eps_loss}
+
+    def generator_step_loss(self, fake, cur_level, features=None):
+        """
+        Loss of the generator update: minimize -D(G(z))
+        :param fake: generated examples
+        :param cur_level: current level
+        :param features: optional conditioning vector (look into Discriminator.forward)
+        :return: loss and dict of logged values
+        """
+        # Train on fooling the Discriminator
+        G_loss = -self.D(fake, cur_level=cur_level, features=features).mean()
+        return G_loss, {'lossG': G_loss}
+
+    def discriminator_losses(self, real, fake, cur_level, features=None):
+        """
+        Wasserstein losses of the discriminator without the gradient penalty
+        In the fused mode real and fake examples are concatenated to one batch, the minibatch standard deviation is
+        computed for each half separately thus the result is the same as with two forward passes. With multiple gpus
+        the fused batch is only split into real and fake groups of the same size as without fusing if the gpus divide
+        the batch size, otherwise the two forward passes are used.
+        :param real: real examples
+        :param fake: detached generated examples
+        :param cur_level: current level
+        :param features: optional conditioning vector for real and fake examples (look into Discriminator.forward)
+        :return: D_real (-D(x) + eps loss), D_fake (D(G(z))) and the eps loss
+        """
+        if self.fused_discriminator and real.size(0) % max(self.D.ngpu, 1) == 0:
+            if features is not None:
+                features = torch.cat([features, features])
+            D_out = self.D(torch.cat([real, fake]), cur_level=cur_level, mbstat_groups=2, features=features)
+            D_real, D_fake = D_out[:real.size(0)], D_out[real.size(0):]
+        else:
+            D_real = self.D(real, cur_level=cur_level, features=features)
+            D_fake = self.D(fake, cur_level=cur_level, features=features)
+
+        # Epsilon loss => 4th loss term from Nvidia paper
+        eps_loss = 0.001 * (D_real ** 2).mean()
+
+        # Wasserstein Loss
+        return -D_real.mean() + eps_loss, D_fake.mean(), eps_loss
+
+    def calculate_gradient_penalty(self, real_data, fake_data, cur_level, features=None, alpha=None):
         """
         https://github.com/caogang/wgan-gp/
         :param real_data: todo
         :param fake_data: todo
         :param cur_level: todo
+        :param features: optional conditioning vector (look into Discriminator.forward) | the penalty is the same as
+        for the features concatenated as constant feature maps: the gradient of a feature map at a pixel is W^T g for
+        each input convolution with the feature part W of its weight and the gradient g of its output at this pixel
+        :param alpha: interpolation factor of each example, default: uniformly random
         :return:
         """
-        # Interpolation between real & fake data
-        alpha = torch.rand(self.batch_size, 1, 1, 1)
-        alpha = alpha.expand(real_data.size())
-        alpha = alpha.cuda() if self.cuda else alpha
-
-        interpolates = alpha * real_data + ((1 - alpha) * fake_data)
-        interpolates = interpolates.cuda() if self.cuda else interpolates
-        interpolates.requires_grad_()
-
-        D_interpolate = self.D(interpolates, cur_level=cur_level)
-
-        grad = torch.autograd.grad(outputs=D_interpolate,
-                                   inputs=interpolates,
-                                   grad_outputs=torch.ones(D_interpolate.size()).cuda() if self.cuda else
-                                   torch.ones(D_interpolate.size()),
-                                   create_graph=True, retain_graph=True, only_inputs=True)[0]
-
-        _lambda = 10  # CelebA TF Code (NVIDIA PAPER)
-        gradient_penalty = ((grad.norm(2, dim=1) - 1) ** 2).mean() * _lambda
+        # the penalty is a gradient of a gradient, it is computed in fp32 even if the training uses reduced precision
+        with torch.autocast(self.mixed_precision.device_type, enabled=False):
+            real_data, fake_data = real_data.float(), fake_data.float()
+
+            # Interpolation between real & fake data
+            if alpha is None:
+                alpha = torch.rand(self.batch_size, 1, 1, 1)
+            alpha = alpha.expand(real_data.size())
+            alpha = alpha.cuda() if self.cuda else alpha
+
+            interpolates = alpha * real_data + ((1 - alpha) * fake_data)
+            interpolates = interpolates.cuda() if self.cuda else interpolates
+            interpolates.requires_grad_()
+
+            recorded = []
+            if features is not None:
+                self.D.output_layer.recorded_inputs = recorded
+            try:
+                D_interpolate = self.D(interpolates, cur_level=cur_level, features=features)
+            finally:
+                self.D.output_layer.recorded_inputs = None
+
+            grads = torch.autograd.grad(outputs=D_interpolate,
+                                        inputs=[interpolates] + [output for _, output in recorded],
+                                        grad_outputs=torch.ones(D_interpolate.size()).cuda() if self.cuda else
+                                        torch.ones(D_interpolate.size()),
+                                        create_graph=True, retain_graph=True, only_inputs=True)
+            grad = grads[0]
+            if recorded:
+                # gradient of the feature maps (batch x features x height x width)
+                channels = interpolates.size(1)
+                grad_features = sum(F.conv2d(grad_output, conv.weight[:, channels:].transpose(0, 1))
+                                    for (conv, _), grad_output in zip(recorded, grads[1:]))
+                grad = torch.cat([grad, grad_features], 1)
+
+            _lambda = 10  # CelebA TF Code (NVIDIA PAPER)
+            gradient_penalty = ((grad.norm(2, dim=1) - 1) ** 2).mean() * _lambda
 
         return gradient_penalty
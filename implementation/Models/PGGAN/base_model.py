@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import copy
 import sys
 
 import numpy as np
@@ -9,6 +10,8 @@ from torch.nn import functional as F
 from torch.nn.init import kaiming_normal_, calculate_gain
 from torch.nn.parameter import Parameter
 
+from Models.ModelUtils.ModelUtils import float32
+
 if sys.version_info.major == 3:
     from functools import reduce
 
@@ -24,6 +27,7 @@ class PixelNormLayer(nn.Module):
         super(PixelNormLayer, self).__init__()
         self.eps = eps
 
+    @float32
     def forward(self, x):
         return x / torch.sqrt(torch.mean(x ** 2, dim=1, keepdim=True) + 1e-8)
 
@@ -59,6 +63,53 @@ class WScaleLayer(nn.Module):
         return self.__class__.__name__ + param_str
 
 
+class FusedConvLayer(nn.Module):
+    """
+    Convolution, LeakyReLU and PixelNormLayer in one layer, used by fold_layers for the inference | the activation is
+    computed in place and the normalization in fp32 (look into PixelNormLayer)
+    """
+
+    def __init__(self, conv, negative_slope):
+        super(FusedConvLayer, self).__init__()
+        self.conv = conv
+        self.negative_slope = negative_slope
+
+    def forward(self, x):
+        x = F.leaky_relu(self.conv(x), self.negative_slope, inplace=True)
+        return x / torch.sqrt(torch.mean(x.float() ** 2, dim=1, keepdim=True) + 1e-8)
+
+
+def fold_layers(layers):
+    """
+    Optimizes a block of layers for the inference: the scale and the bias of each WScaleLayer are folded into a copy of
+    the preceding convolution, a folded convolution followed by LeakyReLU and PixelNormLayer becomes a FusedConvLayer.
+    The original layers are not changed.
+    :param layers: iterable of layers (i.e. nn.Sequential)
+    :return: list of layers with the same output
+    """
+    layers = list(layers)
+    folded = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        i += 1
+        if isinstance(layer, nn.Conv2d) and i < len(layers) and isinstance(layers[i], WScaleLayer):
+            wscale = layers[i]
+            i += 1
+            conv = copy.deepcopy(layer)
+            with torch.no_grad():
+                conv.weight = Parameter(layer.weight * wscale.scale, requires_grad=False)
+                bias = wscale.bias if wscale.bias is not None else torch.zeros_like(layer.weight[:, 0, 0, 0])
+                conv.bias = Parameter(bias.clone(), requires_grad=False)
+            layer = conv
+            if i + 1 < len(layers) and isinstance(layers[i], nn.LeakyReLU) and \
+                    isinstance(layers[i + 1], PixelNormLayer):
+                layer = FusedConvLayer(conv, layers[i].negative_slope)
+                i += 2
+        folded.append(layer)
+    return folded
+
+
 def mean(tensor, axis, **kwargs):
     if isinstance(axis, int):
         axis = [axis]
@@ -82,8 +133,16 @@ class MinibatchStatConcatLayer(nn.Module):
                                       'gpool'], 'Invalid averaging mode' % self.averaging
         self.adjusted_std = lambda x, **kwargs: torch.sqrt(
             torch.mean((x - torch.mean(x, **kwargs)) ** 2, **kwargs) + 1e-8)  # Tstdeps in the original implementation
+        # the minibatch is split into groups with separate statistics, i.e. real and fake examples in one batch
+        self.groups = 1
 
+    @float32
     def forward(self, x):
+        if self.groups > 1:
+            return torch.cat([self.concat_stat(group) for group in x.chunk(self.groups)], 0)
+        return self.concat_stat(x)
+
+    def concat_stat(self, x):
         shape = list(x.size())
         target_shape = shape.copy()
         vals = self.adjusted_std(x, dim=0, keepdim=True)  # per activation, over minibatch dim
@@ -246,12 +305,26 @@ class GSelectLayer(nn.Module):
         self.chain = chain
         self.post = post
         self.N = len(self.chain)
+        # (level, fading) of the execution path used for this level (look into select_level)
+        self.selected_level = None
+
+    def select_level(self, level, fading):
+        """
+        Selects the execution path for a resolution level: only the blocks and to-RGB layers that contribute to the
+        output are executed, during the stabilization phase this is a single to-RGB layer. Calls with other levels use
+        the generic path.
+        :param level: resolution level (1: 4x4, 2: 8x8, ...)
+        :param fading: fading phase | the output is interpolated between level - 1 and level
+        """
+        self.selected_level = (level, fading and level > 1)
 
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         if cur_level is None:
             cur_level = self.N  # cur_level: physical index
         if y is not None:
             assert insert_y_at is not None
+        elif is_selected_level(self.selected_level, cur_level):
+            return self.forward_selected_level(x, cur_level)
 
         min_level, max_level = int(np.floor(cur_level - 1)), int(np.ceil(cur_level - 1))
         min_level_weight, max_level_weight = int(cur_level + 1) - cur_level, cur_level - int(cur_level)
@@ -283,6 +356,20 @@ class GSelectLayer(nn.Module):
             print('G:', x.size())
         return x
 
+    def forward_selected_level(self, x, cur_level):
+        level, fading = self.selected_level
+        if self.pre is not None:
+            x = self.pre(x)
+        for i in range(level - 1):
+            x = self.chain[i](x)
+        if fading:
+            low = self.post[level - 2](x)
+        x = self.post[level - 1](self.chain[level - 1](x))
+        if fading:
+            weight = cur_level - (level - 1)
+            x = resize_activations(low, x.size()) * (1 - weight) + x * weight
+        return x
+
 
 class DSelectLayer(nn.Module):
     def __init__(self, pre, chain, inputs):
@@ -292,12 +379,43 @@ class DSelectLayer(nn.Module):
         self.chain = chain
         self.inputs = inputs
         self.N = len(self.chain)
+        # (level, fading) of the execution path used for this level (look into GSelectLayer.select_level)
+        self.selected_level = None
+        # list of (convolution, output) of the input layers applied to broadcast features, only recorded for the
+        # gradient penalty (look into PGGAN.calculate_gradient_penalty)
+        self.recorded_inputs = None
+
+    def select_level(self, level, fading):
+        self.selected_level = (level, fading and level > 1)
+
+    def apply_input(self, level, x, features=None):
+        """
+        Applies the input layer (NINLayer) of a level
+        :param level: index of the input layer
+        :param x: input images
+        :param features: optional conditioning vector (batch x n) | the result is the same as for concatenating it as
+        constant feature maps to x, but the feature part of the 1x1 convolution is computed once per sample and added
+        as bias instead of materializing the feature maps
+        """
+        if features is None:
+            return self.inputs[level](x)
+        conv = self.inputs[level][0]
+        channels = x.size(1)
+        x = F.conv2d(x, conv.weight[:, :channels], conv.bias)
+        x = x + F.linear(features, conv.weight[:, channels:, 0, 0]).view(x.size(0), -1, 1, 1)
+        if self.recorded_inputs is not None:
+            self.recorded_inputs.append((conv, x))
+        for module in self.inputs[level][1:]:
+            x = module(x)
+        return x
 
-    def forward(self, x, y=None, cur_level=None, insert_y_at=None):
+    def forward(self, x, y=None, cur_level=None, insert_y_at=None, features=None):
         if cur_level is None:
             cur_level = self.N  # cur_level: physical index
         if y is not None:
             assert insert_y_at is not None
+        elif is_selected_level(self.selected_level, cur_level):
+            return self.forward_selected_level(x, cur_level, features)
 
         max_level, min_level = int(np.floor(self.N - cur_level)), int(np.ceil(self.N - cur_level))
         min_level_weight, max_level_weight = int(cur_level + 1) - cur_level, cur_level - int(cur_level)
@@ -311,20 +429,20 @@ class DSelectLayer(nn.Module):
             print('D: level=%s, size=%s, max_level=%s, min_level=%s' % ('in', x.size(), max_level, min_level))
 
         if max_level == min_level:
-            x = self.inputs[max_level](x)
+            x = self.apply_input(max_level, x, features)
             if max_level == insert_y_at:
                 x = self.chain[max_level](x, y)
             else:
                 x = self.chain[max_level](x)
         else:
             out = {}
-            tmp = self.inputs[max_level](x)
+            tmp = self.apply_input(max_level, x, features)
             if max_level == insert_y_at:
                 tmp = self.chain[max_level](tmp, y)
             else:
                 tmp = self.chain[max_level](tmp)
             out['max_level'] = tmp
-            out['min_level'] = self.inputs[min_level](x)
+            out['min_level'] = self.apply_input(min_level, x, features)
             x = resize_activations(out['min_level'], out['max_level'].size()) * min_level_weight + \
                 out['max_level'] * max_level_weight
             if min_level == insert_y_at:
@@ -342,6 +460,38 @@ class DSelectLayer(nn.Module):
                 print('D: level=%d, size=%s' % (level, x.size()))
         return x
 
+    def forward_selected_level(self, x, cur_level, features=None):
+        level, fading = self.selected_level
+        if self.pre is not None:
+            x = self.pre(x)
+        first = self.N - level
+        if fading:
+            weight = cur_level - (level - 1)
+            high = self.chain[first](self.apply_input(first, x, features))
+            low = self.apply_input(first + 1, x, features)
+            x = resize_activations(low, high.size()) * (1 - weight) + high * weight
+            first += 1
+        else:
+            x = self.apply_input(first, x, features)
+        for i in range(first, self.N):
+            x = self.chain[i](x)
+        return x
+
+
+def is_selected_level(selected_level, cur_level):
+    """
+    Check if the execution path selected by GSelectLayer.select_level or DSelectLayer.select_level can be used
+    :param selected_level: (level, fading) or None
+    :param cur_level: level passed to forward | fractional during the fading phase
+    :return: True if cur_level belongs to the selected level and phase
+    """
+    if selected_level is None:
+        return False
+    level, fading = selected_level
+    if fading:
+        return level - 1 < cur_level < level
+    return cur_level == level
+
 
 class ConcatLayer(nn.Module):
     def __init__(self):
@@ -118,6 +118,31 @@ class Generator(CustomModule):
     def get_nf(self, stage):
         return min(int(self.fmap_base / (2.0 ** (stage * self.fmap_decay))), self.fmap_max)
 
+    def select_level(self, level, fading=False):
+        """
+        Selects the execution path for a resolution level (look into GSelectLayer.select_level)
+        """
+        self.output_layer.select_level(level, fading)
+
+    def fold(self, level, folded_blocks=None):
+        """
+        Builds an optimized copy of the generator for the inference on one resolution level: the blocks of higher
+        levels and all other to-RGB layers are dropped, the layers are folded (look into fold_layers)
+        :param level: resolution level (1: 4x4, 2: 8x8, ...)
+        :param folded_blocks: optional dict with the folded layers of each block, the copies of several levels that
+        use the same dict share the folded blocks
+        :return: nn.Sequential with the same output as forward(x, cur_level=level)
+        """
+        if folded_blocks is None:
+            folded_blocks = {}
+        select = self.output_layer
+        layers = [] if select.pre is None else [select.pre]
+        for block in list(select.chain[:level]) + [select.post[level - 1]]:
+            if block not in folded_blocks:
+                folded_blocks[block] = fold_layers(block)
+            layers += folded_blocks[block]
+        return nn.Sequential(*layers)
+
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         if x.is_cuda and self.ngpu > 1:
             x = nn.parallel.data_parallel(self.output_layer, (x, y, cur_level, insert_y_at), range(self.ngpu))
@@ -228,15 +253,41 @@ class Discriminator(CustomModule):
 
         self.output_layer = DSelectLayer(pre, lods, nins)
 
+        # the strength of the GDropLayers and the groups of the MinibatchStatConcatLayers are only updated if they
+        # change
+        self.gdrop_layers = [module for module in self.modules() if hasattr(module, 'strength')]
+        self.gdrop_strength = gdrop_strength
+        self.mbstat_layers = [module for module in self.modules() if isinstance(module, MinibatchStatConcatLayer)]
+        self.mbstat_groups = 1
+
     def get_nf(self, stage):
         return min(int(self.fmap_base / (2.0 ** (stage * self.fmap_decay))), self.fmap_max)
 
-    def forward(self, x, y=None, cur_level=None, insert_y_at=None, gdrop_strength=0.0):
-        for module in self.modules():
-            if hasattr(module, 'strength'):
+    def select_level(self, level, fading=False):
+        """
+        Selects the execution path for a resolution level (look into GSelectLayer.select_level)
+        """
+        self.output_layer.select_level(level, fading)
+
+    def forward(self, x, y=None, cur_level=None, insert_y_at=None, gdrop_strength=0.0, mbstat_groups=1, features=None):
+        """
+        :param mbstat_groups: number of equally sized groups of the batch with separate minibatch statistics, i.e. 2
+        for real and fake examples in one batch | with multiple gpus the statistics are computed for each gpu anyway,
+        the chunk of each gpu is split into the groups: the batch size of a group has to be divisible by the gpus
+        :param features: optional conditioning vector that is broadcast to the spatial size of x instead of being
+        concatenated as feature maps by the caller (look into DSelectLayer.apply_input)
+        """
+        if gdrop_strength != self.gdrop_strength:
+            for module in self.gdrop_layers:
                 module.strength = gdrop_strength
+            self.gdrop_strength = gdrop_strength
+        if mbstat_groups != self.mbstat_groups:
+            for module in self.mbstat_layers:
+                module.groups = mbstat_groups
+            self.mbstat_groups = mbstat_groups
         if x.is_cuda and self.ngpu > 1:
-            x = nn.parallel.data_parallel(self.output_layer, (x, y, cur_level, insert_y_at), range(self.ngpu))
+            x = nn.parallel.data_parallel(self.output_layer, (x, y, cur_level, insert_y_at, features),
+                                          range(self.ngpu))
         else:
-            x = self.output_layer(x, y, cur_level, insert_y_at)
+            x = self.output_layer(x, y, cur_level, insert_y_at, features)
         return x
@@ -4,6 +4,8 @@ import numpy as np
 from PIL import Image, ImageDraw
 from recordclass import recordclass
 
+from Preprocessor.FaceTracker import FaceTracker
+
 ExtractionInformation = recordclass('ExtractionInformation',
                                     ('image_original', 'image_cropped',
                                      'bounding_box_coarse', 'offsets_coarse', 'size_coarse',
@@ -36,7 +38,7 @@ class FaceExtractor(object):
     5. Crop image fine to center face
     """
 
-    def __init__(self, margin=0.05, mask_factor=10, sharp_edge=True, video_mode=False):
+    def __init__(self, margin=0.05, mask_factor=10, sharp_edge=True, video_mode=False, multi_face=False):
         """
         Initializer for a FaceExtractor object
         :param margin: Factor to adapt size of the cropped region
@@ -51,8 +53,14 @@ class FaceExtractor(object):
         :param video_mode: Boolean flag:
                           * True: Extract face from consecutive frames -> activate filter
                           * False: Extract face from single frames
+        :param multi_face: Boolean flag (only used by extract_faces):
+                          * True: Extract all faces, in video mode they are tracked (look into FaceTracker)
+                          * False: Extract the first detected face
         """
         self.landmarks_extractor = LandmarksExtractor(video_mode)
+        self.video_mode = video_mode
+        self.multi_face = multi_face
+        self.face_tracker = FaceTracker() if video_mode and multi_face else None
         # 1.05: Crop coarse face with additional safety margin
         # => no facial landmarks can get lost during rotation
         self.face_cropper_coarse = FaceCropperCoarse(margin=margin * 1.05)
@@ -66,8 +74,8 @@ class FaceExtractor(object):
         :param image: PIL image
         :return: extracted_face: Extracted face
                  extraction_information: namedtuple with the following elements
-                    * image_original: The original scene (PIL image)
-                    * image_cropped: The cropped region from the original image (PIL image)
+                    * image_original: The original scene (np.array, not copied)
+                    * image_cropped: The cropped region from the original image (np.array)
                     * bounding_box_coarse: Namedtuple with the coordinates of the cropped ROI
                                            in the original image
                     * offsets_coarse: index shift to pad image and prevent indices out of image
@@ -80,6 +88,19 @@ class FaceExtractor(object):
                     * size_fine: size (quadratic) of the fine cropped image
                     * landmarks: coordinates of facial regions (x,y)
         """
+        # Convert PIL image into np.array
+        image = np.array(image)
+        return self.extract(image, self.landmarks_extractor(image))
+
+    def extract(self, image, landmarks, bgr=False):
+        """
+        Same as calling the extractor, but with given landmarks (look into LandmarksExtractor), i.e. detected in another
+        thread
+        :param image: np.array (RGB)
+        :param landmarks: face_landmarks or None if no face was detected
+        :param bgr: the image is a BGR frame of OpenCV, only the extracted face is converted to RGB
+        :return: extracted_face and extraction_information (look into __call__)
+        """
         extracted_face = None
         original_image = None
         cropped_image = None
@@ -92,9 +113,6 @@ class FaceExtractor(object):
         offsets_fine = None
         size_fine = None
 
-        # Convert PIL image into np.array
-        image = np.array(image)
-        landmarks = self.landmarks_extractor(image)
         if landmarks is not None:
             original_image = image
             cropped_image, bounding_box_coarse, offsets_coarse, size_coarse = \
@@ -103,10 +121,10 @@ class FaceExtractor(object):
             aligned_image, rotation = self.face_aligner(masked_image, landmarks)
             extracted_face, bounding_box_fine, offsets_fine, size_fine = \
                 self.face_cropper_fine(aligned_image, landmarks)
-            # Convert np.array into PIL image
+            # Convert np.array into PIL image | the networks get RGB faces
+            if bgr:
+                extracted_face = cv2.cvtColor(extracted_face, cv2.COLOR_BGR2RGB)
             extracted_face = Image.fromarray(extracted_face)
-            original_image = Image.fromarray(original_image)
-            cropped_image = Image.fromarray(cropped_image)
             # Save landmarks in list
             landmarks = list_landmarks(landmarks)
 
@@ -123,6 +141,66 @@ class FaceExtractor(object):
 
         return extracted_face, extraction_information
 
+    def extract_faces(self, image, bgr=False):
+        """
+        Extracts the faces of an image | all faces with multi_face, otherwise at most the first face
+        :param image: PIL image or np.array
+        :param bgr: the image is a BGR frame of OpenCV (look into extract)
+        :return: List with (track_id, extracted_face, extraction_information) of each face (look into __call__)
+        """
+        image = np.asarray(image)
+        return [(track_id, *self.extract(image, landmarks, bgr=bgr)) for track_id, landmarks, _ in
+                self.track(self.detect(image, bgr=bgr))]
+
+    def detect(self, image, bgr=False):
+        """
+        Detection without the filter of the video mode, it can run in parallel for several frames
+        :param image: np.array (RGB)
+        :param bgr: the image is a BGR frame of OpenCV, the detection gets an RGB copy
+        :return: List with the face_landmarks of the detected faces (at most one without multi_face)
+        """
+        if bgr:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if self.multi_face:
+            return self.landmarks_extractor.detect_all(image)
+        landmarks = self.landmarks_extractor.detect(image)
+        return [] if landmarks is None else [landmarks]
+
+    def track(self, faces_landmarks):
+        """
+        Assigns an identifier to each face, in video mode the frames have to be tracked in order
+        With multi_face the faces are followed by the FaceTracker, otherwise the face is filtered by the
+        LandmarksExtractor and has the identifier 0
+        :param faces_landmarks: output of detect
+        :return: List with (track_id, face_landmarks, index) of each face, index is the position of the face in
+                 faces_landmarks or None if the face was not detected in this frame (video mode)
+        """
+        if self.face_tracker is not None:
+            return self.face_tracker(faces_landmarks)
+        if self.multi_face:
+            return [(index, landmarks, index) for index, landmarks in enumerate(faces_landmarks)]
+        landmarks = self.landmarks_extractor.filter(faces_landmarks[0] if faces_landmarks else None)
+        if landmarks is None:
+            return []
+        return [(0, landmarks, 0 if faces_landmarks else None)]
+
+    def pop_dropped_tracks(self):
+        """
+        :return: List with the identifiers of the tracks the FaceTracker deleted since the last call (video mode with
+                 multi_face only), the state of the caller for these tracks can be deleted
+        """
+        if self.face_tracker is None:
+            return []
+        return self.face_tracker.pop_dropped()
+
+    def reset(self):
+        """
+        Forgets the state of the video mode, i.e. before a new video
+        """
+        self.landmarks_extractor.old_state = None
+        if self.face_tracker is not None:
+            self.face_tracker.reset()
+
 
 def list_landmarks(landmarks_dict):
     """
@@ -351,7 +429,7 @@ def draw_landmarks(image, landmarks_dict):
 
 class LandmarksExtractor(object):
     """
-    Extract facial landmarks of the first detected face in the image with the
+    Extract facial landmarks of the first detected face (or of all faces with detect_all) in the image with the
     external face_recognition module
     There is an additional filter to interpolate the position of the face
     within a video and make the motion smoother
@@ -371,15 +449,42 @@ class LandmarksExtractor(object):
         :param image: np.array / cv2 image
         :return: face_landmarks or None if no face detected
         """
+        return self.filter(self.detect(image))
+
+    @staticmethod
+    def detect(image):
+        """
+        Detection without the filter of the video mode, it can run in parallel for several frames
+        :param image: np.array / cv2 image
+        :return: face_landmarks or None if no face detected
+        """
         landmarks = face_recognition.face_landmarks(image)
 
         # Check, if extraction was successful
         if landmarks:
-            landmarks = landmarks[0]
-        else:
-            landmarks = None
+            return landmarks[0]
+        return None
 
+    @staticmethod
+    def detect_all(image):
+        """
+        Same as detect, but for all faces in the image
+        :param image: np.array / cv2 image
+        :return: List with the face_landmarks of each detected face
+        """
+        return face_recognition.face_landmarks(image)
+
+    def filter(self, landmarks):
+        """
+        In video mode the landmarks of the last frame are used if no face was detected, thus the frames have to be
+        filtered in order
+        :param landmarks: output of detect
+        :return: face_landmarks or None if no face detected
+        """
         if self.video_mode:
+            if landmarks is None and self.old_state is None:
+                # no face detected so far
+                return None
             if landmarks is None:
                 # Update state in video mode
                 landmarks = self.old_state.copy()
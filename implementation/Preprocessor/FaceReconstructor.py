@@ -13,19 +13,31 @@ class FaceReconstructor(object):
     4. Invert coarse cropping of the ROI
     """
 
-    def __init__(self, mask_factor=-10, postprocessing='blur'):
+    def __init__(self, mask_factor=-10, postprocessing='blur', fast_postprocessing=False):
         """
         :param mask_factor: Increase or decrease region to insert
         :param postprocessing: Enable sharpening or blurring
                     * None: No postprocessing
                     * 'blur': blur image
                     * 'sharp': sharpen image
+        :param fast_postprocessing: reconstruct approximates the postprocessing on the luma of the blended part of the
+                    face only (look into LumaFilter), faster but not the same result as the CIELab filters (compare
+                    them with benchmark.py)
         """
         self.postprocessing = postprocessing
+        self.postprocessing_filter = None
         if self.postprocessing == 'sharp':
             self.face_sharpener = FaceSharpener()
+            self.postprocessing_filter = self.face_sharpener
         if self.postprocessing == 'blur':
             self.face_blurer = FaceBlurer()
+            self.postprocessing_filter = self.face_blurer
+        # the luma approximation of the filter used by reconstruct
+        self.luma_filter = None
+        if fast_postprocessing and self.postprocessing == 'sharp':
+            self.luma_filter = LumaFilter(self.face_sharpener.sharp_factor, amount=1)
+        if fast_postprocessing and self.postprocessing == 'blur':
+            self.luma_filter = LumaFilter(self.face_blurer.blur_factor, amount=-1)
         self.face_decropper_fine = FaceDecropperFine()
         self.face_dealigner = FaceDealigner()
         self.face_demasker = FaceDemasker(mask_factor)
@@ -35,8 +47,8 @@ class FaceReconstructor(object):
         """
         :param processed_image: PIL image
         :param extraction_information: namedtuple with the following elements
-                    * image_original: The original scene (PIL image)
-                    * image_cropped: The cropped region from the original image (PIL image)
+                    * image_original: The original scene (np.array)
+                    * image_cropped: The cropped region from the original image (np.array)
                     * bounding_box_coarse: Namedtuple with the coordinates of the cropped ROI
                                            in the original image
                     * offsets_coarse: index shift to pad image and prevent indices out of image
@@ -78,6 +90,65 @@ class FaceReconstructor(object):
         reconstructed_image = Image.fromarray(decropped_image)
         return reconstructed_image
 
+    def reconstruct(self, processed_image, extraction_information, output, bgr=False):
+        """
+        Same as calling the reconstructor, but the face is blended into output in place: only the region of the
+        eroded mask is written, in fixed point arithmetic, the scene is not copied
+        With fast_postprocessing the postprocessing is approximated on the luma of the face (look into LumaFilter) and
+        only applied to the part of the face which is blended into output
+        :param processed_image: np.array (RGB, uint8) with the size of the extracted face
+        :param extraction_information: namedtuple (look into __call__)
+        :param output: np.array (RGB, uint8) with the scene the face was extracted from, i.e. with other faces merged
+        :param bgr: image and output are BGR (OpenCV)
+        :return: output
+        """
+        alpha, region = self.face_demasker.get_alpha(extraction_information.mask, extraction_information.offsets_coarse)
+        if region is None:
+            return output
+        if self.luma_filter is not None:
+            # Filter before the decropping like __call__, the filter needs the surrounding pixels of the face
+            top, bottom, left, right = face_region(region, extraction_information, processed_image.shape[:2])
+            if top < bottom and left < right:
+                processed_image = processed_image.copy()
+                processed_image[top:bottom, left:right] = \
+                    self.luma_filter.filter_region(processed_image, top, bottom, left, right, bgr=bgr)
+        elif self.postprocessing_filter is not None:
+            processed_image = self.postprocessing_filter(processed_image, bgr=bgr)
+        decropped_image = self.face_decropper_fine(processed_image,
+                                                   extraction_information.bounding_box_fine,
+                                                   extraction_information.offsets_fine,
+                                                   extraction_information.size_coarse)
+        dealigned_image = self.face_dealigner(decropped_image,
+                                              extraction_information.rotation)
+        return self.face_demasker.blend(dealigned_image, alpha, region, output,
+                                        extraction_information.bounding_box_coarse,
+                                        extraction_information.offsets_coarse)
+
+
+def face_region(region, extraction_information, shape, margin=2):
+    """
+    Maps a region of the coarse cropped image to the region of the extracted face it is reconstructed from, i.e.
+    inverts the dealignment and the fine decropping (look into FaceReconstructor.reconstruct)
+    :param region: (top, bottom, left, right) in the coarse cropped image
+    :param extraction_information: namedtuple (look into FaceReconstructor.__call__)
+    :param shape: (height, width) of the extracted face
+    :param margin: pixels added on each side for the interpolation of the dealignment
+    :return: (top, bottom, left, right) in the extracted face, clipped to its shape
+    """
+    top, bottom, left, right = region
+    rotation = extraction_information.rotation
+    bounding_box = extraction_information.bounding_box_fine
+    offsets = extraction_information.offsets_fine
+    # The dealigned image at p is the aligned image at R * p
+    R = cv2.getRotationMatrix2D(rotation.center, rotation.angle, 1.0)
+    corners = np.array([[left, top, 1], [right, top, 1], [left, bottom, 1], [right, bottom, 1]], dtype=np.float64)
+    aligned = corners @ R.T
+    x = aligned[:, 0] - bounding_box.left + offsets.left
+    y = aligned[:, 1] - bounding_box.top + offsets.top
+    H, W = shape
+    return (max(int(np.floor(y.min())) - margin, 0), min(int(np.ceil(y.max())) + margin, H),
+            max(int(np.floor(x.min())) - margin, 0), min(int(np.ceil(x.max())) + margin, W))
+
 
 class FaceSharpener(object):
     """
@@ -92,8 +163,8 @@ class FaceSharpener(object):
         """
         self.sharp_factor = sharp_factor
 
-    def __call__(self, image):
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
+    def __call__(self, image, bgr=False):
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2Lab if bgr else cv2.COLOR_RGB2Lab)
         # Extract L channel
         L = image[:, :, 0]
         # Inverse filtering
@@ -101,7 +172,7 @@ class FaceSharpener(object):
         L_sharp = cv2.addWeighted(L_blur, -1, L, 2, 0)
         # Substitute L channel with sharpened L channel
         image[:, :, 0] = L_sharp
-        image = cv2.cvtColor(image, cv2.COLOR_Lab2RGB)
+        image = cv2.cvtColor(image, cv2.COLOR_Lab2BGR if bgr else cv2.COLOR_Lab2RGB)
 
         return image
 
@@ -119,19 +190,61 @@ class FaceBlurer(object):
         """
         self.blur_factor = blur_factor
 
-    def __call__(self, image):
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
+    def __call__(self, image, bgr=False):
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2Lab if bgr else cv2.COLOR_RGB2Lab)
         # Extract L channel
         L = image[:, :, 0]
         # Gaussian blurring
         L_blur = cv2.GaussianBlur(L, (0, 0), self.blur_factor)
         # Substitute L channel with blurred L channel
         image[:, :, 0] = L_blur
-        image = cv2.cvtColor(image, cv2.COLOR_Lab2RGB)
+        image = cv2.cvtColor(image, cv2.COLOR_Lab2BGR if bgr else cv2.COLOR_Lab2RGB)
 
         return image
 
 
+class LumaFilter(object):
+    """
+    Approximation of FaceBlurer and FaceSharpener without float color space conversions
+    The integer luma (Y of YCrCb) is filtered with a separable gaussian kernel and the
+    difference is added to all color channels, thus the chroma does not change
+    """
+
+    def __init__(self, sigma, amount=-1):
+        """
+        :param sigma: Standard deviation of the gaussian
+        :param amount: Weight of the details (luma - blurred luma)
+                    * -1: blur image
+                    * 1: sharpen image (like FaceSharpener)
+        """
+        self.amount = amount
+        self.radius = int(np.ceil(3 * sigma))
+        # Separable kernel, computed once
+        self.kernel = cv2.getGaussianKernel(2 * self.radius + 1, sigma, cv2.CV_32F)
+
+    def __call__(self, image, bgr=False):
+        H, W = image.shape[:2]
+        return self.filter_region(image, 0, H, 0, W, bgr=bgr)
+
+    def filter_region(self, image, top, bottom, left, right, bgr=False):
+        """
+        Filters a region of the image, the surrounding pixels are used by the kernel
+        :param image: RGB or BGR image (uint8)
+        :param top, bottom, left, right: Coordinates of the region
+        :param bgr: Order of the color channels
+        :return: The filtered region (new np.array)
+        """
+        H, W = image.shape[:2]
+        outer_top, outer_left = max(top - self.radius, 0), max(left - self.radius, 0)
+        outer = image[outer_top:min(bottom + self.radius, H), outer_left:min(right + self.radius, W)]
+        luma = cv2.cvtColor(outer, cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+        luma_blur = cv2.sepFilter2D(luma, cv2.CV_16S, self.kernel, self.kernel)
+        details = luma.astype(np.int16) - luma_blur
+        details = details[top - outer_top:bottom - outer_top, left - outer_left:right - outer_left]
+        filtered = image[top:bottom, left:right].astype(np.int16) + self.amount * details[:, :, None]
+        return np.clip(filtered, 0, 255).astype(np.uint8)
+
+
 class FaceDecropperFine(object):
     """
     Invert the fine cropping of the aligned and masked image
@@ -185,6 +298,8 @@ class FaceDemasker(object):
                  * morphing < 0: erosion -> decrease mask (recommended)
         """
         self.morphing = morphing
+        # structuring elements of the morphological operation for each kernel size
+        self.kernels = {}
 
     def __call__(self, masked_image, cropped_image, mask):
         """
@@ -208,6 +323,52 @@ class FaceDemasker(object):
         demasked_image = demasked_image.astype(np.uint8)
         return demasked_image
 
+    def get_alpha(self, mask, offsets):
+        """
+        The morphed mask as blending weights for blend
+        The mask is quantized to 0..256 before the morphological operation (the result is the same as quantizing the
+        morphed mask)
+        :param mask: The mask applied to the image
+        :param offsets: named tuple with the offsets (padding + image out of range) of the coarse crop
+        :return: (alpha, region), alpha (uint16) cropped to region = (top, bottom, left, right), the bounding box of
+                 the mask in the part of the crop that lies in the scene, (None, None) if the region is empty
+        """
+        H = mask.shape[0]
+        k_size = int(abs(self.morphing) / 100 * H)
+        k_size = k_size if (k_size % 2 == 1) else k_size + 1
+        if k_size not in self.kernels:
+            self.kernels[k_size] = cv2.getStructuringElement(cv2.MORPH_CROSS, (k_size, k_size))
+        operation = cv2.MORPH_ERODE if self.morphing < 0 else cv2.MORPH_DILATE
+        alpha = np.rint(mask * 256).astype(np.uint16)
+        alpha = cv2.morphologyEx(alpha, op=operation, kernel=self.kernels[k_size])
+
+        left, top, width, height = cv2.boundingRect((alpha > 0).astype(np.uint8))
+        top, bottom = max(top, offsets.top), min(top + height, offsets.bottom)
+        left, right = max(left, offsets.left), min(left + width, offsets.right)
+        if top >= bottom or left >= right:
+            return None, None
+        return alpha[top:bottom, left:right, None], (top, bottom, left, right)
+
+    def blend(self, masked_image, alpha, region, output, bounding_box, offsets):
+        """
+        Same as the demasking and the coarse decropping (look into FaceDecropperCoarse), but the image is blended into
+        the region of the mask in output in place with 8 bit fixed point weights in uint16
+        :param masked_image: The masked constructed image (coarse cropped)
+        :param alpha: The blending weights of the region (look into get_alpha)
+        :param region: (top, bottom, left, right) of the region in the coarse cropped image
+        :param output: The scene the image was cropped from
+        :param bounding_box: Indicator where the cropped region was in the scene
+        :param offsets: named tuple with the offsets (padding + image out of range) of the
+                        crop for every bounding box side
+        :return: output
+        """
+        top, bottom, left, right = region
+        scene = output[bounding_box.top + top - offsets.top:bounding_box.top + bottom - offsets.top,
+                       bounding_box.left + left - offsets.left:bounding_box.left + right - offsets.left]
+        blended = alpha * masked_image[top:bottom, left:right] + (256 - alpha) * scene + 128
+        scene[...] = blended >> 8
+        return output
+
 
 class FaceDecropperCoarse(object):
     """
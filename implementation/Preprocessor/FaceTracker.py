@@ -0,0 +1,116 @@
+import numpy as np
+
+
+class FaceTracker(object):
+    """
+    Follows several faces through the frames of a video and assigns a stable identifier to each face
+    The faces of consecutive frames are matched greedily by the intersection over union of the bounding boxes
+    of their landmarks. A face that is not detected in a frame keeps its last landmarks for a few frames
+    (like the filter of the LandmarksExtractor in video mode).
+    """
+
+    def __init__(self, min_iou=0.3, max_missing=10):
+        """
+        :param min_iou: Minimal intersection over union of the bounding boxes to match a face with a track
+        :param max_missing: Number of consecutive frames a track is kept without detection
+        """
+        self.min_iou = min_iou
+        self.max_missing = max_missing
+        self.tracks = {}
+        self.next_id = 0
+        # identifiers of the tracks deleted since the last call of pop_dropped
+        self.dropped = []
+
+    def __call__(self, faces_landmarks):
+        """
+        Matches the detected faces with the tracks of the last frame, the frames have to be tracked in order
+        :param faces_landmarks: List with the face_landmarks of each detected face
+        :return: List with (track_id, face_landmarks, index) of each tracked face, index is the position of the face
+                 in faces_landmarks or None if the track was not detected and keeps its last landmarks
+        """
+        boxes = [bounding_box(landmarks) for landmarks in faces_landmarks]
+        pairs = [(iou(track.box, box), track_id, index) for track_id, track in self.tracks.items()
+                 for index, box in enumerate(boxes)]
+        matched_tracks = {}
+        matched_faces = set()
+        for overlap, track_id, index in sorted(pairs, key=lambda pair: -pair[0]):
+            if overlap < self.min_iou:
+                break
+            if track_id not in matched_tracks and index not in matched_faces:
+                matched_tracks[track_id] = index
+                matched_faces.add(index)
+
+        # New faces get new tracks
+        for index in range(len(faces_landmarks)):
+            if index not in matched_faces:
+                matched_tracks[self.next_id] = index
+                self.tracks[self.next_id] = Track()
+                self.next_id += 1
+
+        tracked = []
+        for track_id in sorted(self.tracks):
+            track = self.tracks[track_id]
+            if track_id in matched_tracks:
+                index = matched_tracks[track_id]
+                # The extraction changes the landmarks in place
+                track.landmarks = faces_landmarks[index].copy()
+                track.box = boxes[index]
+                track.missing = 0
+                tracked.append((track_id, faces_landmarks[index], index))
+            elif track.missing < self.max_missing:
+                track.missing += 1
+                tracked.append((track_id, track.landmarks.copy(), None))
+            else:
+                del self.tracks[track_id]
+                self.dropped.append(track_id)
+        return tracked
+
+    def pop_dropped(self):
+        """
+        :return: List with the identifiers of the tracks deleted since the last call, their identifiers are not reused
+        """
+        dropped, self.dropped = self.dropped, []
+        return dropped
+
+    def reset(self):
+        """
+        Forgets all tracks, i.e. before a new video
+        """
+        self.tracks = {}
+        self.next_id = 0
+        self.dropped = []
+
+
+class Track(object):
+    """
+    State of one tracked face
+    """
+
+    def __init__(self):
+        self.landmarks = None
+        self.box = None
+        # Number of consecutive frames without detection
+        self.missing = 0
+
+
+def bounding_box(landmarks_dict):
+    """
+    :param landmarks_dict: Dict of facial landmarks
+    :return: np.array (left, top, right, bottom) enclosing all landmarks
+    """
+    landmarks = np.array([coordinate for feature in landmarks_dict.values() for coordinate in feature])
+    return np.concatenate([landmarks.min(0), landmarks.max(0)]).astype(np.float64)
+
+
+def iou(box_a, box_b):
+    """
+    :return: Intersection over union of two bounding boxes (look into bounding_box)
+    """
+    width = min(box_a[2], box_b[2]) - max(box_a[0], box_b[0])
+    height = min(box_a[3], box_b[3]) - max(box_a[1], box_b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    return intersection / (area_a + area_b - intersection)
@@ -1,10 +1,18 @@
+import random
+import time
 from pathlib import Path
 
-from PIL.Image import BICUBIC
-from torchvision.transforms import ToPILImage
+import cv2
+import numpy as np
+import torch
+from PIL import Image
 
 from Preprocessor.FaceExtractor import FaceExtractor
 from Preprocessor.FaceReconstructor import FaceReconstructor
+from Utils.Bundle import BUNDLE_SUFFIX, load_bundle
+from Utils.DeadlineController import DeadlineController
+from Utils.Export import ExportedModel
+from Utils.TemporalCache import TemporalCache
 
 
 class Anonymizer:
@@ -13,35 +21,221 @@ class Anonymizer:
     incoming image
     """
 
-    def __init__(self, model_folder: str, config, video_mode=False, postprocessing=None) -> None:
+    def __init__(self, model_folder: str, config, video_mode=False, postprocessing=None, target=None,
+                 reuse_threshold=0, max_reuse_age=10, multi_face=False, deadline=None, min_resolution=32,
+                 fast_postprocessing=False) -> None:
         """
-        :param model_folder: Path to models folder.
+        :param model_folder: Path to models folder, to a model exported by export.py (config is not needed then) or to a
+        bundle (look into Utils/Bundle.py, the config is stored in the bundle)
+        :param target: name of the identity the faces are swapped to (DeepFake models trained on several identities
+        only), by default the target of the model params is used
+        :param reuse_threshold: video mode only, the anonymized face of the last frame is reused while the normalized
+        landmarks moved less than this threshold (look into Utils/TemporalCache.py), 0: anonymize every frame
+        :param max_reuse_age: maximal number of frames an anonymized face is reused
+        :param multi_face: anonymize all faces of an image instead of the first face, in video mode the faces are
+        tracked (look into Preprocessor/FaceTracker.py)
+        :param deadline: video mode only, seconds available for one frame of a live stream (__call__ and
+        anonymize_batch), the output level of progressive models is lowered and frames are dropped to keep up with it
+        (look into Utils/DeadlineController.py), None: always the highest level and no dropped frames
+        :param min_resolution: minimal resolution of the generated faces with a deadline, the faces are upsampled
+        :param fast_postprocessing: approximate the postprocessing when the faces are merged on the frames (look into
+        FaceReconstructor)
         """
         self.config = config
+        self.anonymize_kwargs = {} if target is None else {'target': target}
         self.model_folder = Path(model_folder)
-        self.model = config.model(**config.model_params)
-        self.model.load_model(self.model_folder)
+        if self.model_folder.suffix == BUNDLE_SUFFIX:
+            # weights are memory mapped, the modules are not initialized randomly
+            self.model = load_bundle(self.model_folder, **self.anonymize_kwargs)
+        elif self.model_folder.is_file():
+            # the exported model contains only the inference network, the training model is not constructed
+            self.model = ExportedModel(self.model_folder)
+        else:
+            # only the modules needed for the anonymization are constructed and loaded
+            model_params = dict(config.model_params, precision=config.precision, mode='inference')
+            if target is not None:
+                model_params['target'] = target
+            self.model = config.model(**model_params)
+            self.model.load_model(self.model_folder)
+            self.model.set_train_mode(False)
 
         # use extractor and transform later get correct input for network
-        self.extractor = FaceExtractor(sharp_edge=False, margin=0.05, mask_factor=10, video_mode=video_mode)
-        self.reconstructor = FaceReconstructor(mask_factor=-12, postprocessing=postprocessing)
+        self.extractor = FaceExtractor(sharp_edge=False, margin=0.05, mask_factor=10, video_mode=video_mode,
+                                       multi_face=multi_face)
+        self.reconstructor = FaceReconstructor(mask_factor=-12, postprocessing=postprocessing,
+                                               fast_postprocessing=fast_postprocessing)
+        # the cache reuses the faces of dropped frames as well
+        self.cache = TemporalCache(reuse_threshold, max_reuse_age) \
+            if video_mode and (reuse_threshold > 0 or deadline is not None) else None
+        self.controller = DeadlineController(self.model.get_output_levels(min_resolution), deadline) \
+            if video_mode and deadline is not None else None
+        # in video mode each track keeps its noise, thus the identity of a face does not change over time
+        self.video_mode = video_mode
+        self.noise_size = self.model.get_noise_size(**self.anonymize_kwargs)
+        self.track_noise = {}
+        self.video_seed = random.randrange(2 ** 63)
 
     def __call__(self, image):
         """
-        Merges an anonymized face on the scene
+        Merges the anonymized face (all faces with multi_face) on the scene
         :param image: PIL image
+        :return: PIL image, None if no face was found
+        """
+        return self.anonymize_batch([image])[0]
+
+    def anonymize_batch(self, images):
+        """
+        Same as calling the anonymizer on each image, but the faces of all images are anonymized in one forward pass
+        (look into CombinedModel.anonymize_batch)
+        :param images: list of PIL images | in video mode the frames have to be in order
+        :return: list with a PIL image for each image, None if no face was found
+        """
+        frames = [np.array(image) for image in images]
+        found = self.anonymize_frames(frames, bgr=False)
+        return [Image.fromarray(frame) if face_found else None for frame, face_found in zip(frames, found)]
+
+    def anonymize_frames(self, frames, bgr=True):
+        """
+        Same as anonymize_batch, but the anonymized faces are merged on the frames in place, i.e. on the frames of
+        OpenCV without conversion to PIL images
+        :param frames: list of np.arrays (uint8) | in video mode the frames have to be in order
+        :param bgr: the frames are BGR (OpenCV), otherwise RGB
+        :return: list with a flag for each frame, False if no face was found (the frame is unchanged)
+        """
+        start_time = time.time()
+        drop = self.controller is not None and self.controller.drop
+        # Extract faces | (track_id, extracted_face, extracted_information) of each face of each frame
+        extracted = [self.extractor.extract_faces(frame, bgr=bgr) for frame in frames]
+        faces = [face for frame_faces in extracted for face in frame_faces]
+        if faces:
+            track_ids, extracted_faces, extracted_informations = zip(*faces)
+            faces_out = iter(self.anonymize_faces(extracted_faces, extracted_informations, track_ids, drop=drop))
+            for frame, frame_faces in zip(frames, extracted):
+                if frame_faces:
+                    self.merge_faces_into([next(faces_out) for _ in frame_faces], [face[1] for face in frame_faces],
+                                          [face[2] for face in frame_faces], frame, bgr=bgr)
+
+        if self.controller is not None:
+            latency = (time.time() - start_time) / len(frames)
+            for _ in frames:
+                self.controller.update(latency, dropped=drop)
+        return [len(frame_faces) > 0 for frame_faces in extracted]
+
+    def anonymize_faces(self, extracted_faces, extracted_informations, track_ids=None, drop=False):
+        """
+        Anonymizes extracted faces in one forward pass, with the temporal cache only the faces that moved are anonymized
+        :param extracted_faces: list of faces extracted by the extractor
+        :param extracted_informations: list with the extraction information of each face
+        :param track_ids: list with the track of each face (video mode only, the faces have to be in frame order for
+        the cache), default: all faces belong to one track
+        :param drop: reuse the last face of each track (look into DeadlineController.drop), only faces of new tracks and
+        faces that were reused max_reuse_age times are anonymized
+        :return: batch with the anonymized faces on the cpu | a list with the temporal cache, the reused faces may have
+        been generated at another level (look into DeadlineController)
+        """
+        if track_ids is None:
+            track_ids = [0] * len(extracted_faces)
+        self.forget_dropped_tracks()
+        if self.cache is None:
+            return self.generate(extracted_faces, extracted_informations, track_ids)
+
+        # a face generated in this batch can already be reused by the following frames of the batch
+        entries = []
+        generate = []
+        for i, (extracted_information, track_id) in enumerate(zip(extracted_informations, track_ids)):
+            entry, new = self.cache.lookup(track_id, extracted_information, reuse=drop)
+            entries.append(entry)
+            if new:
+                generate.append(i)
+        if generate:
+            faces_out = self.generate([extracted_faces[i] for i in generate],
+                                      [extracted_informations[i] for i in generate],
+                                      [track_ids[i] for i in generate])
+            for i, face_out in zip(generate, faces_out):
+                entries[i].face = face_out
+        return [entry.face for entry in entries]
+
+    def forget_dropped_tracks(self):
+        """
+        Deletes the noise and the cached face of the tracks the tracker gave up, thus the state of a long stream does
+        not grow with the number of faces that appeared (look into FaceExtractor.pop_dropped_tracks)
+        """
+        for track_id in self.extractor.pop_dropped_tracks():
+            self.track_noise.pop(track_id, None)
+            if self.cache is not None:
+                self.cache.discard(track_id)
+
+    def generate(self, extracted_faces, extracted_informations, track_ids):
+        """
+        Forward pass without the cache (look into anonymize_faces)
+        """
+        noise = None
+        if self.video_mode and self.noise_size:
+            for track_id in track_ids:
+                if track_id not in self.track_noise:
+                    # derived from the seed of the video, the segments of a video get the same noise for a track
+                    generator = torch.Generator().manual_seed(hash((self.video_seed, track_id)) % 2 ** 63)
+                    self.track_noise[track_id] = torch.randn(self.noise_size, generator=generator)
+            noise = torch.stack([self.track_noise[track_id] for track_id in track_ids])
+        kwargs = self.anonymize_kwargs
+        if self.controller is not None and self.controller.level is not None:
+            kwargs = dict(kwargs, level_out=self.controller.level)
+        faces_out = self.model.anonymize_batch(extracted_faces, extracted_informations, noise=noise, **kwargs)
+        # get it back to the cpu and get the data
+        return faces_out.cpu().detach()
+
+    def merge(self, face_out, extracted_face, extracted_information):
+        """
+        Merges an anonymized face on the scene it was extracted from
+        :param face_out: anonymized face (one entry of the output of anonymize_faces)
+        :param extracted_face: the extracted face
+        :param extracted_information: the extraction information of the face
+        :return: PIL image
+        """
+        return self.merge_faces([face_out], [extracted_face], [extracted_information])
+
+    def merge_faces(self, faces_out, extracted_faces, extracted_informations):
+        """
+        Merges several anonymized faces of the same scene one after another into one copy of the scene, overlapping
+        faces are covered by the later faces (look into FaceReconstructor.reconstruct)
+        :param faces_out: anonymized faces (entries of the output of anonymize_faces)
+        :param extracted_faces: the extracted faces
+        :param extracted_informations: the extraction information of each face
         :return: PIL image
         """
-        constructed_image = None
-        # Extract face
-        extracted_face, extracted_information = self.extractor(image)
-        if extracted_face is not None:
-            face_out = self.model.anonymize(extracted_face, extracted_information).squeeze(0)
-            # get it back to the cpu and get the data
-            face_out = ToPILImage()(face_out.cpu().detach())
+        scene = np.array(extracted_informations[0].image_original)
+        self.merge_faces_into(faces_out, extracted_faces, extracted_informations, scene)
+        return Image.fromarray(scene)
+
+    def merge_faces_into(self, faces_out, extracted_faces, extracted_informations, frame, bgr=False):
+        """
+        Same as merge_faces, but the faces are merged on the frame in place. Each face is converted once from the
+        tensor to the array that is blended into the frame.
+        :param frame: np.array (uint8) the faces were extracted from
+        :param bgr: the frame is BGR (OpenCV), otherwise RGB
+        :return: frame
+        """
+        for face_out, extracted_face, extracted_information in zip(faces_out, extracted_faces, extracted_informations):
+            if face_out.is_floating_point():
+                # same conversion as ToPILImage
+                face_out = face_out.mul(255).byte()
+            if bgr:
+                face_out = face_out.flip(0)
+            face_out = face_out.permute(1, 2, 0).contiguous().numpy()
             # scale to original resolution
-            face_out = face_out.resize(extracted_face.size, resample=BICUBIC)
+            face_out = cv2.resize(face_out, extracted_face.size, interpolation=cv2.INTER_CUBIC)
             # Constructed scene with new face
-            constructed_image = self.reconstructor(face_out, extracted_information)
+            self.reconstructor.reconstruct(face_out, extracted_information, frame, bgr=bgr)
+        return frame
 
-        return constructed_image
+    def reset(self, video_seed=None):
+        """
+        Forgets the state of the video mode (filter, tracks, cache and noise), i.e. before a new video
+        :param video_seed: seed the noise of each track is derived from, by default a random seed | with the same seed
+        the same track gets the same identity, i.e. in the segments of a video (look into convert_video_segments)
+        """
+        self.extractor.reset()
+        if self.cache is not None:
+            self.cache.clear()
+        self.track_noise = {}
+        self.video_seed = random.randrange(2 ** 63) if video_seed is None else video_seed
@@ -0,0 +1,155 @@
+import importlib
+import json
+import mmap
+import struct
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from Models.ModelUtils.ModelUtils import MixedPrecision
+
+# layout of a bundle: MAGIC, length of the header (little endian uint64), json header, tensor data | the data of each
+# tensor starts at a multiple of ALIGNMENT w.r.t. the start of the file
+MAGIC = b'FACESWAP'
+ALIGNMENT = 64
+# conventional suffix of a bundle, the Anonymizer loads files with this suffix with load_bundle
+BUNDLE_SUFFIX = '.bundle'
+
+
+def save_bundle(model, path, config, **model_params):
+    """
+    Packs the weights of all CustomModules of a CombinedModel into a single file together with the description of the
+    model. The file is loaded by load_bundle without constructing the model with random weights first.
+    The weights of the folded modules (look into CombinedModel.get_folded_modules) are packed as well, thus they are
+    shared between the processes like the weights of the CustomModules instead of being derived by each process.
+    Tensors that are shared between modules are stored once.
+    :param model: CombinedModel with loaded weights, conventionally constructed with mode='inference' (look into
+    CombinedModel.inference) thus the bundle contains only the modules needed for the anonymization
+    :param path: destination of the bundle, conventionally ends with BUNDLE_SUFFIX
+    :param config: model configuration the model was constructed with (class in Configuration/config_model.py)
+    :param model_params: json serializable parameters that override the model_params of the config (i.e. the target of
+    the DeepFake)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    folded_modules = model.get_folded_modules()
+    module_states = model.get_module_states()
+    module_states.update((name, module.state_dict()) for name, module in folded_modules.items())
+
+    # the offsets in the index are relative to the start of the data, the header has to be known to place the data
+    tensors = []
+    index = {}
+    stored = {}
+    offset = 0
+    for name, module_state in module_states.items():
+        for key, tensor in module_state.items():
+            identity = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+            if tensor.numel() > 0 and identity in stored:
+                index[name + '.' + key] = stored[identity]
+                continue
+            tensor = tensor.detach().cpu().contiguous()
+            offset = _align(offset)
+            nbytes = tensor.numel() * tensor.element_size()
+            index[name + '.' + key] = stored[identity] = {'dtype': str(tensor.dtype).replace('torch.', ''),
+                                                          'shape': list(tensor.shape),
+                                                          'offset': offset, 'nbytes': nbytes}
+            tensors.append((name + '.' + key, tensor))
+            offset += nbytes
+    header = {'config': config.__module__ + '.' + config.__qualname__,
+              'model_params': model_params,
+              'modules': model.get_model_names(),
+              'folded_modules': list(folded_modules),
+              'tensors': index}
+    header = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    print('Saving bundle... %s' % path)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for key, tensor in tensors:
+            f.seek(data_start + index[key]['offset'])
+            # the raw bytes of the tensor, independent of its dtype
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def read_bundle_header(path):
+    """
+    :param path: path of a bundle
+    :return: header of the bundle (look into save_bundle) and the position of the tensor data in the file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a bundle' % path)
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, _align(len(MAGIC) + 8 + header_size)
+
+
+def load_bundle(path, **model_params):
+    """
+    Loads a model saved by save_bundle in inference mode. The model and its folded modules are constructed on the meta
+    device, i.e. without allocating and initializing (or folding) their weights. The weights are memory mapped from the
+    file and assigned to the modules instead. The mapping is private and the file is opened read-only: all processes of
+    a host that load the same bundle share the physical memory of the weights (the page cache) as long as the weights
+    are not changed, changes are not written to the file.
+    On the gpu the weights are copied to the device after the construction.
+    :param path: path of the bundle
+    :param model_params: override the model_params of the config and the bundle
+    :return: CombinedModel in inference mode (look into CombinedModel.inference) in evaluation mode
+    """
+    print('Loading bundle... %s' % path)
+    header, data_start = read_bundle_header(path)
+    module, name = header['config'].rsplit('.', 1)
+    config = getattr(importlib.import_module(module), name)
+    params = dict(config.model_params, precision=config.precision)
+    params.update(header['model_params'])
+    params.update(model_params, mode='inference')
+
+    with torch.device('meta'):
+        model = config.model(**params)
+        # bundles of older versions contain no folded modules, the model derives them if needed
+        folded_modules = model.get_folded_modules() if header.get('folded_modules') else {}
+        if set(folded_modules) != set(header.get('folded_modules', [])):
+            raise ValueError('The bundle contains the folded modules %s, the model folds %s' %
+                             (header['folded_modules'], list(folded_modules)))
+
+    with open(path, 'rb') as f:
+        # a private (copy on write) mapping, writable tensors can be created from it
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    modules = list(zip(model.get_model_names(), model.get_modules())) + list(folded_modules.items())
+    for name, module in modules:
+        if name not in header['modules'] and name not in folded_modules:
+            raise ValueError('The bundle contains no weights for %s, only for %s' % (name, header['modules']))
+        if type(module) is nn.DataParallel:
+            module = module.module
+        state = {}
+        for key in module.state_dict():
+            entry = header['tensors'][name + '.' + key]
+            dtype = getattr(torch, entry['dtype'])
+            if entry['nbytes'] == 0:
+                state[key] = torch.empty(entry['shape'], dtype=dtype)
+            else:
+                state[key] = torch.frombuffer(buffer, dtype=dtype, offset=data_start + entry['offset'],
+                                              count=entry['nbytes'] // dtype.itemsize).reshape(entry['shape'])
+        module.load_state_dict(state, assign=True)
+
+    if torch.cuda.is_available():
+        model.cuda = True
+        for _, module in modules:
+            module.cuda()
+        if model.mixed_precision is not None:
+            model.mixed_precision = MixedPrecision(model.mixed_precision.precision, cuda=True)
+    model.set_train_mode(False)
+    for module in folded_modules.values():
+        module.eval()
+    # after set_train_mode, which drops derived modules
+    model.set_folded_modules(folded_modules)
+    return model
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
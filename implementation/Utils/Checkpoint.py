@@ -0,0 +1,189 @@
+import os
+import queue
+import random
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# a checkpoint is stored as <path>/checkpoint/checkpoint.tar
+CHECKPOINT_FOLDER = 'checkpoint'
+CHECKPOINT_FILE = 'checkpoint.tar'
+# older checkpoints are kept as <path>/checkpoint/checkpoint_<epoch>.tar
+VERSIONED_CHECKPOINT_FILE = 'checkpoint_%04d.tar'
+
+
+def get_rng_state():
+    """
+    Collects the state of all random number generators used during the training
+    The numpy state is converted into a list so that the checkpoint only contains plain python types and tensors
+    :return: dict with the states of python, numpy, torch and cuda
+    """
+    np_state = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    """
+    Restores the states returned by get_rng_state
+    :param state: dict with the states of python, numpy, torch and cuda
+    """
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_checkpoint(path):
+    """
+    Load a checkpoint
+    :param path: checkpoint file or folder that the checkpoint was saved to
+    :return: dict with the complete training state
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / CHECKPOINT_FILE if (path / CHECKPOINT_FILE).exists() else path / CHECKPOINT_FOLDER / CHECKPOINT_FILE
+    print('Loading checkpoint... %s' % path)
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+def snapshot(obj):
+    """
+    Copies all tensors of a (nested) state to the cpu memory, so that the training can go on while the copy is written
+    :param obj: tensor, state_dict or any nested dict/list/tuple containing tensors
+    :return: copy of obj
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((key, snapshot(value)) for key, value in obj.items())
+        if hasattr(obj, '_metadata'):
+            # state_dicts carry the version of the modules
+            copy._metadata = obj._metadata
+        return copy
+    if type(obj) in (list, tuple):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """
+    Saves obj with torch.save to a temporary file that is renamed afterwards, thus the file at path is never half
+    written
+    :param obj: object to save
+    :param path: destination of the file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('.' + path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_link(source, destination):
+    """
+    Hard links (or copies if that is not possible, i.e. on another file system) source to destination and replaces
+    destination atomically
+    :param source: existing file
+    :param destination: path of the link
+    """
+    source, destination = Path(source), Path(destination)
+    if source.resolve() == destination.resolve():
+        return
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name('.' + destination.name + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+class CheckpointWriter:
+    """
+    Writes models and checkpoints in a background thread
+    The state is copied to the cpu memory on the calling thread (look into snapshot), serialization and disk IO happen
+    off the training thread. Each file is written atomically (temporary file + rename) and every other location gets a
+    hard link instead of serializing the state again. At most one write is pending, further writes block until the
+    previous one has been taken by the background thread.
+    """
+
+    def __init__(self, keep_last=3):
+        """
+        :param keep_last: number of versioned files (look into write) that are kept, None keeps all files
+        """
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self.thread.start()
+
+    def write(self, files, links=(), versioned=None):
+        """
+        Schedules a write
+        :param files: dict with paths as keys and the objects to save as values
+        :param links: list of (source, destination) tuples, destination becomes a hard link to source after the files
+        are written
+        :param versioned: optional (folder, glob pattern) of versioned files, only the last keep_last of them (sorted by
+        name) are kept
+        """
+        self._raise_error()
+        files = {Path(path): snapshot(obj) for path, obj in files.items()}
+        self.queue.put((files, list(links), versioned))
+
+    def flush(self):
+        """
+        Blocks until all scheduled writes are finished
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Finishes all scheduled writes and stops the background thread
+        """
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                self._write(*job)
+            except Exception as ex:
+                self.error = ex
+            finally:
+                self.queue.task_done()
+
+    def _write(self, files, links, versioned):
+        for path, obj in files.items():
+            print('Saving... %s' % path)
+            atomic_save(obj, path)
+        for source, destination in links:
+            atomic_link(source, destination)
+        if versioned is not None and self.keep_last is not None:
+            folder, pattern = versioned
+            for old_file in sorted(Path(folder).glob(pattern))[:-self.keep_last]:
+                old_file.unlink()
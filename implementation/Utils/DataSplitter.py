@@ -1,7 +1,75 @@
 import numpy as np
+import torch
 
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
+
+
+class TrainingInterrupted(Exception):
+    """
+    Raised by the training data loader instead of the next batch, after the interruption of the training was requested
+    """
+    pass
+
+
+class ResumableSampler(Sampler):
+    """
+    Samples the indices in random order like the SubsetRandomSampler. The order of the running epoch is kept, so that an
+    epoch interrupted between two batches can be continued after resuming the training.
+    """
+
+    def __init__(self, indices):
+        """
+        :param indices: indices of the data set to sample
+        """
+        self.indices = indices
+        self.order = None
+        self.start = 0
+
+    def resume(self, order, start):
+        """
+        Continues the given order with the next iteration
+        :param order: order of the interrupted epoch
+        :param start: number of samples of the order that were already trained
+        """
+        self.order, self.start = order, start
+
+    def __iter__(self):
+        if self.start == 0:
+            self.order = [self.indices[i] for i in torch.randperm(len(self.indices)).tolist()]
+        start, self.start = self.start, 0
+        return iter(self.order[start:])
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class InterruptibleDataLoader:
+    """
+    Iterates the training data loader and counts the batches of the running epoch. If the interruption was requested
+    (look into Trainer) TrainingInterrupted is raised instead of returning the next batch, i.e. between two iterations
+    of the training when the state of the model is consistent.
+    """
+
+    def __init__(self, data_loader, splitter):
+        """
+        :param data_loader: DataLoader using a ResumableSampler
+        :param splitter: DataSplitter holding the interruption request and the position in the epoch
+        """
+        self.data_loader = data_loader
+        self.splitter = splitter
+
+    def __iter__(self):
+        # a resumed epoch starts with the batches that were already trained
+        self.splitter.epoch_position = self.data_loader.sampler.start // self.data_loader.batch_size
+        for batch in self.data_loader:
+            if self.splitter.interrupt:
+                raise TrainingInterrupted()
+            yield batch
+            self.splitter.epoch_position += 1
+
+    def __len__(self):
+        return len(self.data_loader)
 
 
 class DataSplitter:
@@ -18,6 +86,9 @@ class DataSplitter:
         self.batch_size = batch_size
         self.dataset = dataset
         self.num_workers = num_workers
+        # set to interrupt the training before the next batch, epoch_position counts the trained batches of the epoch
+        self.interrupt = False
+        self.epoch_position = 0
 
         # setup sampler
         N = len(self.dataset)
@@ -25,17 +96,17 @@ class DataSplitter:
         if shuffle:
             np.random.shuffle(idx)
         split = int(np.floor(validation_size * len(self.dataset)))
-        train_idx, validation_idx = idx[split:], idx[:split]
-        self.training_sampler = SubsetRandomSampler(train_idx)
-        self.validation_sampler = SubsetRandomSampler(validation_idx)
+        self.train_idx, self.validation_idx = idx[split:], idx[:split]
+        self.training_sampler = ResumableSampler(self.train_idx)
+        self.validation_sampler = SubsetRandomSampler(self.validation_idx)
 
         self._init_data_loader()
 
     def get_train_data_loader(self):
         """
-        :return: Dataloader object for training data
+        :return: Dataloader object for training data, interrupted on request (look into InterruptibleDataLoader)
         """
-        return self.train_data_loader
+        return InterruptibleDataLoader(self.train_data_loader, self)
 
     def get_validation_data_loader(self):
         """
@@ -65,3 +136,37 @@ class DataSplitter:
 
         # initialize data_loader again
         self._init_data_loader()
+
+    def get_state(self, interrupted=False):
+        """
+        :param interrupted: the running epoch was interrupted, the order and the position in it are stored to continue
+        the epoch
+        :return: dict with the split, the batch size and the resolution of a progressive data set, needed to resume a
+        training
+        """
+        return {'batch_size': self.batch_size,
+                'train_idx': self.train_idx,
+                'validation_idx': self.validation_idx,
+                'resolution': getattr(self.dataset, 'current_resolution', None),
+                'order': self.training_sampler.order if interrupted else None,
+                'position': self.epoch_position if interrupted else 0}
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state
+        :param state: dict with the state of the data splitter
+        """
+        self.batch_size = int(state['batch_size'])
+        self.train_idx, self.validation_idx = state['train_idx'], state['validation_idx']
+        self.training_sampler = ResumableSampler(self.train_idx)
+        self.validation_sampler = SubsetRandomSampler(self.validation_idx)
+
+        # load the resolution of a progressive data set again
+        if state['resolution'] is not None and state['resolution'] != self.dataset.current_resolution:
+            self.dataset.set_resolution(state['resolution'])
+
+        # continue an interrupted epoch with the next batch
+        if state.get('position', 0) > 0:
+            self.training_sampler.resume(state['order'], state['position'] * self.batch_size)
+
+        self._init_data_loader()
@@ -0,0 +1,104 @@
+class DeadlineController:
+    """
+    Chooses the output level of a progressive generator (look into PGGAN.get_output_levels) s.t. the anonymization of a
+    live stream keeps up with a deadline per frame:
+    * the level is lowered as soon as the smoothed latency of the anonymized frames exceeds the deadline, a dropped
+      frame counts as another frame with the latency of the last anonymized frame
+    * the level is raised again after patience anonymized frames with a smoothed latency below headroom * deadline
+    * frames are dropped (the last anonymized faces are reused) while the stream is behind its schedule, i.e. the
+      accumulated latency exceeds the accumulated deadlines | the stream is at most one deadline behind, an older delay
+      is not caught up, and frames are not dropped if the dropped frames alone exceed the deadline
+    """
+
+    def __init__(self, levels, deadline, headroom=0.5, patience=10, smoothing=0.8):
+        """
+        :param levels: output levels ascending (look into CombinedModel.get_output_levels), starts with the highest
+        :param deadline: seconds available for one frame
+        :param headroom: fraction of the deadline the latency has to stay below before the level is raised
+        :param patience: number of anonymized frames with headroom before the level is raised
+        :param smoothing: factor of the exponential moving average of the latency
+        """
+        self.levels = levels
+        self.deadline = deadline
+        self.headroom = headroom
+        self.patience = patience
+        self.smoothing = smoothing
+
+        self.index = len(levels) - 1
+        # smoothed latency of the anonymized frames at the current level, None after a level change
+        self.latency = None
+        # latency of the last anonymized frame at the current level
+        self.last_latency = None
+        # seconds the stream is behind its schedule
+        self.delay = 0.0
+        self.calm_frames = 0
+        self.frames = 0
+        self.dropped_frames = 0
+        self.level_changes = 0
+
+    @property
+    def level(self):
+        """
+        :return: level_out for get_inference_network
+        """
+        return self.levels[self.index]
+
+    @property
+    def drop(self):
+        """
+        :return: True if the next frame should reuse the last anonymized faces
+        """
+        return self.delay > 0
+
+    def update(self, latency, dropped=False):
+        """
+        Records the latency of a frame and adapts the level
+        :param latency: seconds needed for the frame
+        :param dropped: the faces of the frame were reused, its latency does not describe the current level
+        """
+        self.frames += 1
+        self.delay = min(max(0.0, self.delay + latency - self.deadline), self.deadline)
+        if dropped:
+            self.dropped_frames += 1
+            if latency >= self.deadline:
+                # dropping does not help to catch up if the extraction and the merging alone exceed the deadline
+                self.delay = 0.0
+            if self.last_latency is None:
+                return
+            # the frame was dropped because of the latency of the anonymized frames at the current level
+            latency = self.last_latency
+        else:
+            self.last_latency = latency
+
+        self.latency = latency if self.latency is None else \
+            self.smoothing * self.latency + (1 - self.smoothing) * latency
+        if self.latency > self.deadline:
+            self.calm_frames = 0
+            if self.index > 0:
+                self.set_index(self.index - 1)
+        elif dropped:
+            self.calm_frames = 0
+        elif self.latency < self.headroom * self.deadline:
+            self.calm_frames += 1
+            if self.calm_frames >= self.patience and self.index < len(self.levels) - 1:
+                self.set_index(self.index + 1)
+        else:
+            self.calm_frames = 0
+
+    def set_index(self, index):
+        self.index = index
+        self.latency = None
+        self.last_latency = None
+        self.calm_frames = 0
+        self.level_changes += 1
+
+    def summary(self):
+        """
+        :return: dict with the current level, the smoothed latency and the frame counters
+        """
+        return {'level': self.level,
+                'latency': self.latency,
+                'delay': self.delay,
+                'frames': self.frames,
+                'dropped_frames': self.dropped_frames,
+                'level_changes': self.level_changes}
@@ -0,0 +1,210 @@
+import copy
+import importlib
+import json
+import math
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from Models.ModelUtils.ModelUtils import ConvBlockBlock, UpscaleBlockBlock
+
+# the exported file contains the description of the model as extra file
+META_FILE = 'meta.json'
+# containers of convolutions that are quantized statically (look into quantize_network), torch.fx can trace them
+STATIC_QUANTIZATION_MODULES = (ConvBlockBlock, UpscaleBlockBlock)
+
+
+def export_model(model, path, quantize=False, validation_input=None, static=True, **kwargs):
+    """
+    Traces the inference network of a CombinedModel (look into CombinedModel.get_inference_network) for fixed
+    parameters (i.e. the output level of the PGGAN) and saves it as frozen TorchScript module. The module runs on the
+    device the model is on, quantized modules run on the cpu.
+    :param model: CombinedModel with loaded weights
+    :param path: destination of the exported file, conventionally ends with "*.pt"
+    :param quantize: export an int8 quantized network (look into quantize_network)
+    :param validation_input: batch of inputs of the inference network (look into CombinedModel.get_validation_input),
+    needed for quantize: calibrates the quantization and is used to report the accuracy drop
+    :param static: quantize the convolutions statically as well, otherwise only the linear layers are quantized
+    :param kwargs: passed to get_inference_network
+    :return: accuracy report of the quantized network (look into quantization_report), None without quantize
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    model.set_train_mode(False)
+    network = model.get_inference_network(**kwargs).eval()
+
+    device = 'cuda' if model.cuda else 'cpu'
+    report = None
+    if quantize:
+        if validation_input is None:
+            raise ValueError('The quantization needs a batch of validation inputs')
+        # the quantized operators are only available on the cpu
+        device = 'cpu'
+        network = copy.deepcopy(network).cpu()
+        validation_input = validation_input.cpu()
+        quantized = quantize_network(network, validation_input, static=static)
+        report = quantization_report(network, quantized, validation_input)
+        print('Accuracy of the quantized network:', report)
+        network = quantized
+    example_input = (torch.zeros((1,) + network.input_size, device=device),)
+    if network.noise_size:
+        # the noise is an input of the exported module, thus the anonymizer can reuse the noise of a face
+        example_input += (torch.zeros((1, network.noise_size), device=device),)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(network, example_input, check_trace=False)
+    # parameters become constants of the graph | optimize_for_inference is applied when loading, its result can't be
+    # serialized
+    traced = torch.jit.freeze(traced)
+
+    meta = {'model': model.__class__.__module__ + '.' + model.__class__.__name__,
+            'input_size': list(network.input_size),
+            'noise_size': network.noise_size,
+            'device': device,
+            'kwargs': kwargs,
+            'quantization': report}
+    print('Exporting model... %s' % path)
+    torch.jit.save(traced, str(path), _extra_files={META_FILE: json.dumps(meta)})
+    return report
+
+
+def quantize_network(network, calibration_input, static=True):
+    """
+    Post-training int8 quantization of an inference network for the cpu. The weights of all linear layers are
+    quantized, their activations are quantized dynamically for each input. With static the convolution blocks (look
+    into STATIC_QUANTIZATION_MODULES) are quantized including their activations, the ranges of the activations are
+    calibrated on calibration_input.
+    :param network: InferenceNetwork on the cpu, it is not changed
+    :param calibration_input: batch of inputs of the network, i.e. from the validation set
+    :param static: quantize the convolution blocks as well
+    :return: quantized copy of the network
+    """
+    network = copy.deepcopy(network).eval()
+    quantize_dynamic(network, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if not static:
+        return network
+
+    names = [name for name, module in network.named_modules() if isinstance(module, STATIC_QUANTIZATION_MODULES)]
+    # record the input of each block, it is needed to trace the block
+    block_inputs = {}
+    hooks = [network.get_submodule(name).register_forward_pre_hook(
+        lambda module, inputs, name=name: block_inputs.setdefault(name, inputs)) for name in names]
+    _run(network, calibration_input)
+    for hook in hooks:
+        hook.remove()
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = {}
+    for name in names:
+        module = network.get_submodule(name)
+        for layer in module.modules():
+            if isinstance(layer, nn.LeakyReLU):
+                # not supported by the quantized operator
+                layer.inplace = False
+        prepared[name] = prepare_fx(module, qconfig_mapping, example_inputs=block_inputs[name])
+        _set_submodule(network, name, prepared[name])
+
+    # the observers record the range of the activations
+    _run(network, calibration_input)
+    for name, module in prepared.items():
+        _set_submodule(network, name, convert_fx(module))
+    return network
+
+
+def quantization_report(network, quantized, validation_input):
+    """
+    Compares the output of the fp32 network with the output of the quantized network, both get the same noise
+    :param network: fp32 InferenceNetwork
+    :param quantized: quantized copy of the network (look into quantize_network)
+    :param validation_input: batch of inputs of the network
+    :return: dict with the maximal and mean absolute error and the PSNR (w.r.t. the range of the fp32 output)
+    """
+    expected = _run(network, validation_input).float()
+    output = _run(quantized, validation_input).float()
+    error = (expected - output).abs()
+    mse = float((error ** 2).mean())
+    value_range = float(expected.max() - expected.min())
+    return {'max_abs_error': float(error.max()),
+            'mean_abs_error': float(error.mean()),
+            'psnr': 10 * math.log10(value_range ** 2 / mse) if mse > 0 else math.inf}
+
+
+def _run(network, network_input):
+    # the noise of the network is generated with a fixed seed, the global random state is not changed
+    with torch.no_grad(), torch.random.fork_rng():
+        torch.manual_seed(0)
+        return network(network_input)
+
+
+def _set_submodule(network, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(network.get_submodule(parent), child, module)
+
+
+class ExportedModel:
+    """
+    Loads a model exported by export_model. It provides the anonymize function of the CombinedModel without
+    constructing it, only the (static) input preparation of the model class is used.
+    """
+
+    def __init__(self, path, optimize=True):
+        """
+        :param path: path of the exported file
+        :param optimize: apply torch.jit.optimize_for_inference (folds batch norms, uses mkldnn on the cpu, ...)
+        """
+        print('Loading exported model... %s' % path)
+        extra_files = {META_FILE: ''}
+        self.network = torch.jit.load(str(path), map_location='cpu', _extra_files=extra_files)
+        self.meta = json.loads(extra_files[META_FILE])
+
+        # the module was frozen on the export device, fall back to the cpu if this device is not available
+        self.device = self.meta['device'] if self.meta['device'] == 'cpu' or torch.cuda.is_available() else 'cpu'
+        if self.device != 'cpu':
+            self.network = torch.jit.load(str(path), map_location=self.device)
+        if optimize:
+            self.network = torch.jit.optimize_for_inference(self.network)
+
+        module, name = self.meta['model'].rsplit('.', 1)
+        self.model_class = getattr(importlib.import_module(module), name)
+
+    def anonymize(self, extracted_face, extracted_information, **kwargs):
+        """
+        Same as CombinedModel.anonymize | the parameters of get_inference_network were fixed during the export
+        :param extracted_face: extracted face (by the face extractor) in RGB
+        :param extracted_information: additional information possibly needed by the network like landmarks)
+        :return: returns a anonymized version of the input image
+        """
+        return self.anonymize_batch([extracted_face], [extracted_information])
+
+    def anonymize_batch(self, extracted_faces, extracted_informations, noise=None, **kwargs):
+        """
+        Same as CombinedModel.anonymize_batch
+        :param extracted_faces: list of extracted faces (by the face extractor) in RGB
+        :param extracted_informations: list with the additional information of each face
+        :param noise: batch with the noise of each face (look into get_noise_size), by default new noise is drawn
+        :return: batch with the anonymized version of each face
+        """
+        network_input = torch.cat([self.model_class.get_anonymization_input(extracted_face, extracted_information)
+                                   for extracted_face, extracted_information in
+                                   zip(extracted_faces, extracted_informations)]).to(self.device)
+        with torch.no_grad():
+            if self.get_noise_size() == 0:
+                return self.network(network_input)
+            if noise is None:
+                noise = torch.randn((network_input.size(0), self.get_noise_size()))
+            return self.network(network_input, noise.to(network_input))
+
+    def get_noise_size(self, **kwargs):
+        """
+        Same as CombinedModel.get_noise_size | modules exported without noise input draw their noise themselves
+        """
+        return self.meta.get('noise_size', 0)
+
+    def get_output_levels(self, min_resolution=4):
+        """
+        Same as CombinedModel.get_output_levels | the level was fixed during the export
+        """
+        return [None]
@@ -14,11 +14,16 @@ from Preprocessor.Transforms import RandomWarp, TupleToTensor, TupleResize
 class ImageDatesetCombined(Dataset):
     """
     Special dataset class used for the deepfakes approach
-    internally it uses two ImageFolders with the two persons but returns one batch containing data for both autoencoders
+    internally it uses one ImageFolder for each person but returns one batch containing data for all autoencoders
     """
 
-    def __init__(self, root_folder: Path, size_multiplicator=1, img_size=(64, 64)):
-        # use this if your dataset is too little for the batchsize
+    def __init__(self, root_folder: Path, size_multiplicator=1, img_size=(64, 64), identities=(A, B)):
+        """
+        :param root_folder: the images of each identity are in root_folder/preprocessed/<identity>
+        :param size_multiplicator: use this if your dataset is too little for the batchsize
+        :param img_size: size of the returned images
+        :param identities: folder names of the persons, same order as the decoders of the model
+        """
         self.size_multiplicator = size_multiplicator
 
         self.random_transforms = transforms.Compose([
@@ -34,20 +39,20 @@ class ImageDatesetCombined(Dataset):
             TupleToTensor(),
         ])
 
-        self.dataset_a = ImageFolder(str(root_folder / PREPROCESSED / A), transform=self.transforms)
-        self.dataset_b = ImageFolder(str(root_folder / PREPROCESSED / B), transform=self.transforms)
+        self.identities = list(identities)
+        self.datasets = [ImageFolder(str(root_folder / PREPROCESSED / identity), transform=self.transforms)
+                         for identity in self.identities]
 
-        print(f"Number of items in datasets:\n"
-              f"A:\t{len(self.dataset_a)}\n"
-              f"B:\t{len(self.dataset_b)}\n"
-              f"AB:\t{len(self)}")
+        print("Number of items in datasets:\n" +
+              "".join(f"{identity}:\t{len(dataset)}\n" for identity, dataset in zip(self.identities, self.datasets)) +
+              f"Combined:\t{len(self)}")
 
     def __len__(self):
-        return min(len(self.dataset_a), len(self.dataset_b)) * self.size_multiplicator
+        return min(len(dataset) for dataset in self.datasets) * self.size_multiplicator
 
     def __getitem__(self, i):
-        i %= min(len(self.dataset_a), len(self.dataset_b))
-        return self.dataset_a[i][0], self.dataset_b[i][0]
+        i %= min(len(dataset) for dataset in self.datasets)
+        return tuple(dataset[i][0] for dataset in self.datasets)
 
 
 class ImageFeatureDataset(Dataset):
@@ -142,7 +147,14 @@ class ProgressiveFeatureDataset(Dataset):
         """
         double the resolution of the dataset
         """
-        self.current_resolution += 1
+        self.set_resolution(self.current_resolution + 1)
+
+    def set_resolution(self, resolution):
+        """
+        load the dataset with the given resolution, i.e. when resuming a training
+        :param resolution: 2^resolution = width(image)
+        """
+        self.current_resolution = resolution
         self._load_new_dataset()
 
     def __getitem__(self, index):
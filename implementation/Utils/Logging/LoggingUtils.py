@@ -1,18 +1,21 @@
 import datetime
 import inspect
 import json
+from pathlib import Path
 
 import torch
 from tensorboardX import SummaryWriter
 from torchvision import utils as vutils
 
+from Utils.Checkpoint import CheckpointWriter, CHECKPOINT_FOLDER, CHECKPOINT_FILE, VERSIONED_CHECKPOINT_FILE
+
 
 class Logger:
     """
     wrapper for the tensorboardx | does some higher level logging
     """
 
-    def __init__(self, steps_per_epoch, model, save_model_every_nth=100, shared_model_path='.'):
+    def __init__(self, steps_per_epoch, model, save_model_every_nth=100, shared_model_path='.', keep_last_checkpoints=3):
         self.shared_model_path = shared_model_path
         self.loggin_path = "./logs/" + str(datetime.datetime.now())
         self.writer = SummaryWriter(self.loggin_path)
@@ -20,6 +23,8 @@ class Logger:
         self.t = datetime.datetime.now()
         self.model = model
         self.save_model_every_nth = save_model_every_nth
+        # models and checkpoints are written in a background thread
+        self.checkpoint_writer = CheckpointWriter(keep_last=keep_last_checkpoints)
 
     def log_values(self, epoch, values: dict = None):
         """
@@ -72,9 +77,35 @@ class Logger:
         self.writer.add_image(tag_name, grid, epoch)
 
     def save_model(self, epoch):
+        """
+        saves all CustomModules of the model to the logging path, the shared model path gets hard links to these files
+        :param epoch: current epoch
+        """
         if epoch % self.save_model_every_nth == 0:  # and epoch > 0:
-            self.model.save_model(self.loggin_path)
-            self.model.save_model(self.shared_model_path)
+            model_path = Path(self.loggin_path) / 'model'
+            shared_path = Path(self.shared_model_path) / 'model'
+            files = {model_path / (name + '.model'): state for name, state in self.model.get_module_states().items()}
+            links = [(file, shared_path / file.name) for file in files]
+            self.checkpoint_writer.write(files, links)
+
+    def save_checkpoint(self, checkpoint):
+        """
+        saves a checkpoint with the complete training state to the logging path, only the last checkpoints are kept
+        checkpoint/checkpoint.tar in the logging path and in the shared model path are hard links to the newest one
+        :param checkpoint: dict with the training state (look into Trainer.save_checkpoint)
+        """
+        folder = Path(self.loggin_path) / CHECKPOINT_FOLDER
+        file = folder / (VERSIONED_CHECKPOINT_FILE % checkpoint['epoch'])
+        links = [(file, folder / CHECKPOINT_FILE),
+                 (file, Path(self.shared_model_path) / CHECKPOINT_FOLDER / CHECKPOINT_FILE)]
+        self.checkpoint_writer.write({file: checkpoint}, links,
+                                     versioned=(folder, VERSIONED_CHECKPOINT_FILE.replace('%04d', '*')))
+
+    def close(self):
+        """
+        waits until all models and checkpoints are written
+        """
+        self.checkpoint_writer.close()
 
     def log_config(self, config):
         base_tag = 'config'
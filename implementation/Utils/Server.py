@@ -0,0 +1,445 @@
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# Request of the batch queue: the extracted faces of one image and the future of their anonymized faces
+Request = collections.namedtuple('Request', ('faces', 'future', 'enqueue_time'))
+
+
+class HttpError(Exception):
+    """
+    Answered with its status code instead of the response of the request
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ServerStats:
+    """
+    Counters, queue depth, batch sizes and latencies of an AnonymizationServer, only updated in its event loop
+    """
+
+    def __init__(self, window=10000):
+        """
+        :param window: number of recent requests (batches) the percentiles are computed of
+        """
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.without_face = 0
+        self.faces = 0
+        # faces waiting for a forward pass
+        self.queue_depth = 0
+        self.queue_max = 0
+        # number of faces of a forward pass -> number of forward passes
+        self.batch_sizes = collections.Counter()
+        # seconds from the received request to the encoded response
+        self.latencies = collections.deque(maxlen=window)
+        # seconds the faces of a request waited in the batch queue
+        self.wait_times = collections.deque(maxlen=window)
+        # seconds of each forward pass
+        self.inference_times = collections.deque(maxlen=window)
+        self.start_time = time.time()
+
+    def enqueue(self, faces):
+        self.queue_depth += faces
+        self.queue_max = max(self.queue_max, self.queue_depth)
+
+    def summary(self):
+        """
+        :return: dict with the counters, the current and maximal queue depth (faces), the histogram of the batch sizes
+        and the percentiles of the latencies in milliseconds (look into percentiles)
+        """
+        elapsed = time.time() - self.start_time
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'rejected': self.rejected,
+                'without_face': self.without_face,
+                'faces': self.faces,
+                'requests_per_second': self.requests / elapsed if elapsed > 0 else 0.0,
+                'queue_depth': self.queue_depth,
+                'queue_max': self.queue_max,
+                'batches': sum(self.batch_sizes.values()),
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'latency_ms': percentiles(self.latencies),
+                'wait_ms': percentiles(self.wait_times),
+                'inference_ms': percentiles(self.inference_times),
+                'uptime': elapsed}
+
+
+class AnonymizationServer:
+    """
+    Serves one Anonymizer to several local clients over HTTP (asyncio, TCP on localhost or a Unix socket), thus the
+    model is loaded once instead of by each client
+    Requests:
+    * POST /anonymize: the body is an encoded image (PNG, JPEG, ...), the response the anonymized image encoded as PNG
+      (?format=jpg: JPEG), the header X-Faces is the number of anonymized faces (0: the image is unchanged)
+    * GET /metrics: JSON (look into ServerStats.summary)
+    * GET /health
+    The images of concurrent requests are anonymized in micro-batches:
+    1. a pool of threads decodes the image and extracts its faces (dlib and OpenCV release the GIL)
+    2. the faces wait in the batch queue, the first request of a batch waits at most max_delay for further requests,
+       the faces of all collected requests (at least batch_size faces if available) are anonymized in one forward
+       pass by the inference thread (look into Anonymizer.anonymize_faces), requests arriving meanwhile form the
+       next batch
+    3. the pool merges the faces on the image and encodes it (look into Anonymizer.merge_faces_into)
+    """
+
+    def __init__(self, anonymizer, batch_size=8, max_delay=0.01, extract_workers=4, max_queue=64):
+        """
+        :param anonymizer: Anonymizer, not in video mode (the images of the requests are independent)
+        :param batch_size: number of faces that are anonymized in one forward pass without waiting for max_delay
+        :param max_delay: seconds the first request of a batch waits for further requests (latency budget)
+        :param extract_workers: number of threads decoding, extracting, merging and encoding
+        :param max_queue: maximal number of faces waiting in the batch queue, further requests are rejected (503)
+        """
+        self.anonymizer = anonymizer
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.extract_workers = extract_workers
+        self.max_queue = max_queue
+
+    def run(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """
+        Serves until interrupted (look into serve)
+        """
+        try:
+            asyncio.run(self.serve(host, port, unix_socket))
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """
+        :param host: address of the TCP socket
+        :param port: port of the TCP socket
+        :param unix_socket: path of a Unix socket, used instead of the TCP socket
+        """
+        self.stats = ServerStats()
+        self.queue = asyncio.Queue()
+        self.pool = ThreadPoolExecutor(self.extract_workers)
+        # the model is used by one thread
+        self.inference = ThreadPoolExecutor(1)
+        batcher = asyncio.ensure_future(self._batch())
+        if unix_socket is None:
+            server = await asyncio.start_server(self._handle, host, port)
+        else:
+            server = await asyncio.start_unix_server(self._handle, unix_socket)
+        print('Serving on', unix_socket or '%s:%d' % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown(wait=False)
+            self.inference.shutdown(wait=False)
+
+    ############################
+    # requests
+    ###########################
+
+    async def _handle(self, reader, writer):
+        # one connection, several requests with keep-alive
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                start_line, headers, body = message
+                try:
+                    method, target = start_line.split(' ')[:2]
+                    status, response_headers, content = await self._respond(method, target, body)
+                except HttpError as ex:
+                    status, response_headers, content = ex.status, {'Content-Type': 'text/plain'}, str(ex).encode()
+                except ValueError as ex:
+                    status, response_headers, content = 400, {'Content-Type': 'text/plain'}, str(ex).encode()
+                except Exception as ex:
+                    status, response_headers, content = 500, {'Content-Type': 'text/plain'}, repr(ex).encode()
+                if status == 503:
+                    self.stats.rejected += 1
+                elif status != 200:
+                    self.stats.errors += 1
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(format_message('HTTP/1.1 %d %s' % (status, REASONS[status]), response_headers, content,
+                                            keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, body):
+        """
+        :return: (status, headers, content) of the response
+        """
+        url = urlsplit(target)
+        if url.path == '/anonymize':
+            if method != 'POST':
+                raise HttpError(405, 'POST an encoded image')
+            extension = '.jpg' if parse_qs(url.query).get('format') == ['jpg'] else '.png'
+            content, faces = await self.anonymize(body, extension)
+            return 200, {'Content-Type': 'image/jpeg' if extension == '.jpg' else 'image/png',
+                         'X-Faces': str(faces)}, content
+        if url.path == '/metrics':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.stats.summary()).encode()
+        if url.path == '/health':
+            return 200, {'Content-Type': 'text/plain'}, b'ok'
+        raise HttpError(404, 'unknown path ' + url.path)
+
+    async def anonymize(self, encoded_image, extension='.png'):
+        """
+        Anonymizes an image in the next micro-batch
+        :param encoded_image: bytes of an encoded image
+        :param extension: format of the response (look into cv2.imencode)
+        :return: (anonymized image encoded, number of faces)
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        frame, faces = await loop.run_in_executor(self.pool, self._extract, encoded_image)
+        if faces:
+            if self.stats.queue_depth + len(faces) > self.max_queue:
+                raise HttpError(503, 'too many faces are waiting')
+            future = loop.create_future()
+            self.stats.enqueue(len(faces))
+            await self.queue.put(Request(faces, future, time.time()))
+            faces_out = await future
+        else:
+            self.stats.without_face += 1
+            faces_out = []
+        content = await loop.run_in_executor(self.pool, self._merge, frame, faces, faces_out, extension)
+        self.stats.requests += 1
+        self.stats.faces += len(faces)
+        self.stats.latencies.append(time.time() - start_time)
+        return content, len(faces)
+
+    def _extract(self, encoded_image):
+        frame = cv2.imdecode(np.frombuffer(encoded_image, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise HttpError(400, 'the body is not an encoded image')
+        return frame, self.anonymizer.extractor.extract_faces(frame, bgr=True)
+
+    def _merge(self, frame, faces, faces_out, extension):
+        if faces:
+            self.anonymizer.merge_faces_into(faces_out, [face[1] for face in faces], [face[2] for face in faces],
+                                             frame, bgr=True)
+        return cv2.imencode(extension, frame)[1].tobytes()
+
+    ############################
+    # micro-batching
+    ###########################
+
+    async def _batch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            faces = len(pending[0].faces)
+            # the latency budget starts with the first request of the batch
+            deadline = pending[0].enqueue_time + self.max_delay
+            while faces < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    request = self.queue.get_nowait() if not self.queue.empty() else \
+                        await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(request)
+                faces += len(request.faces)
+
+            start_time = time.time()
+            self.stats.queue_depth -= faces
+            for request in pending:
+                self.stats.wait_times.append(start_time - request.enqueue_time)
+            try:
+                faces_out = await loop.run_in_executor(self.inference, self._infer, pending)
+            except Exception as ex:
+                for request in pending:
+                    if not request.future.done():
+                        request.future.set_exception(ex)
+                continue
+            self.stats.inference_times.append(time.time() - start_time)
+            self.stats.batch_sizes[faces] += 1
+            faces_out = iter(faces_out)
+            for request in pending:
+                request_faces_out = [next(faces_out) for _ in request.faces]
+                # the client may have disconnected
+                if not request.future.done():
+                    request.future.set_result(request_faces_out)
+
+    def _infer(self, pending):
+        track_ids, extracted_faces, extracted_informations = zip(*[face for request in pending
+                                                                   for face in request.faces])
+        return self.anonymizer.anonymize_faces(extracted_faces, extracted_informations, track_ids)
+
+
+class Client:
+    """
+    Client of the AnonymizationServer, the requests of a client are sent one after another over one connection
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """
+        :param host: address of the server
+        :param port: port of the server
+        :param unix_socket: path of the Unix socket of the server, used instead of host and port
+        """
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, target, body=b''):
+        """
+        :return: (status, headers, body) of the response
+        """
+        if self.writer is None:
+            if self.unix_socket is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            else:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.unix_socket)
+        self.writer.write(format_message('%s %s HTTP/1.1' % (method, target), {'Host': self.host}, body))
+        await self.writer.drain()
+        message = await read_message(self.reader)
+        if message is None:
+            raise ConnectionError('the server closed the connection')
+        start_line, headers, body = message
+        return int(start_line.split(' ')[1]), headers, body
+
+    async def anonymize(self, encoded_image, image_format='png'):
+        """
+        :param encoded_image: bytes of an encoded image
+        :param image_format: format of the anonymized image, 'png' or 'jpg'
+        :return: (anonymized image encoded, number of faces)
+        """
+        status, headers, body = await self.request('POST', '/anonymize?format=' + image_format, encoded_image)
+        if status != 200:
+            raise HttpError(status, body.decode(errors='replace'))
+        return body, int(headers['x-faces'])
+
+    async def metrics(self):
+        """
+        :return: dict (look into ServerStats.summary)
+        """
+        return json.loads((await self.request('GET', '/metrics'))[2])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = None, None
+
+
+async def generate_load(encoded_image, requests=200, concurrency=16, image_format='png', **client_kwargs):
+    """
+    Sends the same image from several clients at once to measure the throughput and latency of a server
+    :param encoded_image: bytes of an encoded image
+    :param requests: number of requests of all clients
+    :param concurrency: number of clients, each sends its next request after its last response
+    :param image_format: format of the anonymized image
+    :param client_kwargs: address of the server (look into Client)
+    :return: dict with the requests per second, the percentiles of the latencies in milliseconds, the number of
+    responses of each status and the metrics of the server
+    """
+    latencies = []
+    statuses = collections.Counter()
+    remaining = [requests]
+
+    async def run_client():
+        client = Client(**client_kwargs)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start_time = time.time()
+                status = (await client.request('POST', '/anonymize?format=' + image_format, encoded_image))[0]
+                latencies.append(time.time() - start_time)
+                statuses[status] += 1
+        finally:
+            client.close()
+
+    start_time = time.time()
+    await asyncio.gather(*[run_client() for _ in range(concurrency)])
+    elapsed = time.time() - start_time
+    client = Client(**client_kwargs)
+    try:
+        server_metrics = await client.metrics()
+    finally:
+        client.close()
+    return {'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': percentiles(latencies),
+            'statuses': dict(statuses),
+            'elapsed': elapsed,
+            'server': server_metrics}
+
+
+def format_load(stats):
+    """
+    :param stats: statistics returned by generate_load
+    :return: the statistics as text
+    """
+    server = stats['server']
+    lines = ['client: %.1f requests/s, %.1f s, statuses %s' % (stats['requests_per_second'], stats['elapsed'],
+                                                              stats['statuses'])]
+    lines.append('%-16s %10s %10s %10s' % ('[ms]', 'p50', 'p90', 'p99'))
+    for name, values in [('client latency', stats['latency_ms']), ('server latency', server['latency_ms']),
+                         ('batch wait', server['wait_ms']), ('inference', server['inference_ms'])]:
+        lines.append('%-16s %10s %10s %10s' % (name, *['-' if values[key] is None else '%.1f' % values[key]
+                                                       for key in ('p50', 'p90', 'p99')]))
+    lines.append('batch sizes: ' + ', '.join('%s: %d' % item for item in server['batch_sizes'].items()))
+    lines.append('queue max: %d faces, rejected: %d, without face: %d' % (server['queue_max'], server['rejected'],
+                                                                          server['without_face']))
+    return '\n'.join(lines)
+
+
+############################
+# HTTP/1.1 messages
+###########################
+
+async def read_message(reader):
+    """
+    Reads a request or a response with Content-Length (no chunked transfer encoding)
+    :param reader: asyncio.StreamReader
+    :return: (start line, headers with lower case names, body), None if the connection was closed
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return start_line.decode('latin-1').strip(), headers, body
+
+
+def format_message(start_line, headers, body, keep_alive=True):
+    """
+    :return: bytes of a request or a response
+    """
+    headers = dict(headers, **{'Content-Length': str(len(body)), 'Connection': 'keep-alive' if keep_alive else 'close'})
+    head = start_line + '\r\n' + ''.join('%s: %s\r\n' % item for item in headers.items()) + '\r\n'
+    return head.encode('latin-1') + body
+
+
+def percentiles(values, q=(50, 90, 99)):
+    """
+    :param values: seconds
+    :return: dict with the percentiles (p50, p90, p99) in milliseconds, None without values
+    """
+    values = list(values)
+    return {'p%d' % p: float(np.percentile(values, p)) * 1e3 if values else None for p in q}
@@ -0,0 +1,76 @@
+import numpy as np
+
+from Preprocessor.FaceExtractor import normalize_landmarks
+
+
+class CacheEntry:
+    """
+    Face generated for a track and the normalized landmarks it was generated from
+    """
+
+    def __init__(self, landmarks):
+        self.landmarks = landmarks
+        # set after the forward pass, entries are created before the face is generated
+        self.face = None
+        # number of frames the face was reused
+        self.age = 0
+
+
+class TemporalCache:
+    """
+    Reuses the anonymized face of a track (a face followed over several frames of a video) while its landmarks barely
+    move. The landmarks are compared in the coordinates of the extracted face (look into normalize_landmarks), a face
+    that only moves through the frame is reused as well. The reused face is merged on the new frame with the extraction
+    information of the new frame, only the forward pass is skipped.
+    The faces have to be looked up in frame order.
+    """
+
+    def __init__(self, threshold=0.01, max_age=10):
+        """
+        :param threshold: maximal mean distance of the normalized landmarks (relative to the size of the face) to the
+        landmarks the face was generated from
+        :param max_age: maximal number of frames a generated face is reused
+        """
+        self.threshold = threshold
+        self.max_age = max_age
+        self.entries = {}
+        self.reused = 0
+        self.generated = 0
+
+    def lookup(self, track_id, extracted_information, reuse=False):
+        """
+        Returns the entry of the track if its face can be reused, otherwise a new entry is stored for the track. The
+        face of a new entry has to be set by the caller.
+        :param track_id: identifier of the track
+        :param extracted_information: extraction information of the face in the current frame
+        :param reuse: reuse the face of the track regardless of its landmarks (i.e. to drop a frame), the face is not
+        reused more than max_age times either way
+        :return: the entry and whether the face has to be generated
+        """
+        landmarks = normalize_landmarks(extracted_information).reshape((-1, 2))
+        entry = self.entries.get(track_id)
+        if entry is not None and entry.age < self.max_age and (
+                reuse or np.linalg.norm(landmarks - entry.landmarks, axis=1).mean() <= self.threshold):
+            entry.age += 1
+            self.reused += 1
+            return entry, False
+
+        entry = CacheEntry(landmarks)
+        self.entries[track_id] = entry
+        self.generated += 1
+        return entry, True
+
+    def discard(self, track_id):
+        """
+        Forgets a track that ended (look into Anonymizer.forget_dropped_tracks)
+        :param track_id: identifier of the track
+        """
+        self.entries.pop(track_id, None)
+
+    def clear(self):
+        """
+        Forgets all tracks, i.e. before a new video
+        """
+        self.entries = {}
+        self.reused = 0
+        self.generated = 0
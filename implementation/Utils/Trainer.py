@@ -1,5 +1,10 @@
+import os
+import signal
+import sys
+
 from Configuration.config_general import MOST_RECENT_MODEL
-from Utils.DataSplitter import DataSplitter
+from Utils.Checkpoint import get_rng_state, set_rng_state, load_checkpoint
+from Utils.DataSplitter import DataSplitter, TrainingInterrupted
 from Utils.Logging.LoggingUtils import Logger
 
 
@@ -10,9 +15,15 @@ class Trainer:
     with the params from the config. It will train for the number of epochs specified in the config by loading training
     data and call the train method of the model. The returned info is passed to the logging method of the model. If the
     time is right the evaluation method of the model is called and logged as well.
+    After every nth epoch (and on SIGTERM after the running iteration) a checkpoint with the complete training state is
+    written, which can be used to resume the training.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, resume=None):
+        """
+        :param config: the model configuration
+        :param resume: checkpoint file or folder containing a checkpoint to resume the training from
+        """
         self.config = config
         # if torch.cuda.device_count() > 1:
         #     self.config.batch_size *= torch.cuda.device_count()
@@ -21,14 +32,72 @@ class Trainer:
         self.data_loader = DataSplitter(self.data_set, self.config.batch_size, validation_size=config.validation_size)
         self.model = config.model(**config.model_params, dataset=self.data_set,
                                   initial_batch_size=self.config.batch_size,
-                                  data_loader=self.data_loader, mode='train')
+                                  data_loader=self.data_loader, mode='train', precision=self.config.precision)
 
         self.logger = Logger(len(self.data_set), self.model, save_model_every_nth=self.config.save_model_every_nth,
-                             shared_model_path=MOST_RECENT_MODEL)
+                             shared_model_path=MOST_RECENT_MODEL,
+                             keep_last_checkpoints=self.config.keep_last_checkpoints)
         self.logger.log_config(config)
 
+        self.start_epoch = 0
+        # the first epoch continues an interrupted epoch of the checkpoint
+        self.resumed_within_epoch = False
+        if resume is not None:
+            self.resume(resume)
+        # set by the SIGTERM handler, the training stops after the running iteration
+        self.terminate = False
+
+    def resume(self, path):
+        """
+        Restores the complete training state from a checkpoint
+        :param path: checkpoint file or folder containing a checkpoint
+        """
+        checkpoint = load_checkpoint(path)
+        # restore the split and the resolution of the data first, the model may depend on the data loader
+        self.data_loader.set_state(checkpoint['data_loader'])
+        self.model.load_checkpoint(checkpoint['model'])
+        self.config.validate_index = checkpoint['validate_index']
+        set_rng_state(checkpoint['rng'])
+        self.start_epoch = checkpoint['epoch'] + 1
+        self.resumed_within_epoch = checkpoint.get('interrupted', False)
+        print('Resuming training at epoch', self.start_epoch)
+        if self.resumed_within_epoch:
+            print('Continuing the interrupted epoch after batch', checkpoint['data_loader']['position'])
+
+    def save_checkpoint(self, epoch, interrupted=False):
+        """
+        Writes a checkpoint with the complete training state
+        :param epoch: last epoch that is contained in the checkpoint
+        :param interrupted: the epoch after it was interrupted, the trained batches of it are contained as well
+        """
+        checkpoint = {'epoch': epoch,
+                      'interrupted': interrupted,
+                      'validate_index': self.config.validate_index,
+                      'data_loader': self.data_loader.get_state(interrupted),
+                      'model': self.model.get_checkpoint(),
+                      'rng': get_rng_state()}
+        self.logger.save_checkpoint(checkpoint)
+
+    def _handle_sigterm(self, signum, frame):
+        """
+        Requests a checkpoint and the exit after the running iteration. The handler can run at any point of an
+        iteration (i.e. between the backward pass and the optimizer step), so the training data loader interrupts the
+        epoch when the next batch is requested (look into InterruptibleDataLoader).
+        """
+        if os.getpid() != self.pid:
+            # data loader workers inherit the handler: terminate them as usual
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        print('\nSIGTERM received, writing checkpoint after the current iteration...')
+        self.terminate = True
+        self.data_loader.interrupt = True
+
     def train(self):
-        for current_epoch in range(self.config.max_epochs):
+        self.pid = os.getpid()
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+
+        for current_epoch in range(self.start_epoch, self.config.max_epochs):
 
             ############################
             # (1) Training
@@ -39,8 +108,15 @@ class Trainer:
             # get the data for training
             train_data_loader = self.data_loader.get_train_data_loader()
             # train with this data and retrieve logging information
-            info = self.model.train(train_data_loader, self.config.batch_size, current_epoch=current_epoch,
-                                    validate=False)
+            try:
+                info = self.model.train(train_data_loader, self.config.batch_size, current_epoch=current_epoch,
+                                        validate=False, resumed=self.resumed_within_epoch)
+            except TrainingInterrupted:
+                # the remaining batches of the epoch are trained after resuming
+                self.save_checkpoint(current_epoch - 1, interrupted=True)
+                self.logger.close()
+                sys.exit(0)
+            self.resumed_within_epoch = False
 
             # update validation frequency if needed (look into config for more information)
             if current_epoch >= self.config.validation_periods[self.config.validate_index + 1]:
@@ -64,3 +140,15 @@ class Trainer:
             else:
                 # log the info without images
                 self.model.log(self.logger, current_epoch, *info)
+
+            ############################
+            # (3) checkpoint
+            ###########################
+            if current_epoch % self.config.save_checkpoint_every_nth == 0 or self.terminate:
+                self.save_checkpoint(current_epoch)
+            if self.terminate:
+                self.logger.close()
+                sys.exit(0)
+
+        # wait for the background writes of models and checkpoints
+        self.logger.close()
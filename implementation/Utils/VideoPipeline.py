@@ -0,0 +1,448 @@
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import torch
+
+from Utils.Anonymizer import Anonymizer
+from Utils.Logging.LoggingUtils import print_progress_bar
+
+# marks the end of the stream, each worker of a stage passes one to the next stage
+END = None
+
+
+class StageStats:
+    """
+    Throughput and input queue depth of one stage of the VideoPipeline, shared by the workers of the stage
+    """
+
+    def __init__(self, name, workers):
+        """
+        :param name: name of the stage
+        :param workers: number of threads of the stage
+        """
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.depth_samples = 0
+        self.lock = threading.Lock()
+
+    def record_depth(self, depth):
+        """
+        :param depth: current size of the input queue of the stage
+        """
+        with self.lock:
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.depth_samples += 1
+
+    def record_item(self, busy, items=1):
+        """
+        :param busy: seconds a worker needed for the items (without waiting for the queues)
+        :param items: number of processed frames
+        """
+        with self.lock:
+            self.items += items
+            self.busy += busy
+
+    def summary(self, elapsed):
+        """
+        :param elapsed: wall time of the whole pipeline in seconds
+        :return: dict with the processed frames, frames per second (w.r.t. the wall time), the frames per second one
+        worker reaches while busy, the utilization of the workers and the mean and maximal depth of the input queue
+        """
+        return {'frames': self.items,
+                'fps': self.items / elapsed if elapsed > 0 else 0.0,
+                'fps_per_worker': self.items / self.busy if self.busy > 0 else 0.0,
+                'utilization': self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0,
+                'queue_mean': self.depth_sum / self.depth_samples if self.depth_samples else 0.0,
+                'queue_max': self.depth_max}
+
+
+class PipelineStopped(Exception):
+    """
+    Raised in the workers of a VideoPipeline if another worker failed
+    """
+    pass
+
+
+class VideoPipeline:
+    """
+    Anonymizes a video in stages that run concurrently in threads and are connected by bounded queues:
+    1. decode: one thread reads the frames
+    2. extract: a pool of threads detects and extracts the faces (dlib and OpenCV release the GIL)
+    3. infer: one thread tracks the faces in frame order (look into FaceExtractor.track) and anonymizes the faces of
+       several frames in one forward pass (look into Anonymizer.anonymize_faces)
+    4. reconstruct: a pool of threads merges the anonymized faces on the frames
+    5. encode: one thread writes the frames in their original order
+    The frames stay BGR arrays of OpenCV in all stages, only the detection gets an RGB copy (look into
+    FaceExtractor.detect) and the faces are blended into the decoded frames (look into Anonymizer.merge_faces_into).
+    The result is the same as anonymizing frame by frame with the same video_seed (models with noise, look into
+    Anonymizer.reset). With the temporal cache of the anonymizer (look into Utils/TemporalCache.py) the cache of a
+    frame range starts empty, the warm up frames are not anonymized. With multi_face the tracks of a frame range are
+    numbered from its warm up, a face gets the same identity as in the whole video if the track ids match (i.e. the
+    faces in the frames before the range stayed the same), thus convert_video_segments refuses multi_face.
+    """
+
+    STAGES = ['decode', 'extract', 'infer', 'reconstruct', 'encode']
+
+    def __init__(self, anonymizer, extract_workers=4, reconstruct_workers=2, batch_size=8, queue_size=32):
+        """
+        :param anonymizer: Anonymizer, conventionally in video mode
+        :param extract_workers: number of threads extracting faces
+        :param reconstruct_workers: number of threads merging the faces on the frames
+        :param batch_size: number of faces anonymized in one forward pass
+        :param queue_size: maximal number of frames waiting in front of each stage
+        """
+        self.anonymizer = anonymizer
+        self.extract_workers = extract_workers
+        self.reconstruct_workers = reconstruct_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    def __call__(self, input_path, output_path, fourcc='X264', progress=True, start=0, end=None, warmup=0,
+                 video_seed=None):
+        """
+        Anonymizes a video or a range of its frames
+        :param input_path: path of the video
+        :param output_path: destination of the anonymized video
+        :param fourcc: codec of the anonymized video
+        :param progress: print a progress bar
+        :param start: index of the first anonymized frame
+        :param end: index after the last anonymized frame, None: until the end of the video
+        :param warmup: number of frames before start that are only passed to the extractor, its state (video mode) is
+        the same as if the whole video was processed then
+        :param video_seed: seed of the noise of the tracks (look into Anonymizer.reset), by default a random seed
+        :return: dict with the statistics of each stage (look into StageStats.summary), the frames per second of the
+        whole pipeline, the elapsed time and with the temporal cache the number of reused and generated faces
+        """
+        cap = cv2.VideoCapture(str(input_path))
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        out = cv2.VideoWriter(str(output_path), cv2.VideoWriter_fourcc(*fourcc), cap.get(cv2.CAP_PROP_FPS),
+                              (frame_width, frame_height))
+        self.progress = progress
+        self.length = (frame_count if end is None else min(end, frame_count)) - start
+        # the warm up frames get negative indices
+        self.warmup = min(warmup, start)
+        self.frames = None if end is None else end - start
+        # seeking is not frame accurate for all codecs, the frames before are decoded instead
+        for _ in range(start - self.warmup):
+            cap.grab()
+
+        self.anonymizer.reset(video_seed)
+        self.stop = threading.Event()
+        self.error = None
+        self.stats = {name: StageStats(name, workers) for name, workers in
+                      zip(self.STAGES, [1, self.extract_workers, 1, self.reconstruct_workers, 1])}
+        decoded, extracted, anonymized, reconstructed = [queue.Queue(self.queue_size) for _ in range(4)]
+
+        threads = [threading.Thread(target=self._run, args=(self._decode, cap, decoded))]
+        threads += [threading.Thread(target=self._run, args=(self._extract, decoded, extracted))
+                    for _ in range(self.extract_workers)]
+        threads += [threading.Thread(target=self._run, args=(self._infer, extracted, anonymized))]
+        threads += [threading.Thread(target=self._run, args=(self._reconstruct, anonymized, reconstructed))
+                    for _ in range(self.reconstruct_workers)]
+        threads += [threading.Thread(target=self._run, args=(self._encode, reconstructed, out))]
+
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+        cap.release()
+        out.release()
+        if self.error is not None:
+            raise self.error
+
+        stats = {name: stage.summary(elapsed) for name, stage in self.stats.items()}
+        stats['fps'] = self.stats['encode'].items / elapsed if elapsed > 0 else 0.0
+        stats['elapsed'] = elapsed
+        if self.anonymizer.cache is not None:
+            stats['reused'] = self.anonymizer.cache.reused
+            stats['generated'] = self.anonymizer.cache.generated
+        return stats
+
+    ############################
+    # stages
+    ###########################
+
+    def _decode(self, cap, output_queue):
+        stats = self.stats['decode']
+        index = -self.warmup
+        while self.frames is None or index < self.frames:
+            start_time = time.time()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            stats.record_item(time.time() - start_time)
+            self._put(output_queue, (index, frame))
+            index += 1
+        for _ in range(self.extract_workers):
+            self._put(output_queue, END)
+
+    def _extract(self, input_queue, output_queue):
+        stats = self.stats['extract']
+        extractor = self.anonymizer.extractor
+        while True:
+            item = self._get(input_queue, stats)
+            if item is END:
+                self._put(output_queue, END)
+                return
+            start_time = time.time()
+            index, frame = item
+            faces_landmarks = extractor.detect(frame, bgr=True)
+            # the extraction changes the landmarks, the unchanged ones are needed for the tracking
+            extracted = [extractor.extract(frame, landmarks.copy(), bgr=True) for landmarks in faces_landmarks]
+            stats.record_item(time.time() - start_time)
+            self._put(output_queue, (index, frame, faces_landmarks, extracted))
+
+    def _infer(self, input_queue, output_queue):
+        stats = self.stats['infer']
+        extractor = self.anonymizer.extractor
+        # frames (index, frame, list with (track_id, extracted face, extraction information) of each face) waiting for
+        # the next forward pass
+        pending = []
+        faces = 0
+        for index, frame, faces_landmarks, extracted in self._ordered(input_queue, self.extract_workers, stats,
+                                                                      first_index=-self.warmup):
+            start_time = time.time()
+            tracked = extractor.track(faces_landmarks)
+            if index < 0:
+                # warm up frame, only the state of the filter or the tracker is needed
+                stats.record_item(time.time() - start_time)
+                continue
+            # faces that were not detected in this frame are extracted with the landmarks of the last frame
+            frame_faces = [(track_id, *(extracted[i] if i is not None else
+                                        extractor.extract(frame, landmarks, bgr=True)))
+                           for track_id, landmarks, i in tracked]
+            pending.append((index, frame, frame_faces))
+            faces += len(frame_faces)
+            busy = time.time() - start_time
+            if faces >= self.batch_size:
+                busy += self._flush(pending, output_queue)
+                pending, faces = [], 0
+            stats.record_item(busy)
+        self._flush(pending, output_queue)
+        for _ in range(self.reconstruct_workers):
+            self._put(output_queue, END)
+
+    def _flush(self, pending, output_queue):
+        """
+        Anonymizes the faces of the pending frames in one forward pass and passes the frames on
+        :return: seconds needed for the forward pass
+        """
+        start_time = time.time()
+        faces = [face for _, _, frame_faces in pending for face in frame_faces]
+        faces_out = []
+        if faces:
+            track_ids, extracted_faces, extracted_informations = zip(*faces)
+            faces_out = self.anonymizer.anonymize_faces(extracted_faces, extracted_informations, track_ids)
+        busy = time.time() - start_time
+        faces_out = iter(faces_out)
+        for index, frame, frame_faces in pending:
+            self._put(output_queue, (index, frame, [next(faces_out) for _ in frame_faces], frame_faces))
+        return busy
+
+    def _reconstruct(self, input_queue, output_queue):
+        stats = self.stats['reconstruct']
+        while True:
+            item = self._get(input_queue, stats)
+            if item is END:
+                self._put(output_queue, END)
+                return
+            start_time = time.time()
+            index, frame, faces_out, frame_faces = item
+            # the frames stay BGR, the faces are blended into the decoded frame
+            self.anonymizer.merge_faces_into(faces_out, [face[1] for face in frame_faces],
+                                             [face[2] for face in frame_faces], frame, bgr=True)
+            stats.record_item(time.time() - start_time)
+            self._put(output_queue, (index, frame))
+
+    def _encode(self, input_queue, out):
+        stats = self.stats['encode']
+        if self.progress:
+            print_progress_bar(0, max(self.length, 1))
+        for index, frame in self._ordered(input_queue, self.reconstruct_workers, stats):
+            start_time = time.time()
+            out.write(frame)
+            stats.record_item(time.time() - start_time)
+            if self.progress:
+                print_progress_bar(min(index + 1, self.length), max(self.length, 1))
+
+    ############################
+    # queues and threads
+    ###########################
+
+    def _run(self, stage, *args):
+        """
+        Runs a stage in a thread, the first exception stops all stages and is raised by __call__
+        """
+        try:
+            stage(*args)
+        except PipelineStopped:
+            pass
+        except Exception as ex:
+            self.error = self.error or ex
+            self.stop.set()
+
+    def _put(self, output_queue, item):
+        # blocks while the queue is full, but stops if another worker failed
+        while True:
+            try:
+                output_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+
+    def _get(self, input_queue, stats):
+        stats.record_depth(input_queue.qsize())
+        while True:
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+
+    def _ordered(self, input_queue, producers, stats, first_index=0):
+        """
+        Yields the items of a queue in the order of their index (first element of each item) until each producer
+        passed END
+        :param input_queue: queue filled by several workers
+        :param producers: number of workers filling the queue
+        :param stats: StageStats of the consuming stage
+        :param first_index: index of the first item
+        """
+        buffer = {}
+        next_index = first_index
+        finished = 0
+        while finished < producers:
+            item = self._get(input_queue, stats)
+            if item is END:
+                finished += 1
+                continue
+            buffer[item[0]] = item
+            while next_index in buffer:
+                yield buffer.pop(next_index)
+                next_index += 1
+
+
+def convert_video_segments(input_path, output_path, anonymizer_kwargs, segments=4, warmup=10, fourcc='X264',
+                           video_seed=None, **pipeline_kwargs):
+    """
+    Splits a video into frame ranges that are anonymized in separate processes, each with its own Anonymizer and
+    VideoPipeline, and concatenates the anonymized segments in order (look into concatenate_videos). The extractor of
+    each process is warmed up with the frames before its range (look into VideoPipeline.__call__).
+    :param input_path: path of the video
+    :param output_path: destination of the anonymized video
+    :param anonymizer_kwargs: arguments of the Anonymizer of each process (model_folder, config, postprocessing, ...),
+    the video mode is always used | they are pickled, the config has to be a class of an importable module
+    :param segments: number of frame ranges and processes | only 1 with multi_face: the tracks of each range are
+    numbered independently, a face could get another identity (or the identity of another face) at the boundaries
+    :param warmup: number of frames each range overlaps with the previous one to warm up the extractor
+    :param fourcc: codec of the anonymized video
+    :param video_seed: seed of the noise of the tracks shared by all processes, thus a track gets the same identity in
+    each segment (look into Anonymizer.reset), by default a random seed
+    :param pipeline_kwargs: passed to VideoPipeline
+    :return: list with the statistics of each segment (look into VideoPipeline.__call__)
+    """
+    input_path, output_path = Path(input_path), Path(output_path)
+    cap = cv2.VideoCapture(str(input_path))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    segments = max(1, min(segments, frame_count))
+    if segments > 1 and anonymizer_kwargs.get('multi_face', False):
+        raise ValueError('multi_face needs segments=1, the track ids of the segments would not match')
+    bounds = [frame_count * i // segments for i in range(segments + 1)]
+    # the frame count of some containers is not exact, the last segment is read until the end of the video
+    bounds[-1] = None
+    # the cores are shared by the processes
+    torch_threads = max(1, os.cpu_count() // segments)
+    if video_seed is None:
+        video_seed = random.randrange(2 ** 63)
+
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as segment_folder:
+        paths = [Path(segment_folder) / ('segment_%d%s' % (i, output_path.suffix)) for i in range(segments)]
+        arguments = [(anonymizer_kwargs, input_path, paths[i], bounds[i], bounds[i + 1], warmup, fourcc,
+                      torch_threads, video_seed, pipeline_kwargs) for i in range(segments)]
+        # the parent may run threads (torch, OpenCV), forking them is not safe
+        with multiprocessing.get_context('spawn').Pool(segments) as pool:
+            stats = pool.starmap(_convert_segment, arguments)
+        concatenate_videos(paths, output_path, fourcc)
+    return stats
+
+
+def _convert_segment(anonymizer_kwargs, input_path, output_path, start, end, warmup, fourcc, torch_threads,
+                     video_seed, pipeline_kwargs):
+    torch.set_num_threads(torch_threads)
+    anonymizer = Anonymizer(**dict(anonymizer_kwargs, video_mode=True))
+    pipeline = VideoPipeline(anonymizer, **pipeline_kwargs)
+    return pipeline(input_path, output_path, fourcc=fourcc, progress=False, start=start, end=end, warmup=warmup,
+                    video_seed=video_seed)
+
+
+def concatenate_videos(paths, output_path, fourcc='X264'):
+    """
+    Concatenates videos with the same resolution and codec in order. ffmpeg copies the encoded streams without
+    re-encoding them, without ffmpeg (or if it fails) the frames are re-encoded with OpenCV.
+    :param paths: list of paths of the videos
+    :param output_path: destination of the concatenated video
+    :param fourcc: codec of the concatenated video (OpenCV only)
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        with tempfile.TemporaryDirectory() as folder:
+            list_path = Path(folder) / 'segments.txt'
+            list_path.write_text(''.join("file '%s'\n" % Path(path).resolve() for path in paths))
+            result = subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                                     '-i', str(list_path), '-c', 'copy', str(output_path)])
+        if result.returncode == 0:
+            return
+        print('ffmpeg could not concatenate the videos, they are re-encoded')
+
+    out = None
+    for path in paths:
+        cap = cv2.VideoCapture(str(path))
+        if out is None:
+            out = cv2.VideoWriter(str(output_path), cv2.VideoWriter_fourcc(*fourcc), cap.get(cv2.CAP_PROP_FPS),
+                                  (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))))
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            out.write(frame)
+        cap.release()
+    if out is not None:
+        out.release()
+
+
+def format_stats(stats):
+    """
+    :param stats: statistics returned by VideoPipeline
+    :return: the statistics as table
+    """
+    lines = ['%-12s %8s %8s %14s %12s %11s %10s' % ('stage', 'frames', 'fps', 'fps/worker', 'utilization',
+                                                   'queue mean', 'queue max')]
+    for name in VideoPipeline.STAGES:
+        stage = stats[name]
+        lines.append('%-12s %8d %8.1f %14.1f %11.0f%% %11.1f %10d' % (
+            name, stage['frames'], stage['fps'], stage['fps_per_worker'], stage['utilization'] * 100,
+            stage['queue_mean'], stage['queue_max']))
+    lines.append('total: %.1f fps, %.1f s' % (stats['fps'], stats['elapsed']))
+    if 'reused' in stats:
+        lines.append('faces: %d generated, %d reused' % (stats['generated'], stats['reused']))
+    return '\n'.join(lines)
@@ -0,0 +1,103 @@
+import argparse
+import math
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from Preprocessor.FaceReconstructor import FaceBlurer, FaceSharpener, LumaFilter
+
+
+def measure(function, repeats):
+    """
+    :return: mean seconds of one call of function
+    """
+    function()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start_time) / repeats
+
+
+def psnr(expected, output):
+    mse = np.mean((expected.astype(np.float64) - output) ** 2)
+    return 10 * math.log10(255 ** 2 / mse) if mse > 0 else math.inf
+
+
+def synthetic_face(size, seed=0):
+    """
+    :return: smooth random RGB image with some noise, a stand-in for a generated face
+    """
+    rng = np.random.RandomState(seed)
+    image = cv2.resize(rng.randint(0, 256, (8, 8, 3)).astype(np.uint8), (size, size), interpolation=cv2.INTER_CUBIC)
+    return np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+
+
+def load_faces(paths, max_images):
+    """
+    :param paths: image files or folders with image files (i.e. the face crops of a preprocessed data set)
+    :param max_images: maximal number of images
+    :return: list of RGB images
+    """
+    files = []
+    for path in map(Path, paths):
+        files += sorted(file for file in path.iterdir() if file.is_file()) if path.is_dir() else [path]
+    faces = [cv2.imread(str(file)) for file in files[:max_images]]
+    return [cv2.cvtColor(face, cv2.COLOR_BGR2RGB) for face in faces if face is not None]
+
+
+def compare_filters(faces, region, repeats):
+    """
+    Prints the time of each filter on the first face and the PSNR of the luma approximations w.r.t. the CIELab filters
+    on all faces
+    :param faces: list of RGB images
+    :param region: fraction of the width and height covered by the mask
+    :param repeats: number of calls of each filter
+    """
+    def region_of(face):
+        H, W = face.shape[:2]
+        top, left = int(H * (1 - region) / 2), int(W * (1 - region) / 2)
+        return top, H - top, left, W - left
+
+    print('%-8s %10s %10s %13s %8s %15s %14s' % ('filter', 'Lab [ms]', 'luma [ms]', 'region [ms]', 'speedup',
+                                                 'PSNR mean [dB]', 'PSNR min [dB]'))
+    for name, lab_filter, luma_filter in [('blur', FaceBlurer(), LumaFilter(FaceBlurer().blur_factor, amount=-1)),
+                                          ('sharp', FaceSharpener(),
+                                           LumaFilter(FaceSharpener().sharp_factor, amount=1))]:
+        face, (top, bottom, left, right) = faces[0], region_of(faces[0])
+        lab_time = measure(lambda: lab_filter(face.copy()), repeats)
+        luma_time = measure(lambda: luma_filter(face), repeats)
+        region_time = measure(lambda: luma_filter.filter_region(face, top, bottom, left, right), repeats)
+        # the filters are compared on the region
+        psnrs = []
+        for face in faces:
+            top, bottom, left, right = region_of(face)
+            psnrs.append(psnr(lab_filter(face.copy())[top:bottom, left:right],
+                              luma_filter.filter_region(face, top, bottom, left, right)))
+        print('%-8s %10.3f %10.3f %13.3f %7.1fx %15.1f %14.1f' % (name, lab_time * 1e3, luma_time * 1e3,
+                                                                 region_time * 1e3, lab_time / region_time,
+                                                                 np.mean(psnrs), np.min(psnrs)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the postprocessing filters of the FaceReconstructor: the '
+                                                 'CIELab filters with their luma approximations (fast_postprocessing) '
+                                                 'on a synthetic image and on face images')
+    parser.add_argument('--images', nargs='*', default=[],
+                        help='RGB face images or folders with face images, i.e. the face crops of a preprocessed data '
+                             'set (look into preprocess.py)')
+    parser.add_argument('--max_images', type=int, default=100, help='maximal number of face images')
+    parser.add_argument('--size', type=int, default=256, help='size of the synthetic image')
+    parser.add_argument('--region', type=float, default=0.7,
+                        help='fraction of the width and height covered by the mask (the luma filter only filters '
+                             'this region)')
+    parser.add_argument('--repeats', type=int, default=200, help='number of calls of each filter')
+    args = parser.parse_args()
+
+    print('synthetic image %dx%d' % (args.size, args.size))
+    compare_filters([synthetic_face(args.size)], args.region, args.repeats)
+    if args.images:
+        faces = load_faces(args.images, args.max_images)
+        print('\n%d face images' % len(faces))
+        compare_filters(faces, args.region, args.repeats)
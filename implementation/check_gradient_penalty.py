@@ -0,0 +1,62 @@
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from Configuration.config_model import CPGGAN_CONFIG
+
+
+def gradient_penalties(model, real, fake, features, cur_level):
+    """
+    :return: gradient penalty and gradients of the discriminator parameters with the features concatenated as constant
+    feature maps and with the broadcast features (look into CPGGAN.discriminator_input)
+    """
+    alpha = torch.rand(real.size(0), 1, 1, 1)
+    results = []
+    for broadcast in [False, True]:
+        model.D.zero_grad()
+        if broadcast:
+            penalty = model.calculate_gradient_penalty(real, fake, cur_level, features, alpha=alpha)
+        else:
+            penalty = model.calculate_gradient_penalty(model.concatenate_features(real, features),
+                                                       model.concatenate_features(fake, features), cur_level,
+                                                       alpha=alpha)
+        penalty.backward()
+        results.append((penalty.item(), [parameter.grad.clone() for parameter in model.D.parameters()
+                                         if parameter.grad is not None]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the gradient penalty of the CPGGAN with broadcast features '
+                                                 'to the penalty with the features as constant feature maps on random '
+                                                 'data for every level of the discriminator')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of examples')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random weights and data')
+    parser.add_argument('--rtol', type=float, default=1e-4,
+                        help='relative tolerance of the penalty and of the norm of the parameter gradients')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model = CPGGAN_CONFIG.model(**CPGGAN_CONFIG.model_params, mode='validate')
+    model.D.float().cpu()
+    model.cuda = False
+
+    print('%-6s %-8s %14s %14s %18s' % ('level', 'phase', 'GP maps', 'GP broadcast', 'rel. grad diff'))
+    failed = False
+    for level in range(1, model.max_level + 1):
+        resolution = 2 ** (level + 1)
+        # the fading phase interpolates the output of the previous level
+        for fading, cur_level in [(False, level)] + ([(True, level - 0.5)] if level > 1 else []):
+            model.D.select_level(level, fading)
+            real, fake = torch.rand(2, args.batch_size, 3, resolution, resolution) * 2 - 1
+            features = torch.rand(args.batch_size, model.feature_size) * 2 - 1
+            (gp_maps, grads_maps), (gp, grads) = gradient_penalties(model, real, fake, features, cur_level)
+            grads_maps, grads = torch.cat([g.view(-1) for g in grads_maps]), torch.cat([g.view(-1) for g in grads])
+            grad_diff = ((grads_maps - grads).norm() / grads_maps.norm()).item()
+            equal = np.isclose(gp, gp_maps, rtol=args.rtol) and grad_diff <= args.rtol
+            failed |= not equal
+            print('%-6d %-8s %14.6g %14.6g %18.3g%s' % (level, 'fading' if fading else 'stable', gp_maps, gp,
+                                                        grad_diff, '' if equal else '  <- differs'))
+    sys.exit(1 if failed else 0)
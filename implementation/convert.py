@@ -1,15 +1,17 @@
+import argparse
 from pathlib import Path
 
-import cv2
-import numpy as np
 from PIL import Image
 
 from Configuration.config_model import current_config
 from Utils.Anonymizer import Anonymizer
-from Utils.Logging.LoggingUtils import print_progress_bar
+from Utils.VideoPipeline import VideoPipeline, convert_video_segments, format_stats
 
 
-def convert_images():
+def convert_images(batch_size=16):
+    """
+    :param batch_size: number of images whose faces are anonymized in one forward pass
+    """
     anonymizer = Anonymizer(
         model_folder='model',
         config=current_config)
@@ -17,22 +19,39 @@ def convert_images():
     result_path = path / 'result'
     result_path.mkdir(exist_ok=True)
 
+    image_files = []
     for image_file in path.iterdir():
         if image_file.is_dir():
             print('Skipping image:', image_file.name)
             continue
-        print('Processing image:', image_file.name)
-        image = Image.open(image_file)
-        image = image.convert('RGB')
-        new_image = anonymizer(image)
-        if new_image is not None:
-            new_image.save(result_path / image_file.name.__str__())
+        image_files.append(image_file)
 
+    for start in range(0, len(image_files), batch_size):
+        batch_files = image_files[start:start + batch_size]
+        for image_file in batch_files:
+            print('Processing image:', image_file.name)
+        images = [Image.open(image_file).convert('RGB') for image_file in batch_files]
+        for image_file, new_image in zip(batch_files, anonymizer.anonymize_batch(images)):
+            if new_image is not None:
+                new_image.save(result_path / image_file.name.__str__())
 
-def convert_video():
-    anonymizer = Anonymizer(
+
+def convert_video(segments=1, reuse_threshold=0, max_reuse_age=10, multi_face=False):
+    """
+    :param segments: number of processes, each anonymizes a frame range of the video with its own model
+    :param reuse_threshold: the anonymized face of the previous frame is reused while the normalized landmarks moved
+    less than this threshold, 0 anonymizes every face (look into Anonymizer)
+    :param max_reuse_age: maximal number of frames an anonymized face is reused
+    :param multi_face: track and anonymize all faces of a frame instead of the first face (only with segments=1)
+    """
+    anonymizer_kwargs = dict(
         model_folder='/home/stromaxi/ml-lab-summer-18-project-2/implementation/logs/__CGAN_10Landmarks/model/',
-        config=current_config, video_mode=True, postprocessing='blur')
+        config=current_config, postprocessing='blur', reuse_threshold=reuse_threshold, max_reuse_age=max_reuse_age,
+        multi_face=multi_face)
+    # decoding, extraction, anonymization, reconstruction and encoding run concurrently
+    pipeline_kwargs = dict(extract_workers=4, reconstruct_workers=2, batch_size=8)
+    if segments == 1:
+        pipeline = VideoPipeline(Anonymizer(**anonymizer_kwargs, video_mode=True), **pipeline_kwargs)
     path = Path('/nfs/students/summer-term-2018/project_2/test_max/')
     result_path = path / 'result'
     result_path.mkdir(exist_ok=True)
@@ -40,36 +59,26 @@ def convert_video():
         if video_file.is_dir():
             continue
         print(f'Processing video:{video_file.name}')
-        cap = cv2.VideoCapture(video_file.__str__())
-        frame_width = int(cap.get(3))
-        frame_height = int(cap.get(4))
-        length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        out = cv2.VideoWriter((result_path / (video_file.name.__str__())).__str__(),
-                              cv2.VideoWriter_fourcc('X', '2', '6', '4'), fps,
-                              (frame_width, frame_height))
-        curr = 0
-        print_progress_bar(curr, length)
-        while True:
-            ret, frame = cap.read()
-            curr += 1
-            if ret:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(frame)
-                new_image = anonymizer(image)
-                if not new_image:
-                    new_image = image
-                new_image = np.array(new_image)
-                new_image = cv2.cvtColor(new_image, cv2.COLOR_RGB2BGR)
-                out.write(new_image)
-                print_progress_bar(curr, length)
-            else:
-                break
-        cap.release()
-        out.release()
-
-        cv2.destroyAllWindows()
+        if segments == 1:
+            print(format_stats(pipeline(video_file, result_path / video_file.name)))
+        else:
+            for i, stats in enumerate(convert_video_segments(video_file, result_path / video_file.name,
+                                                             anonymizer_kwargs, segments=segments,
+                                                             **pipeline_kwargs)):
+                print('Segment %d:' % i)
+                print(format_stats(stats))
 
 
 if __name__ == '__main__':
-    convert_video()
+    parser = argparse.ArgumentParser(description='Anonymize the videos of the test folder')
+    parser.add_argument('--segments', type=int, default=1, help='number of processes, each anonymizes a frame range')
+    parser.add_argument('--reuse_threshold', type=float, default=0,
+                        help='the anonymized face of the previous frame is reused while the normalized landmarks moved '
+                             'less than this threshold, 0 anonymizes every face')
+    parser.add_argument('--max_reuse_age', type=int, default=10,
+                        help='maximal number of frames an anonymized face is reused')
+    parser.add_argument('--multi_face', action='store_true', help='track and anonymize all faces of a frame')
+    args = parser.parse_args()
+
+    convert_video(segments=args.segments, reuse_threshold=args.reuse_threshold, max_reuse_age=args.max_reuse_age,
+                  multi_face=args.multi_face)
@@ -0,0 +1,46 @@
+import argparse
+
+from Configuration.config_model import current_config
+from Utils.Bundle import save_bundle
+from Utils.DataSplitter import DataSplitter
+from Utils.Export import export_model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the inference network of the current config as frozen '
+                                                 'TorchScript module that can be loaded by the Anonymizer')
+    parser.add_argument('--model_folder', default='model', help='folder containing the saved modules')
+    parser.add_argument('--output', default='model/anonymizer.pt', help='destination of the exported file')
+    parser.add_argument('--level', type=int, default=None,
+                        help='output level of the generator (PGGAN and CPGGAN only), default: highest level')
+    parser.add_argument('--target', default=None,
+                        help='identity the faces are swapped to (DeepFake only), default: target of the config')
+    parser.add_argument('--quantize', action='store_true',
+                        help='int8 quantization (cpu): linear layers dynamically, convolution blocks statically')
+    parser.add_argument('--dynamic_only', action='store_true', help='quantize only the linear layers')
+    parser.add_argument('--bundle', action='store_true',
+                        help='save the weights of the model as single file with memory mapped loading instead '
+                             '(conventionally *.bundle), the level is chosen when anonymizing')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.level is not None:
+        kwargs['level_out'] = args.level
+    # parameters of the model that differ from the config
+    model_params = {}
+    if args.target is not None:
+        kwargs['target'] = args.target
+        model_params['target'] = args.target
+    model = current_config.model(**dict(current_config.model_params, mode='inference', **model_params))
+    model.load_model(args.model_folder)
+
+    if args.bundle:
+        save_bundle(model, args.output, current_config, **model_params)
+    elif args.quantize:
+        # a batch of the validation set calibrates the quantization and is used to report the accuracy drop
+        data_loader = DataSplitter(current_config.data_set(), current_config.batch_size,
+                                   validation_size=current_config.validation_size)
+        batch = next(iter(data_loader.get_validation_data_loader()))
+        export_model(model, args.output, quantize=True, validation_input=model.get_validation_input(batch),
+                     static=not args.dynamic_only, **kwargs)
+    else:
+        export_model(model, args.output, **kwargs)
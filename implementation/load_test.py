@@ -0,0 +1,22 @@
+import argparse
+import asyncio
+from pathlib import Path
+
+from Utils.Server import format_load, generate_load
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput and latency of a server started by serve.py '
+                                                 'with concurrent clients sending the same image')
+    parser.add_argument('--image', required=True, help='encoded image (PNG, JPEG, ...), conventionally with a face')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the server')
+    parser.add_argument('--port', type=int, default=8080, help='port of the server')
+    parser.add_argument('--unix_socket', default=None, help='path of the Unix socket of the server')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests of all clients')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of clients sending at once')
+    parser.add_argument('--format', default='png', choices=['png', 'jpg'], help='format of the anonymized images')
+    args = parser.parse_args()
+
+    stats = asyncio.run(generate_load(Path(args.image).read_bytes(), requests=args.requests,
+                                      concurrency=args.concurrency, image_format=args.format, host=args.host,
+                                      port=args.port, unix_socket=args.unix_socket))
+    print(format_load(stats))
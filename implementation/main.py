@@ -1,12 +1,19 @@
+import argparse
+
 import torch
 
 from Configuration.config_model import current_config
 from Utils.Trainer import Trainer
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the model of the current config')
+    parser.add_argument('--resume', default=None,
+                        help='checkpoint file or folder containing a checkpoint to resume the training from')
+    args = parser.parse_args()
+
     torch.backends.cudnn.benchmark = True
     #torch.backends.cudnn.deterministic = True
 
-    trainer = Trainer(current_config)
+    trainer = Trainer(current_config, resume=args.resume)
 
     trainer.train()
@@ -0,0 +1,38 @@
+import argparse
+
+from Configuration.config_model import current_config
+from Utils.Anonymizer import Anonymizer
+from Utils.Server import AnonymizationServer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve one Anonymizer over HTTP to local clients, the images of '
+                                                 'concurrent requests are anonymized in micro-batches '
+                                                 '(look into Utils/Server.py)')
+    parser.add_argument('--model_folder', default='model',
+                        help='folder containing the saved modules, an exported model or a bundle')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the server')
+    parser.add_argument('--port', type=int, default=8080, help='port of the server')
+    parser.add_argument('--unix_socket', default=None, help='path of a Unix socket used instead of host and port')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='number of faces anonymized in one forward pass without waiting for further requests')
+    parser.add_argument('--max_delay', type=float, default=0.01,
+                        help='seconds the first request of a batch waits for further requests')
+    parser.add_argument('--extract_workers', type=int, default=4,
+                        help='number of threads decoding, extracting, merging and encoding the images')
+    parser.add_argument('--max_queue', type=int, default=64,
+                        help='maximal number of faces waiting for a forward pass, further requests are rejected')
+    parser.add_argument('--postprocessing', default=None, choices=['blur', 'sharp'],
+                        help='postprocessing of the anonymized faces, default: none')
+    parser.add_argument('--fast_postprocessing', action='store_true',
+                        help='approximate the postprocessing on the luma of the faces (compare with benchmark.py)')
+    parser.add_argument('--multi_face', action='store_true', help='anonymize all faces of an image')
+    parser.add_argument('--target', default=None,
+                        help='identity the faces are swapped to (DeepFake only), default: target of the config')
+    args = parser.parse_args()
+
+    anonymizer = Anonymizer(args.model_folder, current_config, postprocessing=args.postprocessing,
+                            fast_postprocessing=args.fast_postprocessing, target=args.target,
+                            multi_face=args.multi_face)
+    server = AnonymizationServer(anonymizer, batch_size=args.batch_size, max_delay=args.max_delay,
+                                 extract_workers=args.extract_workers, max_queue=args.max_queue)
+    server.run(args.host, args.port, args.unix_socket)